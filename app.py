@@ -1,39 +1,264 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify, send_from_directory
-import mercadopago
-from flask import session, flash
+import time
+_import_started = time.perf_counter()
+from flask import Flask, render_template, request, redirect, url_for, jsonify, send_from_directory, send_file, Response
+from flask import session, flash, g, has_request_context
+from flask.logging import default_handler
+from jinja2 import FileSystemBytecodeCache
 import os
 import logging
+import logging.handlers
+import queue
+import atexit
 import urllib.parse
 import json
+import copy
 import tempfile
 import uuid
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 import re
+import threading
+import multiprocessing
+import random
+import secrets
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import csv
+import io
+import socket
+from datetime import datetime, timedelta, timezone
+import sqlite3
+import hashlib
+import gzip
+import mimetypes
+from contextlib import contextmanager
+from types import MappingProxyType
+import click
+import subprocess
+import sys
+import statistics
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 load_dotenv()
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "dev-secret-key")
-app.logger.setLevel(logging.INFO)
+
+# ── Logging ───────────────────────────────────────────────────────────────────
+# El request solo arma el LogRecord y lo deja en una cola acotada; un hilo
+# aparte lo formatea (JSON por defecto) y lo escribe. Si la cola se llena se
+# descarta el registro en lugar de frenar el request. Los eventos de alto
+# volumen (extra={"sample": True}) se muestrean con LOG_SAMPLE_RATE.
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "1"))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_REQUESTS = os.environ.get("LOG_REQUESTS", "1") == "1"
+# Tokens de Mercado Pago (APP_USR-..., TEST-...) que pudieran colarse en un mensaje.
+SECRET_RE = re.compile(r"\b(APP_USR|TEST)-[0-9A-Za-z-]{8,}")
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sample"}
+
+def _redact(text):
+    return SECRET_RE.sub(r"\1-***", text)
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update((k, v) for k, v in vars(record).items() if k not in _RECORD_ATTRS)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return _redact(json.dumps(entry, ensure_ascii=False, default=str))
+
+class TextLogFormatter(logging.Formatter):
+    def format(self, record):
+        return _redact(super().format(record))
+
+class LogContextFilter(logging.Filter):
+    # Corre en el hilo del request, antes de encolar: agrega el request id y
+    # descarta la fraccion muestreada de los eventos de alto volumen.
+    def filter(self, record):
+        if getattr(record, "sample", False) and LOG_SAMPLE_RATE < 1 and random.random() >= LOG_SAMPLE_RATE:
+            return False
+        if has_request_context() and "request_id" in g:
+            record.request_id = g.request_id
+        return True
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, handler):
+        super().__init__(queue.Queue(LOG_QUEUE_SIZE))
+        self.target = handler
+        self.dropped = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_listener(self):
+        # El hilo se crea por proceso y recien al primer log (sobrevive al fork de gunicorn).
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self.queue = queue.Queue(LOG_QUEUE_SIZE)
+                    listener = logging.handlers.QueueListener(self.queue, self.target)
+                    listener.start()
+                    atexit.register(listener.stop)
+                    self._pid = os.getpid()
+
+    def prepare(self, record):
+        # Sin formatear: getMessage() se resuelve en el hilo del listener.
+        if self.dropped:
+            record.logs_dropped, self.dropped = self.dropped, 0
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+_log_target = logging.StreamHandler()
+_log_target.setFormatter(JsonLogFormatter() if LOG_FORMAT == "json"
+                         else TextLogFormatter("[%(asctime)s] %(levelname)s in %(module)s: %(message)s"))
+log_handler = NonBlockingQueueHandler(_log_target)
+log_handler.addFilter(LogContextFilter())
+app.logger.removeHandler(default_handler)
+app.logger.addHandler(log_handler)
+app.logger.setLevel(LOG_LEVEL)
+app.logger.propagate = False
+
+@app.before_request
+def assign_request_id():
+    g.request_id = (request.headers.get("X-Request-ID") or uuid.uuid4().hex)[:64]
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def log_request(response):
+    response.headers["X-Request-ID"] = g.request_id
+    if LOG_REQUESTS:
+        app.logger.info("%s %s %s", request.method, request.path, response.status_code, extra={
+            "event": "request", "method": request.method, "path": request.path,
+            "status": response.status_code, "sample": True,
+            "duration_ms": round((time.perf_counter() - g.request_started) * 1000, 2)})
+    return response
 
 BASE_DIR = os.path.dirname(__file__)
 DATA_DIR = os.environ.get("DATA_DIR", "/data")
 
-try:
-    os.makedirs(DATA_DIR, exist_ok=True)
-    test_path = os.path.join(DATA_DIR, ".writetest")
-    with open(test_path, "w", encoding="utf-8") as _f:
-        _f.write("ok")
-    os.remove(test_path)
-    SETTINGS_DIR = DATA_DIR
-except Exception:
-    SETTINGS_DIR = BASE_DIR
+# Importar el modulo no escribe en disco: "flask init-data" crea DATA_DIR y
+# settings.json (si falta, settings.json se copia en el primer uso). Mientras
+# DATA_DIR no exista o no se pueda escribir se usa instance/ dentro del repo
+# (ignorado por git): el settings.json versionado nunca se reescribe.
+SETTINGS_DIR = DATA_DIR if os.access(DATA_DIR, os.W_OK) else os.path.join(BASE_DIR, "instance")
+if SETTINGS_DIR != DATA_DIR:
+    app.logger.warning("DATA_DIR %s no existe o no se puede escribir; los datos van a %s "
+                       "(correr \"flask init-data\" en produccion)", DATA_DIR, SETTINGS_DIR,
+                       extra={"event": "data_dir_fallback"})
 
 SETTINGS_PATH = os.path.join(SETTINGS_DIR, "settings.json")
 LOGOS_DIR = os.path.join(DATA_DIR, "logos")
-os.makedirs(LOGOS_DIR, exist_ok=True)
+JINJA_CACHE_DIR = os.environ.get("JINJA_CACHE_DIR", os.path.join(DATA_DIR, "jinja-cache"))
+if os.path.isdir(JINJA_CACHE_DIR):
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
 REPO_SETTINGS_PATH = os.path.join(BASE_DIR, "settings.json")
+SETTINGS_BACKEND = os.environ.get("SETTINGS_BACKEND", "json").lower()
+SETTINGS_DB_PATH = os.environ.get("SETTINGS_DB_PATH", os.path.join(SETTINGS_DIR, "settings.db"))
+# SETTINGS_BACKEND=redis comparte settings y logos entre varios nodos (ver RedisSettingsStore).
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+REDIS_PREFIX = os.environ.get("REDIS_PREFIX", "inscripciones:")
+SETTINGS_POLL_SECONDS = float(os.environ.get("SETTINGS_POLL_SECONDS", "2"))
+# Sin Redis, directorio compartido entre nodos para los logos subidos (ver LocalLogoStore).
+LOGO_SHARED_DIR = os.environ.get("LOGO_SHARED_DIR", "")
+
+# ── Metricas ──────────────────────────────────────────────────────────────────
+# Con METRICS_ENABLED=1 (requiere prometheus_client) se publica /metrics. Con
+# varios workers de gunicorn hay que definir PROMETHEUS_MULTIPROC_DIR: cada
+# worker escribe sus valores en ese directorio y /metrics los suma (ver
+# gunicorn.conf.py). Apagadas, los hooks de request no se registran y cada
+# punto instrumentado cuesta solo el chequeo de "metrics".
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "0") == "1"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+WEBHOOK_TOPICS = {"payment", "merchant_order"}
+
+class Metrics:
+    def __init__(self):
+        from prometheus_client import Counter, Gauge, Histogram
+        self.http_latency = Histogram("http_request_duration_seconds", "Duracion de requests por ruta",
+                                      ["route", "method"], buckets=LATENCY_BUCKETS)
+        self.http_requests = Counter("http_requests_total", "Requests por ruta y status",
+                                     ["route", "method", "status"])
+        self.http_in_flight = Gauge("http_requests_in_flight", "Requests en curso", multiprocess_mode="livesum")
+        self.settings_cache = Counter("settings_cache_total", "Lecturas del cache de settings", ["result"])
+        self.settings_parse = Histogram("settings_parse_seconds", "Lectura y compilacion de settings",
+                                        ["backend"], buckets=FAST_BUCKETS)
+        self.settings_save = Histogram("settings_save_seconds", "Escritura de settings", ["backend"],
+                                       buckets=FAST_BUCKETS)
+        self.settings_fsync = Histogram("settings_fsync_seconds", "fsync de settings.json", buckets=FAST_BUCKETS)
+        self.mp_latency = Histogram("mercadopago_request_duration_seconds", "Llamadas a Mercado Pago",
+                                    ["operation", "outcome"], buckets=LATENCY_BUCKETS)
+        self.mp_in_flight = Gauge("mercadopago_requests_in_flight", "Llamadas a Mercado Pago en curso",
+                                  multiprocess_mode="livesum")
+        self.webhooks_received = Counter("webhooks_received_total", "Notificaciones recibidas",
+                                         ["topic", "result"])
+        self.webhooks_processed = Counter("webhooks_processed_total", "Notificaciones procesadas",
+                                          ["topic", "status"])
+        self.webhook_fetches_in_flight = Gauge("webhook_fetches_in_flight", "Consultas de pagos en curso",
+                                               multiprocess_mode="livesum")
+
+metrics = None
+if METRICS_ENABLED:
+    try:
+        metrics = Metrics()
+    except ImportError:
+        app.logger.warning("METRICS_ENABLED=1 pero prometheus_client no esta instalado: /metrics desactivado")
+
+if metrics:
+    @app.before_request
+    def metrics_request_started():
+        g.metrics_started = time.perf_counter()
+        metrics.http_in_flight.inc()
+
+    @app.after_request
+    def metrics_request_finished(response):
+        # Se etiqueta con la regla ("/inscripciones/<camp_id>") para no crear una serie por URL.
+        route = request.url_rule.rule if request.url_rule else "sin_ruta"
+        metrics.http_latency.labels(route, request.method).observe(time.perf_counter() - g.metrics_started)
+        metrics.http_requests.labels(route, request.method, str(response.status_code)).inc()
+        return response
+
+    @app.teardown_request
+    def metrics_request_teardown(exc):
+        # asgi.py suspende el checkout mientras espera a MP y lo retoma en otro
+        # contexto; el request sigue en curso hasta ese segundo teardown.
+        if not g.get("request_suspended"):
+            metrics.http_in_flight.dec()
+
+def _metric_topic(topic):
+    return topic if topic in WEBHOOK_TOPICS else "otro"
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not metrics:
+        return "Not Found", 404
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return "Unauthorized", 401
+    from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest, multiprocess
+    registry = REGISTRY
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
 
 DEFAULT_GOOGLE_FORMS = {
     "competitors_id": "",
@@ -86,17 +311,14 @@ def _migrate_old_settings(old):
     new["campeonatos"] = [camp]
     return new
 
-def _bootstrap_settings_file():
-    if not os.path.exists(SETTINGS_PATH):
-        src = REPO_SETTINGS_PATH if os.path.exists(REPO_SETTINGS_PATH) else None
-        if src:
-            import shutil
-            shutil.copyfile(src, SETTINGS_PATH)
-        else:
-            with open(SETTINGS_PATH, "w", encoding="utf-8") as f:
-                json.dump(DEFAULT_SETTINGS, f, ensure_ascii=False, indent=2)
-
-_bootstrap_settings_file()
+def _bootstrap_settings_file(path):
+    # Copia el settings.json del repo (o los valores por defecto) si falta.
+    if not os.path.exists(path):
+        data = DEFAULT_SETTINGS
+        if os.path.exists(REPO_SETTINGS_PATH):
+            with open(REPO_SETTINGS_PATH, encoding="utf-8") as f:
+                data = json.load(f)
+        _write_json_atomic(path, data)
 
 ALLOWED_LOGO_EXTENSIONS = {"png", "jpg", "jpeg", "gif", "webp"}
 URL_BASE = os.environ.get("URL_BASE", "https://metropolitanopagos-inscripciones.onrender.com")
@@ -110,46 +332,203 @@ def extract_form_id(url_or_id):
         return match.group(1)
     return url_or_id.strip()
 
+_settings_lock = threading.RLock()
+_settings_cache = {"stamp": None, "data": None}
+
+class _Frozen:
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for key, value in fields.items():
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"{type(self).__name__} es de solo lectura")
+
+class Clase(_Frozen):
+    __slots__ = ("name", "closed", "price", "discount_price", "capacity", "label",
+                 "regular_price", "discounted_price", "item_title", "discounted_title")
+
+class Campeonato(_Frozen):
+    __slots__ = ("id", "name", "active", "logo", "title_main", "title_strong", "allow_cash_payments",
+                 "google_forms", "discount_enabled", "discount_percentage", "discount_description",
+                 "camp_prefix", "classes", "sorted_classes", "classes_by_name", "enabled_classes",
+                 "enabled_names")
+
+class Settings(_Frozen):
+    __slots__ = ("revision", "cuba_logo", "site_closed", "campeonatos", "campeonatos_by_id", "activos")
+
+    def get_camp(self, camp_id):
+        return self.campeonatos_by_id.get(camp_id)
+
+def _compile_clase(cls, camp):
+    name = cls.get("name", "")
+    price = cls.get("price")
+    prefix = camp.get("camp_prefix", "").strip()
+    label = f"{prefix}_{name}" if prefix else name
+    regular_price = discounted_price = None
+    if price is not None:
+        regular_price = max(1, int(price))
+        if camp.get("discount_enabled"):
+            discount_pct = int(camp.get("discount_percentage", 0))
+            discounted_price = max(1, round(int(price) * (1 - discount_pct / 100), 2))
+    return Clase(
+        name=name,
+        closed=bool(cls.get("closed", False)),
+        price=price,
+        discount_price=cls.get("discount_price"),
+        capacity=int(cls.get("capacity") or 0),
+        label=label,
+        regular_price=regular_price,
+        discounted_price=discounted_price,
+        item_title=f"Inscripcion Competidor - {label}",
+        discounted_title=f"Inscripcion Competidor - {label} ({camp.get('discount_description', 'Descuento')})",
+    )
+
+def _compile_campeonato(camp):
+    classes = tuple(_compile_clase(c, camp) for c in camp.get("classes", []))
+    sorted_classes = tuple(sorted(classes, key=lambda c: c.closed))
+    return Campeonato(
+        id=camp["id"],
+        name=camp.get("name", ""),
+        active=bool(camp.get("active", True)),
+        logo=camp.get("logo", "static/images/Metropolitano.png"),
+        title_main=camp.get("title_main", "Inscripciones"),
+        title_strong=camp.get("title_strong", ""),
+        allow_cash_payments=bool(camp.get("allow_cash_payments", True)),
+        google_forms=MappingProxyType(dict(camp.get("google_forms", DEFAULT_GOOGLE_FORMS))),
+        discount_enabled=bool(camp.get("discount_enabled", False)),
+        discount_percentage=camp.get("discount_percentage", 0),
+        discount_description=camp.get("discount_description", ""),
+        camp_prefix=camp.get("camp_prefix", ""),
+        classes=classes,
+        sorted_classes=sorted_classes,
+        classes_by_name=MappingProxyType({c.name: c for c in classes}),
+        enabled_classes=frozenset(c.name for c in classes if not c.closed),
+        enabled_names=tuple(c.name for c in sorted_classes if not c.closed),
+    )
+
+def compile_settings(raw, revision=None):
+    campeonatos = tuple(_compile_campeonato(c) for c in raw.get("campeonatos", []))
+    return Settings(
+        revision=revision,
+        cuba_logo=raw.get("cuba_logo", "static/images/Metropolitano.png"),
+        site_closed=bool(raw.get("site_closed", False)),
+        campeonatos=campeonatos,
+        campeonatos_by_id=MappingProxyType({c.id: c for c in campeonatos}),
+        activos=tuple(c for c in campeonatos if c.active),
+    )
+
+def _settings_stamp():
+    try:
+        st = os.stat(SETTINGS_PATH)
+    except FileNotFoundError:
+        # Primer uso sin "flask init-data": se crea recien ahora, no al importar.
+        _bootstrap_settings_file(SETTINGS_PATH)
+        st = os.stat(SETTINGS_PATH)
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def _normalize_settings(raw):
+    settings = _migrate_old_settings(raw)
+    for camp in settings.get("campeonatos", []):
+        camp.setdefault("id", str(uuid.uuid4())[:8])
+        camp.setdefault("name", "Campeonato")
+        camp.setdefault("active", True)
+        camp.setdefault("logo", settings.get("cuba_logo", "static/images/Metropolitano.png"))
+        camp.setdefault("title_main", "Inscripciones")
+        camp.setdefault("title_strong", camp["name"])
+        camp.setdefault("allow_cash_payments", True)
+        camp.setdefault("google_forms", dict(DEFAULT_GOOGLE_FORMS))
+        camp["google_forms"].setdefault("entry_id_num_operacion", "entry.1161481877")
+        camp["google_forms"].setdefault("entry_id_clase_barco", "entry.1553765108")
+        camp.setdefault("discount_enabled", False)
+        camp.setdefault("discount_percentage", 0)
+        camp.setdefault("discount_description", "")
+        camp.setdefault("camp_prefix", "")
+        camp.setdefault("classes", [])
+        for cls in camp["classes"]:
+            cls.setdefault("discount_price", None)
+    return settings
+
+def _read_settings_file(path=None):
+    if path is None:
+        _bootstrap_settings_file(SETTINGS_PATH)
+    path = path or SETTINGS_PATH
+    with open(path, 'r', encoding='utf-8') as f:
+        raw = json.load(f)
+    needs_save = "campeonatos" not in raw
+    settings = _normalize_settings(raw)
+    if needs_save and path == SETTINGS_PATH:
+        save_settings(settings)
+    return settings
+
+def invalidate_settings_cache():
+    with _settings_lock:
+        _settings_cache["stamp"] = None
+        _settings_cache["data"] = None
+
+def _cached_settings():
+    # Se vuelve a leer solo si cambio la revision del backend (stat del JSON o contador de SQLite).
+    stamp = settings_store.revision()
+    data = _settings_cache["data"]
+    if data is not None and _settings_cache["stamp"] == stamp:
+        if metrics:
+            metrics.settings_cache.labels("hit").inc()
+        return data
+    with _settings_lock:
+        if _settings_cache["data"] is not None and _settings_cache["stamp"] == stamp:
+            if metrics:
+                metrics.settings_cache.labels("hit").inc()
+            return _settings_cache["data"]
+        started = time.perf_counter()
+        data = compile_settings(settings_store.read(), revision=stamp)
+        if metrics:
+            metrics.settings_cache.labels("miss").inc()
+            metrics.settings_parse.labels(SETTINGS_BACKEND).observe(time.perf_counter() - started)
+        _settings_cache["stamp"] = stamp
+        _settings_cache["data"] = data
+        return data
+
+class SettingsUnavailable(Exception):
+    pass
+
 def load_settings():
+    # Un unico snapshot de solo lectura por request (gate + vista).
+    if has_request_context() and "settings" in g:
+        return g.settings
     try:
-        with open(SETTINGS_PATH, 'r', encoding='utf-8') as f:
-            raw = json.load(f)
-        needs_save = "campeonatos" not in raw
-        settings = _migrate_old_settings(raw)
-        if needs_save:
-            save_settings(settings)
-        for camp in settings.get("campeonatos", []):
-            camp.setdefault("id", str(uuid.uuid4())[:8])
-            camp.setdefault("name", "Campeonato")
-            camp.setdefault("active", True)
-            camp.setdefault("logo", settings.get("cuba_logo", "static/images/Metropolitano.png"))
-            camp.setdefault("title_main", "Inscripciones")
-            camp.setdefault("title_strong", camp["name"])
-            camp.setdefault("allow_cash_payments", True)
-            camp.setdefault("google_forms", dict(DEFAULT_GOOGLE_FORMS))
-            camp["google_forms"].setdefault("entry_id_num_operacion", "entry.1161481877")
-            camp["google_forms"].setdefault("entry_id_clase_barco", "entry.1553765108")
-            camp.setdefault("discount_enabled", False)
-            camp.setdefault("discount_percentage", 0)
-            camp.setdefault("discount_description", "")
-            camp.setdefault("camp_prefix", "")
-            camp.setdefault("classes", [])
-            for cls in camp["classes"]:
-                cls.setdefault("discount_price", None)
-        return settings
-    except Exception:
-        return dict(DEFAULT_SETTINGS)
+        settings = _cached_settings()
+    except Exception as e:
+        app.logger.exception("No se pudieron leer los settings", extra={"event": "settings_unavailable"})
+        # El admin y las escrituras no ven los valores por defecto: un
+        # formulario armado con ellos pisaria los datos reales al guardarse.
+        if has_request_context() and (request.path.startswith('/admin') or request.method not in ('GET', 'HEAD')):
+            raise SettingsUnavailable() from e
+        # Las paginas publicas se degradan a los defaults, sin guardarlos en g.
+        return compile_settings(DEFAULT_SETTINGS)
+    if has_request_context():
+        g.settings = settings
+    return settings
 
-def save_settings(data):
-    dir_ = os.path.dirname(SETTINGS_PATH)
+@app.errorhandler(SettingsUnavailable)
+def settings_unavailable(e):
+    return render_template('payment_status.html', status="no disponible",
+                           message="La configuracion no esta disponible en este momento. Intenta de nuevo en unos minutos."), \
+        503, {"Retry-After": "30"}
+
+def _write_json_atomic(path, data):
+    dir_ = os.path.dirname(path)
     os.makedirs(dir_, exist_ok=True)
     fd, tmp_path = tempfile.mkstemp(prefix="settings.", suffix=".json", dir=dir_)
     try:
         with os.fdopen(fd, 'w', encoding='utf-8') as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
             f.flush()
+            started = time.perf_counter()
             os.fsync(f.fileno())
-        os.replace(tmp_path, SETTINGS_PATH)
+            if metrics:
+                metrics.settings_fsync.observe(time.perf_counter() - started)
+        os.replace(tmp_path, path)
     finally:
         try:
             if os.path.exists(tmp_path):
@@ -157,148 +536,2717 @@ def save_settings(data):
         except Exception:
             pass
 
+def save_settings(data):
+    started = time.perf_counter()
+    _write_json_atomic(SETTINGS_PATH, data)
+    invalidate_settings_cache()
+    if metrics:
+        metrics.settings_save.labels("json").observe(time.perf_counter() - started)
+
+# Backends de settings. Ambos exponen la misma interfaz: revision() barata para
+# validar el cache, read() con el dict completo y operaciones puntuales por
+# campeonato que se aplican atomicamente (sin read-modify-write en la vista).
+
+class JsonSettingsStore:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def revision(self):
+        return _settings_stamp()
+
+    def read(self):
+        return _read_settings_file()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock, open(self.path + ".lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _mutate(self, fn):
+        # Sin cambios no se reescribe el archivo: su mtime es la revision.
+        with self._locked():
+            data = self.read()
+            before = json.dumps(data, sort_keys=True)
+            result = fn(data)
+            if json.dumps(data, sort_keys=True) != before:
+                save_settings(data)
+            return result
+
+    def get_campeonato(self, camp_id):
+        return get_camp_or_none(self.read(), camp_id)
+
+    def set_site(self, **fields):
+        self._mutate(lambda data: data.update(fields))
+
+    def add_campeonato(self, camp):
+        self._mutate(lambda data: data.setdefault("campeonatos", []).append(camp))
+
+    def update_campeonato(self, camp_id, fn):
+        # fn modifica el campeonato en el lugar, dentro de la misma escritura
+        # que lo leyo. Devuelve (antes, despues) o None si no existe.
+        def apply(data):
+            camp = get_camp_or_none(data, camp_id)
+            if camp is None:
+                return None
+            before = copy.deepcopy(camp)
+            fn(camp)
+            camp["id"], camp["active"] = before["id"], before.get("active", True)
+            return before, camp
+        return self._mutate(apply)
+
+    def toggle_campeonato(self, camp_id):
+        def apply(data):
+            camp = get_camp_or_none(data, camp_id)
+            if camp is None:
+                return None
+            camp["active"] = not camp.get("active", True)
+            return camp["active"]
+        return self._mutate(apply)
+
+    def update_classes(self, camp_id, ops):
+        # Devuelve (antes, despues) o None si el campeonato no existe.
+        def apply(camp):
+            camp["classes"] = apply_class_changes(camp.get("classes", []), ops)
+        return self.update_campeonato(camp_id, apply)
+
+    def delete_campeonato(self, camp_id):
+        def apply(data):
+            data["campeonatos"] = [c for c in data.get("campeonatos", []) if c["id"] != camp_id]
+        self._mutate(apply)
+
+    def replace_all(self, data):
+        with self._locked():
+            save_settings(data)
+
+class SqliteSettingsStore:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+        INSERT OR IGNORE INTO meta (key, value) VALUES ('revision', 0);
+        CREATE TABLE IF NOT EXISTS site (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS campeonatos (
+            id TEXT PRIMARY KEY,
+            position INTEGER NOT NULL,
+            active INTEGER NOT NULL DEFAULT 1,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS clases (
+            camp_id TEXT NOT NULL REFERENCES campeonatos(id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (camp_id, position)
+        );
+    """
+
+    def __init__(self, path, seed_from_json=False):
+        self.path = path
+        self.seed_from_json = seed_from_json
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.executescript(self.SCHEMA)
+            self._local.conn = conn
+            if self.seed_from_json and self.is_empty():
+                # Importacion unica desde el settings.json existente.
+                self.replace_all(_read_settings_file())
+        return conn
+
+    @contextmanager
+    def _tx(self):
+        conn = self._conn()
+        started = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            changes = conn.total_changes
+            yield conn
+            # La revision solo sube si se toco alguna fila: una escritura que
+            # no cambia nada no invalida los snapshots ni el cache de paginas.
+            changed = conn.total_changes != changes
+            if changed:
+                conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'revision'")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if not changed:
+            return
+        invalidate_settings_cache()
+        if metrics:
+            metrics.settings_save.labels("sqlite").observe(time.perf_counter() - started)
+
+    def revision(self):
+        return self._conn().execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0]
+
+    def is_empty(self):
+        conn = self._conn()
+        return (conn.execute("SELECT COUNT(*) FROM site").fetchone()[0] == 0
+                and conn.execute("SELECT COUNT(*) FROM campeonatos").fetchone()[0] == 0)
+
+    @staticmethod
+    def _camp_row(camp):
+        fields = {k: v for k, v in camp.items() if k not in ("id", "active", "classes")}
+        return camp["id"], 1 if camp.get("active", True) else 0, json.dumps(fields, ensure_ascii=False)
+
+    @staticmethod
+    def _class_row(cls):
+        fields = {k: v for k, v in cls.items() if k != "name"}
+        return cls.get("name", ""), json.dumps(fields, ensure_ascii=False)
+
+    @staticmethod
+    def _load_camp(conn, row):
+        camp_id, active, data = row
+        camp = {"id": camp_id, "active": bool(active)}
+        camp.update(json.loads(data))
+        camp["classes"] = [dict(json.loads(cls_data), name=name) for name, cls_data in conn.execute(
+            "SELECT name, data FROM clases WHERE camp_id = ? ORDER BY position", (camp_id,))]
+        return camp
+
+    def read(self):
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            settings = dict(DEFAULT_SETTINGS)
+            for key, value in conn.execute("SELECT key, value FROM site"):
+                settings[key] = json.loads(value)
+            settings["campeonatos"] = [self._load_camp(conn, row) for row in conn.execute(
+                "SELECT id, active, data FROM campeonatos ORDER BY position").fetchall()]
+        finally:
+            conn.execute("COMMIT")
+        return _normalize_settings(settings)
+
+    def get_campeonato(self, camp_id):
+        conn = self._conn()
+        row = conn.execute("SELECT id, active, data FROM campeonatos WHERE id = ?", (camp_id,)).fetchone()
+        return _normalize_settings({"campeonatos": [self._load_camp(conn, row)]})["campeonatos"][0] if row else None
+
+    def set_site(self, **fields):
+        with self._tx() as conn:
+            conn.executemany("INSERT INTO site (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE "
+                             "SET value = excluded.value WHERE site.value != excluded.value",
+                             [(k, json.dumps(v, ensure_ascii=False)) for k, v in fields.items()])
+
+    def _insert_camp(self, conn, camp, position):
+        conn.execute("INSERT INTO campeonatos (id, active, data, position) VALUES (?, ?, ?, ?)",
+                     self._camp_row(camp) + (position,))
+        conn.executemany("INSERT INTO clases (camp_id, position, name, data) VALUES (?, ?, ?, ?)",
+                         [(camp["id"], idx) + self._class_row(cls) for idx, cls in enumerate(camp.get("classes", []))])
+
+    def add_campeonato(self, camp):
+        with self._tx() as conn:
+            position = conn.execute("SELECT COALESCE(MAX(position), -1) + 1 FROM campeonatos").fetchone()[0]
+            self._insert_camp(conn, camp, position)
+
+    def update_campeonato(self, camp_id, fn):
+        with self._tx() as conn:
+            row = conn.execute("SELECT id, active, data FROM campeonatos WHERE id = ?", (camp_id,)).fetchone()
+            if row is None:
+                return None
+            before = _normalize_settings({"campeonatos": [self._load_camp(conn, row)]})["campeonatos"][0]
+            camp = copy.deepcopy(before)
+            fn(camp)
+            # "id" y "active" quedan fuera: este ultimo lo maneja toggle_campeonato.
+            camp["id"], camp["active"] = before["id"], before["active"]
+            _, _, data = self._camp_row(camp)
+            conn.execute("UPDATE campeonatos SET data = ? WHERE id = ? AND data != ?", (data, camp_id, data))
+            self._write_classes(conn, camp_id, camp.get("classes", []))
+            return before, camp
+
+    def _write_classes(self, conn, camp_id, classes):
+        # Solo se tocan las filas de clases que realmente cambiaron.
+        conn.executemany(
+            "INSERT INTO clases (camp_id, position, name, data) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (camp_id, position) DO UPDATE SET name = excluded.name, data = excluded.data "
+            "WHERE clases.name != excluded.name OR clases.data != excluded.data",
+            [(camp_id, idx) + self._class_row(cls) for idx, cls in enumerate(classes)])
+        conn.execute("DELETE FROM clases WHERE camp_id = ? AND position >= ?", (camp_id, len(classes)))
+
+    def update_classes(self, camp_id, ops):
+        def apply(camp):
+            camp["classes"] = apply_class_changes(camp["classes"], ops)
+        return self.update_campeonato(camp_id, apply)
+
+    def toggle_campeonato(self, camp_id):
+        with self._tx() as conn:
+            conn.execute("UPDATE campeonatos SET active = 1 - active WHERE id = ?", (camp_id,))
+            row = conn.execute("SELECT active FROM campeonatos WHERE id = ?", (camp_id,)).fetchone()
+            return bool(row[0]) if row else None
+
+    def delete_campeonato(self, camp_id):
+        with self._tx() as conn:
+            conn.execute("DELETE FROM campeonatos WHERE id = ?", (camp_id,))
+
+    def replace_all(self, data):
+        data = _normalize_settings(data)
+        with self._tx() as conn:
+            conn.execute("DELETE FROM site")
+            conn.execute("DELETE FROM campeonatos")
+            conn.executemany("INSERT INTO site (key, value) VALUES (?, ?)",
+                             [(k, json.dumps(v, ensure_ascii=False)) for k, v in data.items() if k != "campeonatos"])
+            for position, camp in enumerate(data.get("campeonatos", [])):
+                self._insert_camp(conn, camp, position)
+
+class RedisSettingsStore(JsonSettingsStore):
+    # Mismo documento unico que el JSON, guardado en <prefijo>settings junto a
+    # un contador <prefijo>settings:rev. Cada escritura es una transaccion
+    # optimista (WATCH/MULTI) que sube el contador y lo publica en
+    # <prefijo>settings:changes. Cada nodo sirve desde un snapshot en memoria
+    # que refresca un hilo suscripto a ese canal; el hilo ademas compara el
+    # contador cada SETTINGS_POLL_SECONDS por si se perdio un mensaje, asi que
+    # un cambio llega a todos los nodos en a lo sumo ese intervalo y las
+    # requests nunca leen de Redis.
+
+    def __init__(self, url, prefix, poll_seconds):
+        self.url = url
+        self.key = f"{prefix}settings"
+        self.rev_key = f"{prefix}settings:rev"
+        self.channel = f"{prefix}settings:changes"
+        self.poll_seconds = poll_seconds
+        self._client = None
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._watcher = None
+
+    def redis(self):
+        if self._client is None:
+            import redis
+            self._client = redis.Redis.from_url(self.url, socket_timeout=5, socket_connect_timeout=3,
+                                                health_check_interval=30)
+        return self._client
+
+    def _refresh(self):
+        # La lectura (o la siembra) y el reemplazo van bajo el mismo lock que
+        # usa _mutate(): una escritura que termina despues de leer deja su
+        # snapshot despues, asi que nunca se pisa una version nueva con una
+        # vieja. Lo leido manda aunque la version baje (Redis se vacio y se
+        # volvio a sembrar).
+        with self._lock:
+            while True:
+                pipe = self.redis().pipeline(transaction=True)
+                pipe.get(self.rev_key)
+                pipe.get(self.key)
+                rev, raw = pipe.execute()
+                if raw is not None:
+                    self._snapshot = (int(rev or 0), raw)
+                    return
+                rev = self._seed()
+                if rev is not None:
+                    break
+        self.redis().publish(self.channel, rev)
+
+    def _seed(self):
+        # Redis vacio (primer nodo o se perdieron los datos): se siembra con el
+        # snapshot de este nodo o, si no hay, con el settings.json local. Si
+        # otro nodo escribe antes del EXEC, WATCH lo aborta y se devuelve None
+        # para releer lo suyo. Se llama con self._lock tomado.
+        from redis.exceptions import WatchError
+        with self.redis().pipeline() as pipe:
+            pipe.watch(self.key)
+            if pipe.get(self.key) is not None:
+                return None
+            current = self._snapshot[1] if self._snapshot else None
+            data = _normalize_settings(json.loads(current) if current else _read_settings_file())
+            raw = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            pipe.multi()
+            pipe.set(self.key, raw)
+            pipe.incr(self.rev_key)
+            try:
+                rev = pipe.execute()[1]
+            except WatchError:
+                return None
+        self._snapshot = (rev, raw)
+        return rev
+
+    def _ensure_started(self):
+        # Se arranca en el primer uso y no al importar: con gunicorn cada
+        # worker tiene su propio hilo y su propia conexion.
+        if self._snapshot is None:
+            self._refresh()
+        with self._lock:
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch, name="settings-watch", daemon=True)
+                self._watcher.start()
+        return self._snapshot
+
+    def _check(self):
+        rev = int(self.redis().get(self.rev_key) or 0)
+        if rev != self._snapshot[0]:
+            self._refresh()
+
+    def _watch(self):
+        while True:
+            try:
+                with self.redis().pubsub(ignore_subscribe_messages=True) as pubsub:
+                    pubsub.subscribe(self.channel)
+                    self._check()
+                    checked = time.monotonic()
+                    while True:
+                        message = pubsub.get_message(timeout=self.poll_seconds)
+                        if message is not None or time.monotonic() - checked >= self.poll_seconds:
+                            self._check()
+                            checked = time.monotonic()
+            except Exception as e:
+                app.logger.warning("Suscripcion a cambios de settings caida: %s", e,
+                                   extra={"event": "settings_watch_error"})
+                time.sleep(self.poll_seconds)
+
+    def _current(self):
+        if self._watcher is None:
+            return self._ensure_started()
+        return self._snapshot
+
+    def revision(self):
+        return self._current()[0]
+
+    def read(self):
+        return _normalize_settings(json.loads(self._current()[1]))
+
+    def _mutate(self, fn):
+        from redis.exceptions import WatchError
+        started = time.perf_counter()
+        with self.redis().pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(self.key)
+                    current = stored = pipe.get(self.key)
+                    if current is None:
+                        # Redis vacio (primer nodo o se perdieron los datos): se siembra con el
+                        # snapshot de este nodo o, si no hay, con el settings.json local.
+                        current = self._snapshot[1] if self._snapshot else None
+                    data = _normalize_settings(json.loads(current) if current else _read_settings_file())
+                    result = fn(data)
+                    raw = json.dumps(data, ensure_ascii=False).encode("utf-8")
+                    if raw == stored:
+                        # Nada que escribir: ni version nueva ni aviso a los demas nodos.
+                        pipe.unwatch()
+                        return result
+                    pipe.multi()
+                    pipe.set(self.key, raw)
+                    pipe.incr(self.rev_key)
+                    rev = pipe.execute()[1]
+                    break
+                except WatchError:
+                    continue
+        self.redis().publish(self.channel, rev)
+        # El nodo que escribe ve su cambio sin esperar al canal.
+        with self._lock:
+            if self._snapshot is None or rev > self._snapshot[0]:
+                self._snapshot = (rev, raw)
+        if metrics:
+            metrics.settings_save.labels("redis").observe(time.perf_counter() - started)
+        return result
+
+    def replace_all(self, data):
+        data = _normalize_settings(data)
+        def apply(current):
+            current.clear()
+            current.update(data)
+        self._mutate(apply)
+
+def _make_settings_store():
+    if SETTINGS_BACKEND == "sqlite":
+        return SqliteSettingsStore(SETTINGS_DB_PATH, seed_from_json=True)
+    if SETTINGS_BACKEND == "redis":
+        return RedisSettingsStore(REDIS_URL, REDIS_PREFIX, SETTINGS_POLL_SECONDS)
+    return JsonSettingsStore(SETTINGS_PATH)
+
+settings_store = _make_settings_store()
+
+@app.cli.command("import-settings")
+@click.argument("path", required=False)
+def import_settings_command(path):
+    """Importa un settings.json al backend configurado."""
+    settings_store.replace_all(_read_settings_file(path))
+    click.echo(f"Settings importados desde {path or SETTINGS_PATH} (revision {settings_store.revision()})")
+
+@app.cli.command("export-settings")
+@click.argument("path", required=False)
+def export_settings_command(path):
+    """Exporta los settings actuales en formato JSON."""
+    path = path or os.path.join(SETTINGS_DIR, "settings.export.json")
+    _write_json_atomic(path, settings_store.read())
+    click.echo(f"Settings exportados a {path}")
+
 def allowed_logo(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_LOGO_EXTENSIONS
 
+# ── Clases en bloque ──────────────────────────────────────────────────────────
+# Varios cambios de clases (abrir/cerrar, precio, cupo, renombrar, agregar,
+# borrar) en una sola escritura del backend, o sea una sola revision de
+# settings. La API PATCH recibe la lista de operaciones y la importacion
+# CSV/XLSX se traduce a la misma lista. Se valida todo antes de escribir: si
+# una operacion falla no se aplica ninguna.
+
+CLASS_OPS = {
+    "add": {"name", "price", "capacity", "closed"},
+    "update": {"name", "new_name", "price", "capacity", "closed"},
+    "delete": {"name"},
+}
+CLASS_SHEET_COLUMNS = ("clase", "precio", "cupo", "abierta")
+CLASS_IMPORT_MAX_ROWS = int(os.environ.get("CLASS_IMPORT_MAX_ROWS", "1000"))
+CLASS_IMPORT_MAX_BYTES = 1024 * 1024
+TRUE_VALUES = {"1", "si", "s", "true", "x", "yes", "abierta"}
+FALSE_VALUES = {"0", "no", "n", "false", "cerrada"}
+
+class ClassChangeError(ValueError):
+    def __init__(self, errors):
+        super().__init__("; ".join(e["error"] for e in errors))
+        self.errors = errors
+
+def _class_name(value):
+    name = str(value or "").strip()
+    if not name:
+        raise ValueError("falta el nombre de la clase")
+    if len(name) > 80:
+        raise ValueError(f"nombre demasiado largo: {name[:20]}...")
+    return name
+
+def _class_int(value, field):
+    # Vacio es "sin precio" o "sin limite". Excel devuelve 30000.0 para enteros.
+    if value is None or value == "":
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"{field} invalido: {value!r}")
+    try:
+        number = int(str(value).strip())
+    except ValueError:
+        raise ValueError(f"{field} invalido: {value!r}") from None
+    if number < 0:
+        raise ValueError(f"{field} no puede ser negativo")
+    return number
+
+def _class_bool(value, field):
+    if isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in TRUE_VALUES:
+        return True
+    if text in FALSE_VALUES:
+        return False
+    raise ValueError(f"{field} invalido: {value!r}")
+
+def _find_class(classes, name):
+    key = name.lower()
+    for idx, cls in enumerate(classes):
+        if cls.get("name", "").lower() == key:
+            return idx
+    return None
+
+def _apply_class_op(classes, op):
+    if not isinstance(op, dict):
+        raise ValueError("cada operacion debe ser un objeto")
+    kind = op.get("op")
+    if kind not in CLASS_OPS:
+        raise ValueError(f"op desconocida: {kind!r}")
+    unknown = set(op) - CLASS_OPS[kind] - {"op"}
+    if unknown:
+        raise ValueError(f"campos no validos para {kind}: {', '.join(sorted(unknown))}")
+    name = _class_name(op.get("name"))
+    idx = _find_class(classes, name)
+    if kind == "add":
+        if idx is not None:
+            raise ValueError(f"la clase {name} ya existe")
+        classes.append({"name": name, "closed": _class_bool(op.get("closed", False), "closed"),
+                        "price": _class_int(op.get("price"), "price"), "discount_price": None,
+                        "capacity": _class_int(op.get("capacity"), "capacity") or 0})
+        return
+    if idx is None:
+        raise ValueError(f"no existe la clase {name}")
+    if kind == "delete":
+        classes.pop(idx)
+        return
+    cls = classes[idx]
+    if "new_name" in op:
+        new_name = _class_name(op["new_name"])
+        other = _find_class(classes, new_name)
+        if other is not None and other != idx:
+            raise ValueError(f"la clase {new_name} ya existe")
+        cls["name"] = new_name
+    if "price" in op:
+        cls["price"] = _class_int(op["price"], "price")
+    if "capacity" in op:
+        cls["capacity"] = _class_int(op["capacity"], "capacity") or 0
+    if "closed" in op:
+        cls["closed"] = _class_bool(op["closed"], "closed")
+
+def apply_class_changes(classes, ops):
+    # Aplica las operaciones en orden sobre una copia (un rename seguido de un
+    # update con el nombre nuevo funciona) y junta todos los errores.
+    if not isinstance(ops, list) or not ops:
+        raise ClassChangeError([{"index": None, "error": "se espera una lista de operaciones"}])
+    classes = [dict(c) for c in classes]
+    errors = []
+    for idx, op in enumerate(ops):
+        try:
+            _apply_class_op(classes, op)
+        except ValueError as e:
+            errors.append({"index": idx, "error": str(e)})
+    if errors:
+        raise ClassChangeError(errors)
+    return classes
+
+def class_sheet_rows(camp):
+    yield CLASS_SHEET_COLUMNS
+    for cls in camp.classes:
+        yield (cls.name, "" if cls.price is None else cls.price, cls.capacity or "", "no" if cls.closed else "si")
+
+def class_sheet_csv(camp):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(class_sheet_rows(camp))
+    return buffer.getvalue()
+
+def class_sheet_xlsx(camp):
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Clases")
+    for row in class_sheet_rows(camp):
+        ws.append(list(row))
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+def _read_class_sheet(filename, data):
+    ext = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+    if ext == "csv":
+        text = data.decode("utf-8-sig")
+        first_line = text.split("\n", 1)[0]
+        # Excel en castellano guarda los CSV separados por punto y coma.
+        delimiter = ";" if first_line.count(";") > first_line.count(",") else ","
+        return list(csv.reader(io.StringIO(text), delimiter=delimiter))
+    if ext == "xlsx":
+        from openpyxl import load_workbook
+        wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        try:
+            return [list(row) for row in wb.worksheets[0].iter_rows(values_only=True)]
+        finally:
+            wb.close()
+    raise ClassChangeError([{"row": None, "error": "formato no soportado, usar CSV o XLSX"}])
+
+def class_sheet_ops(filename, data, classes, remove_missing=False):
+    # Traduce la planilla a operaciones contra las clases actuales: update para
+    # las que existen (solo si algo cambio), add para las nuevas y, si se pide,
+    # delete para las que no aparecen. Devuelve (ops, filas de cada op).
+    try:
+        rows = _read_class_sheet(filename, data)
+    except ClassChangeError:
+        raise
+    except Exception as e:
+        # csv y openpyxl levantan tipos muy distintos ante un archivo roto.
+        raise ClassChangeError([{"row": None, "error": f"no se pudo leer el archivo: {e}"}]) from None
+    if not rows:
+        raise ClassChangeError([{"row": None, "error": "el archivo esta vacio"}])
+    header = [str(h or "").strip().lower() for h in rows[0]]
+    if "clase" not in header:
+        raise ClassChangeError([{"row": 1, "error": f"falta la columna clase (columnas: {', '.join(CLASS_SHEET_COLUMNS)})"}])
+    if len(rows) - 1 > CLASS_IMPORT_MAX_ROWS:
+        raise ClassChangeError([{"row": None, "error": f"maximo {CLASS_IMPORT_MAX_ROWS} filas por archivo"}])
+    columns = {name: header.index(name) for name in CLASS_SHEET_COLUMNS if name in header}
+    ops, op_rows, errors, seen = [], [], [], set()
+    for number, row in enumerate(rows[1:], 2):
+        values = {name: row[idx] if idx < len(row) else None for name, idx in columns.items()}
+        if all(v is None or str(v).strip() == "" for v in values.values()):
+            continue
+        try:
+            name = _class_name(values["clase"])
+            if name.lower() in seen:
+                raise ValueError(f"la clase {name} esta repetida")
+            seen.add(name.lower())
+            wanted = {}
+            if "precio" in values:
+                wanted["price"] = _class_int(values["precio"], "precio")
+            if "cupo" in values:
+                wanted["capacity"] = _class_int(values["cupo"], "cupo") or 0
+            if "abierta" in values and str(values["abierta"] or "").strip():
+                wanted["closed"] = not _class_bool(values["abierta"], "abierta")
+        except ValueError as e:
+            errors.append({"row": number, "error": str(e)})
+            continue
+        idx = _find_class(classes, name)
+        if idx is None:
+            ops.append(dict(wanted, op="add", name=name))
+            op_rows.append(number)
+            continue
+        current = dict(classes[idx], capacity=classes[idx].get("capacity") or 0,
+                       closed=bool(classes[idx].get("closed")))
+        changes = {k: v for k, v in wanted.items() if current.get(k) != v}
+        if current.get("name") != name:
+            changes["new_name"] = name
+        if changes:
+            ops.append(dict(changes, op="update", name=current["name"]))
+            op_rows.append(number)
+    if errors:
+        raise ClassChangeError(errors)
+    if remove_missing:
+        for cls in classes:
+            if cls.get("name", "").lower() not in seen:
+                ops.append({"op": "delete", "name": cls["name"]})
+                op_rows.append(None)
+    return ops, op_rows
+
+# ── Assets con hash de contenido ──────────────────────────────────────────────
+# Los logos subidos se guardan con el hash del contenido en el nombre y los
+# archivos de static/ (y logos viejos) se referencian con ?v=<hash>. Esas URLs
+# nunca cambian de contenido, asi que se sirven como immutable por un año.
+
+ASSET_MAX_AGE = 365 * 24 * 3600
+HASHED_LOGO_RE = re.compile(r".+_[0-9a-f]{16}(\.w\d+)?\.[a-z0-9]+$")
+_asset_hashes = {}
+
+def _asset_location(logical):
+    logical = logical.lstrip("/")
+    if logical.startswith("static/"):
+        return app.static_folder, logical[len("static/"):]
+    if logical.startswith("logos/"):
+        return LOGOS_DIR, logical[len("logos/"):]
+    return None, None
+
+def asset_hash(directory, filename):
+    path = os.path.join(directory, filename)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    cached = _asset_hashes.get(path)
+    if cached and cached[0] == (st.st_mtime_ns, st.st_size):
+        return cached[1]
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:16]
+    _asset_hashes[path] = ((st.st_mtime_ns, st.st_size), digest)
+    return digest
+
+@app.template_global()
+def asset_url(logical):
+    directory, filename = _asset_location(logical)
+    if directory is None:
+        return logical
+    url = "/" + urllib.parse.quote(logical.lstrip("/"))
+    if directory == LOGOS_DIR and HASHED_LOGO_RE.match(filename):
+        return url
+    digest = asset_hash(directory, filename)
+    return f"{url}?v={digest}" if digest else url
+
+# Bundle generado por build_assets.py: nombres con hash en static/dist, con
+# variantes .br/.gz que se eligen segun Accept-Encoding.
+DIST_MANIFEST_PATH = os.path.join(app.static_folder, "dist", "manifest.json")
+PRECOMPRESSED_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+_dist_manifest = {"stamp": None, "urls": None}
+
+@app.template_global()
+def asset_bundle():
+    try:
+        st = os.stat(DIST_MANIFEST_PATH)
+    except OSError:
+        return None
+    stamp = (st.st_mtime_ns, st.st_size)
+    if _dist_manifest["stamp"] != stamp:
+        with open(DIST_MANIFEST_PATH, encoding="utf-8") as f:
+            urls = {name: f"/static/{path}" for name, path in json.load(f).items()}
+        _dist_manifest.update(stamp=stamp, urls=urls)
+    return _dist_manifest["urls"]
+
+def asset_stamp():
+    # Cambia cuando build_assets.py escribe otro manifest o process-logos (o el
+    # pool de logos) agrega variantes: el mtime de un directorio se mueve al
+    # crear o reemplazar archivos adentro.
+    stamp = []
+    for path in (DIST_MANIFEST_PATH, os.path.join(app.static_folder, "images"), LOGOS_DIR):
+        try:
+            st = os.stat(path)
+        except OSError:
+            stamp.append(None)
+            continue
+        stamp.append((st.st_mtime_ns, st.st_size))
+    return tuple(stamp)
+
+def send_asset(directory, filename):
+    dist = directory == app.static_folder and filename.startswith("dist/") and filename != "dist/manifest.json"
+    immutable = dist or (HASHED_LOGO_RE.match(filename) if directory == LOGOS_DIR else False) \
+        or (request.args.get("v") and request.args.get("v") == asset_hash(directory, filename))
+    max_age = ASSET_MAX_AGE if immutable else None
+    encoding = None
+    if dist:
+        for name, suffix in PRECOMPRESSED_ENCODINGS:
+            if request.accept_encodings[name] and os.path.exists(os.path.join(directory, filename + suffix)):
+                encoding = name
+                break
+    if encoding:
+        response = send_from_directory(directory, filename + suffix, max_age=max_age,
+                                       mimetype=mimetypes.guess_type(filename)[0])
+        response.headers["Content-Encoding"] = encoding
+    else:
+        response = send_from_directory(directory, filename, max_age=max_age)
+    if dist:
+        response.vary.add("Accept-Encoding")
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
+
+# ── Procesamiento de logos ────────────────────────────────────────────────────
+# Al subir un logo se valida el tipo real con Pillow y se guarda el original
+# re-codificado sin metadatos (EXIF con GPS, comentarios); en un proceso
+# aparte se generan variantes WebP y PNG sin metadatos en LOGO_WIDTHS para
+# srcset (<nombre>.w<ancho>.<ext>). Mientras no existan, /logos/ responde la
+# variante con el original sin cache.
+
+LOGO_WIDTHS = (100, 200, 400)
+LOGO_FORMATS = {"PNG": "png", "JPEG": "jpg", "GIF": "gif", "WEBP": "webp"}
+LOGO_MAX_PIXELS = int(os.environ.get("LOGO_MAX_PIXELS", "40000000"))
+LOGO_VARIANT_RE = re.compile(r"(.+)\.w\d+\.(webp|png)$")
+
+class InvalidImage(ValueError):
+    pass
+
+def inspect_logo(data):
+    from PIL import Image
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            fmt = img.format
+            if img.width * img.height > LOGO_MAX_PIXELS:
+                raise InvalidImage("la imagen es demasiado grande")
+            img.verify()
+    except InvalidImage:
+        raise
+    except Exception as e:
+        raise InvalidImage("el archivo no es una imagen valida") from e
+    if fmt not in LOGO_FORMATS:
+        raise InvalidImage(f"formato {fmt} no permitido")
+    return LOGO_FORMATS[fmt]
+
+# Lo unico que se conserva del original al re-codificarlo: color y animacion.
+LOGO_KEEP_INFO = ("icc_profile", "transparency", "background", "duration", "loop", "disposal")
+
+def strip_logo(data):
+    # Devuelve la imagen en su mismo formato, ya rotada segun EXIF y sin el
+    # resto de los metadatos. Es lo que se sirve como src de respaldo.
+    from PIL import Image, ImageOps
+    with Image.open(io.BytesIO(data)) as img:
+        fmt = img.format
+        animated = getattr(img, "is_animated", False)
+        if not animated:
+            img = ImageOps.exif_transpose(img)
+        keep = {key: img.info[key] for key in LOGO_KEEP_INFO if key in img.info}
+        img.info = dict(keep)
+        options = {"quality": 95} if fmt in ("JPEG", "WEBP") else {}
+        out = io.BytesIO()
+        img.save(out, format=fmt, save_all=animated, **keep, **options)
+    return out.getvalue()
+
+def logo_variant_name(filename, width, ext):
+    return f"{filename.rsplit('.', 1)[0]}.w{width}.{ext}"
+
+def process_logo(path):
+    from PIL import Image, ImageOps
+    directory, filename = os.path.split(path)
+    with Image.open(path) as img:
+        img = ImageOps.exif_transpose(img).convert("RGBA")
+    img.info = {}
+    for width in LOGO_WIDTHS:
+        if img.width > width:
+            variant = img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS)
+        else:
+            variant = img
+        for ext, options in (("webp", {"quality": 85, "method": 6}), ("png", {"optimize": True})):
+            out_path = os.path.join(directory, logo_variant_name(filename, width, ext))
+            tmp_path = out_path + ".tmp"
+            variant.save(tmp_path, format=ext.upper(), **options)
+            os.replace(tmp_path, out_path)
+    return filename
+
+_logo_pool = None
+_logo_pool_lock = threading.Lock()
+
+def _get_logo_pool():
+    global _logo_pool
+    with _logo_pool_lock:
+        if _logo_pool is None:
+            # spawn y no fork: el worker ya tiene hilos (logs, webhooks,
+            # settings) y un hijo forkeado puede heredar un lock tomado.
+            _logo_pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+        return _logo_pool
+
+def _logo_done(future):
+    if future.exception():
+        app.logger.error("No se pudieron generar variantes del logo: %s", future.exception())
+
+# Los logos subidos tienen nombre por hash de contenido, asi que se pueden
+# copiar entre nodos sin invalidar nada. El original se guarda tambien en un
+# store compartido (Redis con SETTINGS_BACKEND=redis, si no LOGO_SHARED_DIR
+# si esta definido) y cada nodo lo baja a su LOGOS_DIR la primera vez que se
+# lo piden, generando ahi sus propias variantes. Sin ninguno de los dos los
+# logos quedan solo en el LOGOS_DIR de cada nodo.
+
+class LocalLogoStore:
+    # Un directorio compartido (NFS, volumen montado en todos los nodos).
+    def __init__(self, directory):
+        self.directory = directory
+
+    def put(self, name, data):
+        path = os.path.join(self.directory, name)
+        if os.path.exists(path):
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix="logo.", dir=self.directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, name):
+        try:
+            with open(os.path.join(self.directory, name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+class RedisLogoStore:
+    def __init__(self, store, prefix):
+        self.store = store
+        self.key = f"{prefix}logos"
+
+    def put(self, name, data):
+        self.store.redis().hset(self.key, name, data)
+
+    def get(self, name):
+        return self.store.redis().hget(self.key, name)
+
+def _make_logo_store():
+    if SETTINGS_BACKEND == "redis":
+        return RedisLogoStore(settings_store, REDIS_PREFIX)
+    if LOGO_SHARED_DIR:
+        return LocalLogoStore(LOGO_SHARED_DIR)
+    return None
+
+logo_store = _make_logo_store()
+
+def _write_logo(save_name, data):
+    os.makedirs(LOGOS_DIR, exist_ok=True)
+    path = os.path.join(LOGOS_DIR, save_name)
+    if not os.path.exists(path):
+        fd, tmp_path = tempfile.mkstemp(prefix="logo.", dir=LOGOS_DIR)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    _get_logo_pool().submit(process_logo, path).add_done_callback(_logo_done)
+
+def fetch_shared_logo(filename):
+    # Trae de logo_store el original de un logo (o de una variante) que falta
+    # en este nodo. Devuelve el nombre del original guardado o None.
+    if not HASHED_LOGO_RE.match(filename) or secure_filename(filename) != filename:
+        return None
+    match = LOGO_VARIANT_RE.match(filename)
+    names = [f"{match.group(1)}.{ext}" for ext in LOGO_FORMATS.values()] if match else [filename]
+    if logo_store is None:
+        return None
+    for name in names:
+        try:
+            data = logo_store.get(name)
+        except Exception as e:
+            app.logger.warning("No se pudo leer el logo %s del store compartido: %s", name, e)
+            return None
+        if data is not None:
+            _write_logo(name, data)
+            return name
+    return None
+
+def save_logo(file, prefix):
+    # Devuelve la ruta logica del original; lanza InvalidImage si no es una imagen permitida.
+    data = file.read()
+    ext = inspect_logo(data)
+    try:
+        data = strip_logo(data)
+    except Exception as e:
+        raise InvalidImage("el archivo no es una imagen valida") from e
+    save_name = f"{prefix}_{hashlib.sha256(data).hexdigest()[:16]}.{ext}"
+    # Primero al store compartido: los otros nodos pueden pedirlo apenas se guarden los settings.
+    if logo_store is not None:
+        logo_store.put(save_name, data)
+    _write_logo(save_name, data)
+    return f"logos/{save_name}"
+
+@app.template_global()
+def logo_srcset(logical, ext):
+    # Los logos con hash siempre listan sus variantes; los de static/ solo si
+    # ya fueron generadas con "flask process-logos".
+    directory, filename = _asset_location(logical)
+    if directory is None:
+        return ""
+    hashed = directory == LOGOS_DIR and HASHED_LOGO_RE.match(filename)
+    base = logical.lstrip("/").rsplit("/", 1)[0]
+    candidates = []
+    for width in LOGO_WIDTHS:
+        variant = logo_variant_name(filename, width, ext)
+        if hashed or os.path.exists(os.path.join(directory, variant)):
+            candidates.append(f"{asset_url(f'{base}/{variant}')} {width}w")
+    return ", ".join(candidates)
+
+def _variant_source(filename):
+    match = LOGO_VARIANT_RE.match(filename)
+    if not match:
+        return None
+    for ext in LOGO_FORMATS.values():
+        original = f"{match.group(1)}.{ext}"
+        if os.path.exists(os.path.join(LOGOS_DIR, original)):
+            return original
+    return None
+
+@app.cli.command("process-logos")
+def process_logos_command():
+    """Genera las variantes WebP/PNG de los logos subidos y de static/images."""
+    directories = (LOGOS_DIR, os.path.join(app.static_folder, "images"))
+    paths = [os.path.join(d, name) for d in directories if os.path.isdir(d)
+             for name in sorted(os.listdir(d))
+             if allowed_logo(name) and not LOGO_VARIANT_RE.match(name)]
+    for path in paths:
+        try:
+            process_logo(path)
+            click.echo(f"OK     {path}")
+        except Exception as e:
+            click.echo(f"ERROR  {path}: {e}")
+
 MERCADO_PAGO_ACCESS_TOKEN = os.environ.get("MERCADO_PAGO_ACCESS_TOKEN")
-sdk = mercadopago.SDK(MERCADO_PAGO_ACCESS_TOKEN)
-app.logger.info(f"DEBBUGING: {MERCADO_PAGO_ACCESS_TOKEN[:10]}")
+MP_DEFAULT_API_BASE_URL = "https://api.mercadopago.com"
+# Permite apuntar el SDK a un stub local (ver fake_mercadopago.py).
+MP_API_BASE_URL = os.environ.get("MP_API_BASE_URL", "").rstrip("/")
+MP_POOL_SIZE = int(os.environ.get("MP_POOL_SIZE", "10"))
+MP_CONNECT_TIMEOUT = float(os.environ.get("MP_CONNECT_TIMEOUT", "3.05"))
+MP_READ_TIMEOUT = float(os.environ.get("MP_READ_TIMEOUT", "10"))
+MP_GET_RETRIES = int(os.environ.get("MP_GET_RETRIES", "2"))
+MP_RETRY_BACKOFF = float(os.environ.get("MP_RETRY_BACKOFF", "0.2"))
+MP_BREAKER_THRESHOLD = int(os.environ.get("MP_BREAKER_THRESHOLD", "5"))
+MP_BREAKER_COOLDOWN = float(os.environ.get("MP_BREAKER_COOLDOWN", "30"))
+
+class MercadoPagoUnavailable(Exception):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            # Pasado el cooldown se deja pasar una llamada de prueba (half-open).
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+class PooledHttpClient:
+    # Reemplaza el HttpClient del SDK, que abre una sesion nueva por llamada y no
+    # tiene timeout de conexion: una sesion keep-alive por worker, timeouts
+    # (connect, read), reintentos con jitter solo en GET y circuit breaker.
+    # get_sdk() lo combina con mercadopago.http.HttpClient al construir el SDK.
+    def __init__(self, pool_size, connect_timeout, read_timeout, get_retries, backoff, breaker, base_url=""):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.get_retries = get_retries
+        self.backoff = backoff
+        self.breaker = breaker
+        self.base_url = base_url
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_session(self):
+        # La sesion se crea por proceso: no se comparten sockets entre workers forkeados.
+        import requests
+        import requests.adapters
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size,
+                                                            pool_maxsize=self.pool_size, max_retries=0)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+                    self._pid = os.getpid()
+        return self._session
+
+    @staticmethod
+    def _to_response(api_result):
+        response = {"status": api_result.status_code, "response": None}
+        if api_result.status_code != 204 and api_result.content:
+            try:
+                response["response"] = api_result.json()
+            except ValueError:
+                pass
+        return response
+
+    def request(self, method, url, maxretries=None, **kwargs):
+        if not metrics:
+            return self._request(method, url, **kwargs)
+        operation = _mp_operation(method, url)
+        outcome = "error"
+        metrics.mp_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            result = self._request(method, url, **kwargs)
+            status = result["status"]
+            outcome = "ok" if status < 400 else "rechazada" if status < 500 and status != 429 else "error"
+            return result
+        except MercadoPagoUnavailable as e:
+            outcome = "circuito_abierto" if str(e) == "circuito abierto" else "sin_conexion"
+            raise
+        finally:
+            metrics.mp_in_flight.dec()
+            metrics.mp_latency.labels(operation, outcome).observe(time.perf_counter() - started)
+
+    def _request(self, method, url, **kwargs):
+        import requests
+        kwargs.pop("retry_on", None)
+        kwargs.pop("backoff_factor", None)
+        kwargs["timeout"] = self.timeout
+        if self.base_url and url.startswith(MP_DEFAULT_API_BASE_URL):
+            url = self.base_url + url[len(MP_DEFAULT_API_BASE_URL):]
+        if not self.breaker.allow():
+            raise MercadoPagoUnavailable("circuito abierto")
+        attempts = 1 + (self.get_retries if method == "GET" else 0)
+        error = None
+        result = None
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+            try:
+                api_result = self._get_session().request(method, url, **kwargs)
+            except requests.RequestException as e:
+                error = e
+                continue
+            result = self._to_response(api_result)
+            if api_result.status_code < 500 and api_result.status_code != 429:
+                self.breaker.record_success()
+                return result
+        self.breaker.record_failure()
+        if result is not None:
+            return result
+        raise MercadoPagoUnavailable(str(error)) from error
+
+def _mp_operation(method, url):
+    path = urllib.parse.urlsplit(url).path
+    if path.startswith("/checkout/preferences"):
+        return "preference.create" if method == "POST" else "preference.get"
+    if path == "/v1/payments/search":
+        return "payment.search"
+    if path.startswith("/v1/payments/"):
+        return "payment.get"
+    return "otra"
+
+mp_breaker = CircuitBreaker(MP_BREAKER_THRESHOLD, MP_BREAKER_COOLDOWN)
+_sdk = None
+_sdk_lock = threading.Lock()
+
+def get_sdk():
+    # El SDK (y requests) se importan y construyen en la primera llamada a MP,
+    # no al importar la app.
+    global _sdk
+    if _sdk is None:
+        with _sdk_lock:
+            if _sdk is None:
+                if not MERCADO_PAGO_ACCESS_TOKEN:
+                    raise MercadoPagoUnavailable("MERCADO_PAGO_ACCESS_TOKEN no configurado")
+                import mercadopago
+                import mercadopago.http
+                from mercadopago.config import RequestOptions
+                client_class = type("PooledHttpClient", (PooledHttpClient, mercadopago.http.HttpClient), {})
+                http_client = client_class(MP_POOL_SIZE, MP_CONNECT_TIMEOUT, MP_READ_TIMEOUT, MP_GET_RETRIES,
+                                           MP_RETRY_BACKOFF, mp_breaker, base_url=MP_API_BASE_URL)
+                _sdk = mercadopago.SDK(MERCADO_PAGO_ACCESS_TOKEN, http_client=http_client,
+                                       request_options=RequestOptions(connection_timeout=MP_READ_TIMEOUT,
+                                                                      max_retries=0))
+    return _sdk
 
 def get_camp_or_none(settings, camp_id):
     return next((c for c in settings.get("campeonatos", []) if c["id"] == camp_id), None)
 
+PREFERENCE_CACHE_SIZE = int(os.environ.get("PREFERENCE_CACHE_SIZE", "512"))
+PREFERENCE_TTL_SECONDS = int(os.environ.get("PREFERENCE_TTL_SECONDS", "3600"))
+# Margen para no redirigir a una preferencia que vence mientras el usuario paga.
+PREFERENCE_TTL_MARGIN_SECONDS = 300
+
+class PreferenceCache:
+    # LRU acotado con TTL. La clave es el preference_data normalizado, asi que un
+    # cambio de precio o de medios de pago genera otra clave aun en otros workers;
+    # invalidate_camp() descarta ademas lo que quedo viejo en este proceso.
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(preference_data):
+        return json.dumps(preference_data, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry["expires_at"] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry["init_point"]
+
+    def put(self, key, camp_id, init_point):
+        ttl = max(0, self.ttl - PREFERENCE_TTL_MARGIN_SECONDS)
+        if not ttl or not self.maxsize:
+            return
+        with self._lock:
+            self._entries[key] = {"camp_id": camp_id, "init_point": init_point,
+                                  "expires_at": time.monotonic() + ttl}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate_camp(self, camp_id):
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e["camp_id"] == camp_id]:
+                del self._entries[key]
+
+preference_cache = PreferenceCache(PREFERENCE_CACHE_SIZE, PREFERENCE_TTL_SECONDS)
+
+def _pricing_signature(camp):
+    if not camp:
+        return None
+    return (camp.get("allow_cash_payments"), camp.get("discount_enabled"), camp.get("discount_percentage"),
+            camp.get("discount_description"), camp.get("camp_prefix"),
+            tuple((c.get("name"), c.get("price"), c.get("closed")) for c in camp.get("classes", [])))
+
+def _with_expiration(preference_data):
+    expires_to = datetime.now(timezone.utc) + timedelta(seconds=PREFERENCE_TTL_SECONDS)
+    return dict(preference_data, expires=True,
+                expiration_date_to=expires_to.isoformat(timespec="milliseconds"))
+
+# ── Cola de webhooks ──────────────────────────────────────────────────────────
+# El endpoint solo valida y persiste la notificacion; un pool en segundo plano
+# la procesa. La cola vive en SQLite para sobrevivir reinicios y ser compartida
+# por todos los workers de gunicorn.
+
+PAGOS_DB_PATH = os.environ.get("PAGOS_DB_PATH", os.path.join(SETTINGS_DIR, "pagos.db"))
+WEBHOOK_DEDUPE_WINDOW = float(os.environ.get("WEBHOOK_DEDUPE_WINDOW", "10"))
+WEBHOOK_CONCURRENCY = int(os.environ.get("WEBHOOK_CONCURRENCY", "4"))
+WEBHOOK_BATCH_SIZE = int(os.environ.get("WEBHOOK_BATCH_SIZE", "50"))
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get("WEBHOOK_MAX_ATTEMPTS", "5"))
+WEBHOOK_STALE_SECONDS = float(os.environ.get("WEBHOOK_STALE_SECONDS", "120"))
+WEBHOOK_RETRY_BACKOFF = float(os.environ.get("WEBHOOK_RETRY_BACKOFF", "5"))
+
+class LocalDB:
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema
+        self._local = threading.local()
+
+    def conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(self.schema)
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+PAGOS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS webhook_queue (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        topic TEXT NOT NULL,
+        resource_id TEXT NOT NULL,
+        received_at REAL NOT NULL,
+        state TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        claimed_at REAL,
+        processed_at REAL,
+        payment_status TEXT,
+        error TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_webhook_queue_state ON webhook_queue (state, id);
+    CREATE INDEX IF NOT EXISTS idx_webhook_queue_resource ON webhook_queue (topic, resource_id, received_at);
+
+    CREATE TABLE IF NOT EXISTS preferencias (
+        preference_id TEXT PRIMARY KEY,
+        external_reference TEXT NOT NULL,
+        camp_id TEXT NOT NULL,
+        clase TEXT NOT NULL,
+        discounted INTEGER NOT NULL DEFAULT 0,
+        unit_price REAL,
+        init_point TEXT,
+        created_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_preferencias_external_reference ON preferencias (external_reference);
+    CREATE INDEX IF NOT EXISTS idx_preferencias_camp ON preferencias (camp_id, clase);
+
+    CREATE TABLE IF NOT EXISTS preferencias_lineas (
+        line_reference TEXT PRIMARY KEY,
+        external_reference TEXT NOT NULL,
+        camp_id TEXT NOT NULL,
+        clase TEXT NOT NULL,
+        competidor TEXT,
+        quantity INTEGER NOT NULL DEFAULT 1,
+        discounted INTEGER NOT NULL DEFAULT 0,
+        unit_price REAL,
+        created_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_preferencias_lineas_external_reference ON preferencias_lineas (external_reference);
+
+    CREATE TABLE IF NOT EXISTS pagos (
+        payment_id TEXT PRIMARY KEY,
+        external_reference TEXT,
+        preference_id TEXT,
+        camp_id TEXT,
+        clase TEXT,
+        status TEXT NOT NULL,
+        status_detail TEXT,
+        amount REAL,
+        payment_type TEXT,
+        discounted INTEGER NOT NULL DEFAULT 0,
+        date_created TEXT,
+        date_last_updated TEXT,
+        updated_at REAL NOT NULL,
+        source TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_pagos_external_reference ON pagos (external_reference);
+    CREATE INDEX IF NOT EXISTS idx_pagos_camp ON pagos (camp_id, clase);
+    CREATE INDEX IF NOT EXISTS idx_pagos_status ON pagos (status);
+
+    CREATE TABLE IF NOT EXISTS pagos_eventos (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        payment_id TEXT NOT NULL,
+        status_from TEXT,
+        status_to TEXT NOT NULL,
+        source TEXT,
+        at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_pagos_eventos_payment ON pagos_eventos (payment_id);
+
+    CREATE TABLE IF NOT EXISTS pagos_lineas (
+        payment_id TEXT NOT NULL,
+        line_reference TEXT NOT NULL,
+        camp_id TEXT,
+        clase TEXT,
+        competidor TEXT,
+        quantity INTEGER NOT NULL DEFAULT 1,
+        status TEXT NOT NULL,
+        amount REAL,
+        discounted INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (payment_id, line_reference)
+    );
+    CREATE INDEX IF NOT EXISTS idx_pagos_lineas_camp ON pagos_lineas (camp_id, clase);
+
+    CREATE TABLE IF NOT EXISTS estadisticas (
+        camp_id TEXT NOT NULL,
+        clase TEXT NOT NULL,
+        approved INTEGER NOT NULL DEFAULT 0,
+        pending INTEGER NOT NULL DEFAULT 0,
+        rejected INTEGER NOT NULL DEFAULT 0,
+        gross_revenue REAL NOT NULL DEFAULT 0,
+        discounted_revenue REAL NOT NULL DEFAULT 0,
+        cash_count INTEGER NOT NULL DEFAULT 0,
+        card_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (camp_id, clase)
+    );
+
+    CREATE TABLE IF NOT EXISTS reservas (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        camp_id TEXT NOT NULL,
+        clase TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        expires_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_reservas_clase ON reservas (camp_id, clase, expires_at);
+    CREATE TABLE IF NOT EXISTS reservas_referencia (
+        reservation_id INTEGER PRIMARY KEY,
+        external_reference TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_reservas_referencia ON reservas_referencia (external_reference);
+
+    CREATE TABLE IF NOT EXISTS jobs (
+        name TEXT PRIMARY KEY,
+        cursor TEXT,
+        lease_owner TEXT,
+        lease_until REAL
+    );
+
+    CREATE TABLE IF NOT EXISTS perfiles_armados (
+        endpoint TEXT PRIMARY KEY,
+        mode TEXT NOT NULL,
+        remaining INTEGER NOT NULL,
+        expires_at REAL NOT NULL
+    );
+"""
+
+pagos_db = LocalDB(PAGOS_DB_PATH, PAGOS_SCHEMA)
+
+def enqueue_webhook(topic, resource_id):
+    # Se descarta si ya hay una notificacion pendiente para el mismo recurso (al
+    # procesarla se obtiene el estado mas reciente) o si llego otra hace menos de
+    # WEBHOOK_DEDUPE_WINDOW segundos.
+    now = time.time()
+    with pagos_db.transaction() as conn:
+        cur = conn.execute(
+            "INSERT INTO webhook_queue (topic, resource_id, received_at) SELECT ?, ?, ? "
+            "WHERE NOT EXISTS (SELECT 1 FROM webhook_queue WHERE topic = ? AND resource_id = ? "
+            "AND (state IN ('pending', 'processing') OR received_at > ?))",
+            (topic, resource_id, now, topic, resource_id, now - WEBHOOK_DEDUPE_WINDOW))
+        return cur.rowcount > 0
+
+def _claim_webhooks(limit):
+    # Un reintento vence WEBHOOK_RETRY_BACKOFF * 2^(intentos-1) segundos
+    # despues del ultimo intento; antes de eso no se vuelve a tomar.
+    now = time.time()
+    with pagos_db.transaction() as conn:
+        rows = conn.execute(
+            "SELECT id, topic, resource_id, attempts FROM webhook_queue "
+            "WHERE (state = 'pending' AND (attempts = 0 OR processed_at + ? * (1 << (attempts - 1)) <= ?)) "
+            "OR (state = 'processing' AND claimed_at < ?) ORDER BY id LIMIT ?",
+            (WEBHOOK_RETRY_BACKOFF, now, now - WEBHOOK_STALE_SECONDS, limit)).fetchall()
+        conn.executemany("UPDATE webhook_queue SET state = 'processing', claimed_at = ? WHERE id = ?",
+                         [(now, row["id"]) for row in rows])
+    return rows
+
+def _fetch_payment(resource_id):
+    return _payment_from_response(get_sdk().payment().get(resource_id))
+
+def _payment_from_response(payment_info):
+    if not payment_info or payment_info["status"] != 200:
+        raise RuntimeError(f"MP respondio {payment_info['status'] if payment_info else 'vacio'}")
+    return payment_info["response"]
+
+# ── Libro de pagos ────────────────────────────────────────────────────────────
+# Registro local de preferencias creadas y de cada transicion de estado de un
+# pago. Las repeticiones del mismo estado (reintentos de webhook) no escriben.
+
+# Un pago de equipo (varias inscripciones en una preferencia) lleva la
+# referencia "EQ<lote>_<camp_id>"; cada linea tiene la suya
+# ("EQ<lote>-<n>_<camp_id>", tambien como id del item en MP) y en pagos_lineas
+# queda su estado y su parte del monto para conciliarla por separado.
+TEAM_REFERENCE_PREFIX = "EQ"
+TEAM_CLASS = "Equipo"
+
+def _split_external_reference(external_reference):
+    label, _, camp_id = (external_reference or "").rpartition("_")
+    return camp_id, label
+
+def record_preference(pref, camp_id, clase, discounted, unit_price):
+    with pagos_db.transaction() as conn:
+        conn.execute(
+            "INSERT INTO preferencias (preference_id, external_reference, camp_id, clase, discounted, "
+            "unit_price, init_point, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (preference_id) DO NOTHING",
+            (pref.get("id"), pref.get("external_reference", ""), camp_id, clase, 1 if discounted else 0,
+             unit_price, pref.get("init_point"), time.time()))
+
+def record_team_preference(pref, camp_id, lines, total_price):
+    now = time.time()
+    external_reference = pref.get("external_reference", "")
+    with pagos_db.transaction() as conn:
+        conn.execute(
+            "INSERT INTO preferencias (preference_id, external_reference, camp_id, clase, discounted, "
+            "unit_price, init_point, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (preference_id) DO NOTHING",
+            (pref.get("id"), external_reference, camp_id, TEAM_CLASS,
+             1 if any(line["discounted"] for line in lines) else 0, total_price, pref.get("init_point"), now))
+        conn.executemany(
+            "INSERT INTO preferencias_lineas (line_reference, external_reference, camp_id, clase, competidor, "
+            "quantity, discounted, unit_price, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (line_reference) DO NOTHING",
+            [(line["line_reference"], external_reference, camp_id, line["clase"], line["competidor"],
+              line["quantity"], 1 if line["discounted"] else 0, line["unit_price"], now) for line in lines])
+
+def team_lines(external_reference):
+    return [dict(row) for row in pagos_db.conn().execute(
+        "SELECT * FROM preferencias_lineas WHERE external_reference = ? ORDER BY line_reference",
+        (external_reference,))]
+
+def _payment_lines(conn, row):
+    # Reparte un pago de equipo en sus lineas, con el monto en proporcion al
+    # precio de cada una. None si no es un pago de equipo.
+    external_reference = row["external_reference"] or ""
+    if not external_reference.startswith(TEAM_REFERENCE_PREFIX):
+        return None
+    lines = conn.execute(
+        "SELECT line_reference, camp_id, clase, competidor, quantity, discounted, unit_price "
+        "FROM preferencias_lineas WHERE external_reference = ? ORDER BY line_reference",
+        (external_reference,)).fetchall()
+    if not lines:
+        return None
+    totals = [(line["unit_price"] or 0) * line["quantity"] for line in lines]
+    expected = sum(totals)
+    amount = row["amount"]
+    return [dict(line, status=row["status"], payment_type=row["payment_type"],
+                 amount=round(amount * total / expected, 2) if amount is not None and expected else total)
+            for line, total in zip(lines, totals)]
+
+def record_payment(payment, source):
+    with pagos_db.transaction() as conn:
+        changed = _record_payment_tx(conn, payment, source)
+    if changed:
+        app.logger.info("Pago %s - estado: %s (%s)", payment["id"], payment.get("status"), source, extra={
+            "event": "payment", "payment_id": str(payment["id"]), "payment_status": payment.get("status"),
+            "source": source, "sample": True})
+    return changed
+
+def _record_payment_tx(conn, payment, source):
+    payment_id = str(payment["id"])
+    status = payment.get("status") or "unknown"
+    external_reference = payment.get("external_reference") or ""
+    now = time.time()
+    current = conn.execute("SELECT * FROM pagos WHERE payment_id = ?", (payment_id,)).fetchone()
+    if current is not None and current["status"] == status:
+        return False
+    pref = conn.execute(
+        "SELECT preference_id, camp_id, clase, discounted FROM preferencias WHERE external_reference = ? "
+        "ORDER BY created_at DESC LIMIT 1", (external_reference,)).fetchone()
+    if pref is not None:
+        camp_id, clase = pref["camp_id"], pref["clase"]
+    else:
+        camp_id, clase = _split_external_reference(external_reference)
+    conn.execute(
+        "INSERT INTO pagos (payment_id, external_reference, preference_id, camp_id, clase, status, "
+        "status_detail, amount, payment_type, discounted, date_created, date_last_updated, updated_at, source) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (payment_id) DO UPDATE SET status = excluded.status, status_detail = excluded.status_detail, "
+        "amount = COALESCE(excluded.amount, pagos.amount), payment_type = COALESCE(excluded.payment_type, pagos.payment_type), "
+        "date_created = COALESCE(pagos.date_created, excluded.date_created), "
+        "date_last_updated = excluded.date_last_updated, updated_at = excluded.updated_at, source = excluded.source",
+        (payment_id, external_reference, pref["preference_id"] if pref else payment.get("preference_id"),
+         camp_id, clase, status, payment.get("status_detail"), payment.get("transaction_amount"),
+         payment.get("payment_type_id"), pref["discounted"] if pref else 0, payment.get("date_created"),
+         payment.get("date_last_updated"), now, source))
+    conn.execute("INSERT INTO pagos_eventos (payment_id, status_from, status_to, source, at) VALUES (?, ?, ?, ?, ?)",
+                 (payment_id, current["status"] if current else None, status, source, now))
+    if current is not None:
+        _apply_stats(conn, current, -1)
+    row = conn.execute("SELECT * FROM pagos WHERE payment_id = ?", (payment_id,)).fetchone()
+    _apply_stats(conn, row, 1)
+    lines = _payment_lines(conn, row)
+    if _holds_slot(status) and not (current is not None and _holds_slot(current["status"])):
+        _consume_reservations(conn, row, lines)
+    if lines:
+        conn.executemany(
+            "INSERT INTO pagos_lineas (payment_id, line_reference, camp_id, clase, competidor, quantity, status, "
+            "amount, discounted) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (payment_id, line_reference) DO UPDATE SET status = excluded.status, amount = excluded.amount",
+            [(payment_id, line["line_reference"], line["camp_id"], line["clase"], line["competidor"],
+              line["quantity"], line["status"], line["amount"], line["discounted"]) for line in lines])
+    return True
+
+def _holds_slot(status):
+    return STATS_BUCKETS.get(status) in ("approved", "pending")
+
+def _consume_reservations(conn, row, lines):
+    # El pago pasa a ocupar cupo por si mismo: se borran tantas reservas de su
+    # preferencia como barcos paga, asi no cuenta dos veces hasta que vencen.
+    # Una preferencia cacheada la comparten varios checkouts, por eso se borra
+    # por cantidad (las mas viejas) y no por id de reserva.
+    wanted = {}
+    for line in lines or [dict(row, quantity=1)]:
+        wanted[line["clase"]] = wanted.get(line["clase"], 0) + line["quantity"]
+    ids = []
+    for clase, count in wanted.items():
+        ids.extend(r[0] for r in conn.execute(
+            "SELECT r.id FROM reservas r JOIN reservas_referencia l ON l.reservation_id = r.id "
+            "WHERE l.external_reference = ? AND r.clase = ? ORDER BY r.id LIMIT ?",
+            (row["external_reference"], clase, count)))
+    conn.executemany("DELETE FROM reservas WHERE id = ?", [(rid,) for rid in ids])
+    conn.executemany("DELETE FROM reservas_referencia WHERE reservation_id = ?", [(rid,) for rid in ids])
+
+def drop_unverified_payment(payment_id):
+    # Versiones anteriores registraban el estado de la URL de retorno (source
+    # back_url) antes de confirmarlo con MP. Si MP nunca lo confirma, se borra.
+    with pagos_db.transaction() as conn:
+        row = conn.execute("SELECT * FROM pagos WHERE payment_id = ? AND source = 'back_url'",
+                           (str(payment_id),)).fetchone()
+        if row is None:
+            return False
+        _apply_stats(conn, row, -1)
+        conn.execute("DELETE FROM pagos_lineas WHERE payment_id = ?", (row["payment_id"],))
+        conn.execute("DELETE FROM pagos WHERE payment_id = ?", (row["payment_id"],))
+    app.logger.warning("Pago %s sin confirmar en MP: eliminado del libro", payment_id,
+                       extra={"event": "payment_dropped", "payment_id": str(payment_id)})
+    return True
+
+def _ledger_query(camp_id, clase=None, status=None, desde=None, hasta=None, columns="*"):
+    query = f"SELECT {columns} FROM pagos WHERE camp_id = ?"
+    params = [camp_id]
+    if clase:
+        query += " AND (clase = ? OR payment_id IN (SELECT payment_id FROM pagos_lineas WHERE clase = ?))"
+        params.extend([clase, clase])
+    if status:
+        query += " AND status = ?"
+        params.append(status)
+    if desde:
+        query += " AND substr(date_created, 1, 10) >= ?"
+        params.append(desde)
+    if hasta:
+        query += " AND substr(date_created, 1, 10) <= ?"
+        params.append(hasta)
+    return query, params
+
+def ledger_payments(camp_id, clase=None, status=None):
+    query, params = _ledger_query(camp_id, clase, status)
+    conn = pagos_db.conn()
+    payments = [dict(row) for row in conn.execute(query + " ORDER BY updated_at DESC", params)]
+    for payment in payments:
+        if (payment["external_reference"] or "").startswith(TEAM_REFERENCE_PREFIX):
+            payment["lineas"] = [dict(row) for row in conn.execute(
+                "SELECT line_reference, clase, competidor, quantity, status, amount, discounted FROM pagos_lineas "
+                "WHERE payment_id = ? ORDER BY line_reference", (payment["payment_id"],))]
+    return payments
+
+# ── Exportacion de inscripciones ──────────────────────────────────────────────
+# CSV se genera fila a fila mientras se envia; XLSX se arma en un proceso aparte
+# con openpyxl en modo write-only y se descarga cuando el archivo esta listo.
+# En ambos casos la memoria no depende de la cantidad de pagos.
+
+EXPORT_COLUMNS = ("payment_id", "external_reference", "camp_id", "clase", "status", "status_detail", "amount",
+                  "payment_type", "discounted", "date_created", "date_last_updated", "source")
+EXPORTS_DIR = os.path.join(SETTINGS_DIR, "exports")
+EXPORT_MAX_AGE_SECONDS = 3600
+_export_pool = None
+_export_pool_lock = threading.Lock()
+
+def _iter_export_rows(db_path, query, params):
+    conn = sqlite3.connect(db_path, timeout=10)
+    try:
+        cursor = conn.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(500)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        conn.close()
+
+def _write_xlsx_export(db_path, query, params, out_path):
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Inscripciones")
+    ws.append(list(EXPORT_COLUMNS))
+    for row in _iter_export_rows(db_path, query, params):
+        ws.append(list(row))
+    tmp_path = out_path + ".tmp"
+    wb.save(tmp_path)
+    os.replace(tmp_path, out_path)
+
+def _get_export_pool():
+    global _export_pool
+    with _export_pool_lock:
+        if _export_pool is None:
+            # spawn por lo mismo que el pool de logos: no forkear un proceso con hilos.
+            _export_pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+        return _export_pool
+
+def _cleanup_exports():
+    limit = time.time() - EXPORT_MAX_AGE_SECONDS
+    for name in os.listdir(EXPORTS_DIR):
+        path = os.path.join(EXPORTS_DIR, name)
+        try:
+            if os.path.getmtime(path) < limit:
+                os.remove(path)
+        except OSError:
+            pass
+
+def stream_csv_export(query, params):
+    pagos_db.conn()  # crea el esquema si la base todavia no existe
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        for idx, row in enumerate(_iter_export_rows(PAGOS_DB_PATH, query, params), 1):
+            writer.writerow(row)
+            if idx % 200 == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    return generate()
+
+def _export_done(out_path):
+    # Si el proceso falla se deja <job>.xlsx.error con el motivo: la descarga
+    # lo muestra en vez de esperar para siempre un archivo que no va a existir.
+    def done(future):
+        error = future.exception()
+        if error is None:
+            return
+        global _export_pool
+        if isinstance(error, BrokenProcessPool):
+            with _export_pool_lock:
+                _export_pool = None
+        app.logger.error("Fallo la exportacion %s: %s", os.path.basename(out_path), error,
+                         extra={"event": "export_failed"})
+        with open(out_path + ".error", "w", encoding="utf-8") as f:
+            f.write(str(error) or type(error).__name__)
+    return done
+
+def start_xlsx_export(query, params):
+    os.makedirs(EXPORTS_DIR, exist_ok=True)
+    _cleanup_exports()
+    job_id = uuid.uuid4().hex
+    pagos_db.conn()
+    out_path = os.path.join(EXPORTS_DIR, f"{job_id}.xlsx")
+    _get_export_pool().submit(_write_xlsx_export, PAGOS_DB_PATH, query, params,
+                              out_path).add_done_callback(_export_done(out_path))
+    return job_id
+
+# ── Estadisticas de inscripciones ─────────────────────────────────────────────
+# Contadores materializados por (campeonato, clase). Se actualizan con la
+# diferencia entre el estado anterior y el nuevo de cada pago, dentro de la
+# misma transaccion del libro; rebuild-stats los regenera desde la tabla pagos.
+
+STATS_BUCKETS = {
+    "approved": "approved",
+    "pending": "pending", "in_process": "pending", "authorized": "pending", "in_mediation": "pending",
+    "rejected": "rejected", "cancelled": "rejected", "refunded": "rejected", "charged_back": "rejected",
+}
+STATS_COLUMNS = ("approved", "pending", "rejected", "gross_revenue", "discounted_revenue", "cash_count", "card_count")
+CASH_PAYMENT_TYPES = {"ticket", "atm"}
+
+def _stats_contribution(row, quantity=1):
+    bucket = STATS_BUCKETS.get(row["status"])
+    if bucket is None:
+        return None
+    contribution = {bucket: quantity}
+    if bucket == "approved":
+        amount = row["amount"] or 0
+        contribution["gross_revenue"] = amount
+        if row["discounted"]:
+            contribution["discounted_revenue"] = amount
+        payment_type = row["payment_type"] or ""
+        if payment_type in CASH_PAYMENT_TYPES:
+            contribution["cash_count"] = quantity
+        elif payment_type.endswith("_card"):
+            contribution["card_count"] = quantity
+    return contribution
+
+def _apply_stats(conn, row, sign):
+    # Un pago de equipo suma en la clase de cada linea, no en "Equipo".
+    for part in _payment_lines(conn, row) or [row]:
+        contribution = _stats_contribution(part, part["quantity"] if part is not row else 1)
+        if not contribution or not part["camp_id"]:
+            continue
+        values = [sign * contribution.get(col, 0) for col in STATS_COLUMNS]
+        conn.execute(
+            f"INSERT INTO estadisticas (camp_id, clase, {', '.join(STATS_COLUMNS)}) VALUES (?, ?, {', '.join('?' * len(STATS_COLUMNS))}) "
+            f"ON CONFLICT (camp_id, clase) DO UPDATE SET {', '.join(f'{c} = {c} + excluded.{c}' for c in STATS_COLUMNS)}",
+            [part["camp_id"], part["clase"] or ""] + values)
+
+def registration_stats(camp_id):
+    classes = [dict(row) for row in pagos_db.conn().execute(
+        "SELECT * FROM estadisticas WHERE camp_id = ? ORDER BY clase", (camp_id,))]
+    totals = {col: sum(row[col] for row in classes) for col in STATS_COLUMNS}
+    return {"camp_id": camp_id, "classes": classes, "totals": totals}
+
+def rebuild_stats():
+    with pagos_db.transaction() as conn:
+        conn.execute("DELETE FROM estadisticas")
+        rows = conn.execute("SELECT camp_id, clase, status, amount, payment_type, discounted, external_reference "
+                            "FROM pagos").fetchall()
+        for row in rows:
+            _apply_stats(conn, row, 1)
+    return len(rows)
+
+@app.cli.command("rebuild-stats")
+def rebuild_stats_command():
+    """Regenera los contadores de inscripciones desde el historial de pagos."""
+    click.echo(f"Estadisticas regeneradas a partir de {rebuild_stats()} pagos")
+
+# ── Control de admision ───────────────────────────────────────────────────────
+# Al abrir una clase concurrida todos los competidores llegan a la vez y cada
+# checkout retiene un worker durante la llamada a MP. Se limita la cantidad de
+# llamadas simultaneas por proceso y el ritmo por campeonato (token bucket); el
+# excedente recibe una sala de espera liviana con Retry-After en lugar de
+# quedar colgado. Los cupos por clase se reservan en pagos.db dentro de una
+# transaccion, asi que son consistentes entre procesos.
+
+ADMISSION_MAX_CONCURRENT = int(os.environ.get("ADMISSION_MAX_CONCURRENT", "0"))
+ADMISSION_RATE_PER_CAMP = float(os.environ.get("ADMISSION_RATE_PER_CAMP", "0"))
+ADMISSION_BURST = int(os.environ.get("ADMISSION_BURST", "20"))
+ADMISSION_MAX_RETRY_AFTER = int(os.environ.get("ADMISSION_MAX_RETRY_AFTER", "60"))
+RESERVATION_SECONDS = int(os.environ.get("RESERVATION_SECONDS", "1200"))
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.waiting = 0.0
+        self.updated = time.monotonic()
+
+    def take(self):
+        # Devuelve (admitido, posicion estimada). "waiting" cuenta los rechazos
+        # recientes y se descuenta al mismo ritmo con que se recargan fichas.
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.waiting = max(0.0, self.waiting - elapsed * self.rate)
+        if self.tokens >= 1 and self.waiting < 1:
+            self.tokens -= 1
+            return True, 0
+        self.waiting += 1
+        return False, int(self.waiting)
+
+class AdmissionController:
+    def __init__(self, max_concurrent, rate, burst):
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.in_flight = 0
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def _retry_after(self, position, rate):
+        seconds = position / rate if rate else 1
+        return max(1, min(ADMISSION_MAX_RETRY_AFTER, int(seconds + random.uniform(0, 1) + 0.5)))
+
+    def admit(self, camp_id):
+        # Devuelve (None, None) si se admite; si no, (posicion, retry_after).
+        # Quien es admitido debe llamar a release().
+        with self._lock:
+            if self.rate > 0:
+                bucket = self.buckets.get(camp_id)
+                if bucket is None:
+                    bucket = self.buckets[camp_id] = TokenBucket(self.rate, self.burst)
+                ok, position = bucket.take()
+                if not ok:
+                    return position, self._retry_after(position, self.rate)
+            if self.max_concurrent and self.in_flight >= self.max_concurrent:
+                position = self.in_flight - self.max_concurrent + 1
+                return position, self._retry_after(position, self.rate or self.max_concurrent)
+            self.in_flight += 1
+            return None, None
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+admission = AdmissionController(ADMISSION_MAX_CONCURRENT, ADMISSION_RATE_PER_CAMP, ADMISSION_BURST)
+
+def reserve_slots(camp_id, wanted, external_reference=None):
+    # wanted: {clase: (cantidad, cupo)}. Ocupan cupo los pagos aprobados o
+    # pendientes y las reservas vigentes (un checkout iniciado en los ultimos
+    # RESERVATION_SECONDS). Reserva todo o nada: devuelve (ids, None) o
+    # ((), clase) con la primera clase que no alcanza. Las reservas quedan
+    # asociadas al external_reference de la preferencia para liberarlas
+    # cuando el pago se registra (ver _consume_reservations).
+    now = time.time()
+    with pagos_db.transaction() as conn:
+        conn.execute("DELETE FROM reservas WHERE expires_at < ?", (now,))
+        conn.execute("DELETE FROM reservas_referencia WHERE reservation_id NOT IN (SELECT id FROM reservas)")
+        for clase, (count, capacity) in wanted.items():
+            reserved = conn.execute("SELECT COUNT(*) FROM reservas WHERE camp_id = ? AND clase = ?",
+                                    (camp_id, clase)).fetchone()[0]
+            row = conn.execute("SELECT approved + pending FROM estadisticas WHERE camp_id = ? AND clase = ?",
+                               (camp_id, clase)).fetchone()
+            if reserved + (row[0] if row else 0) + count > capacity:
+                return (), clase
+        ids = []
+        for clase, (count, capacity) in wanted.items():
+            for _ in range(count):
+                cur = conn.execute("INSERT INTO reservas (camp_id, clase, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                                   (camp_id, clase, now, now + RESERVATION_SECONDS))
+                ids.append(cur.lastrowid)
+        if external_reference:
+            conn.executemany("INSERT INTO reservas_referencia (reservation_id, external_reference) VALUES (?, ?)",
+                             [(rid, external_reference) for rid in ids])
+        return tuple(ids), None
+
+def release_slots(reservation_ids):
+    with pagos_db.transaction() as conn:
+        conn.executemany("DELETE FROM reservas WHERE id = ?", [(rid,) for rid in reservation_ids])
+        conn.executemany("DELETE FROM reservas_referencia WHERE reservation_id = ?", [(rid,) for rid in reservation_ids])
+
+def slots_taken(camp_id):
+    conn = pagos_db.conn()
+    taken = {row[0]: row[1] for row in conn.execute(
+        "SELECT clase, approved + pending FROM estadisticas WHERE camp_id = ?", (camp_id,))}
+    for clase, count in conn.execute(
+            "SELECT clase, COUNT(*) FROM reservas WHERE camp_id = ? AND expires_at >= ? GROUP BY clase",
+            (camp_id, time.time())):
+        taken[clase] = taken.get(clase, 0) + count
+    return taken
+
+def waiting_room(camp, position, retry_after, form, action='process_inscription'):
+    return render_template('sala_espera.html', page_title="Sala de espera", camp=camp, action=action,
+                           position=position, retry_after=retry_after, form=form), \
+        429, {"Retry-After": str(retry_after), "Cache-Control": "no-store"}
+
+# ── Conciliacion con Mercado Pago ─────────────────────────────────────────────
+# Recorre la busqueda de pagos de MP desde el ultimo cursor, compara en bloque
+# contra el libro local y aplica las correcciones en transacciones por lote.
+# El cursor (date_last_updated del ultimo pago aplicado) se guarda despues de
+# cada lote, asi que una corrida interrumpida retoma donde quedo.
+
+RECONCILE_PAGE_SIZE = int(os.environ.get("RECONCILE_PAGE_SIZE", "100"))
+RECONCILE_CONCURRENCY = int(os.environ.get("RECONCILE_CONCURRENCY", "8"))
+RECONCILE_BATCH_SIZE = int(os.environ.get("RECONCILE_BATCH_SIZE", "500"))
+RECONCILE_INTERVAL_SECONDS = int(os.environ.get("RECONCILE_INTERVAL_SECONDS", "0"))
+RECONCILE_DEFAULT_SINCE = "2020-01-01T00:00:00.000-03:00"
+
+def _job_cursor(name):
+    row = pagos_db.conn().execute("SELECT cursor FROM jobs WHERE name = ?", (name,)).fetchone()
+    return row["cursor"] if row and row["cursor"] else None
+
+def _try_acquire_lease(name, ttl):
+    # Evita que varios workers corran el mismo job programado a la vez.
+    now = time.time()
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    with pagos_db.transaction() as conn:
+        conn.execute("INSERT OR IGNORE INTO jobs (name) VALUES (?)", (name,))
+        cur = conn.execute("UPDATE jobs SET lease_owner = ?, lease_until = ? WHERE name = ? "
+                           "AND (lease_until IS NULL OR lease_until < ? OR lease_owner = ?)",
+                           (owner, now + ttl, name, now, owner))
+        return cur.rowcount > 0
+
+def _search_payments_page(filters, offset):
+    resp = get_sdk().payment().search(filters=dict(filters, offset=offset))
+    if resp["status"] != 200:
+        raise RuntimeError(f"Busqueda MP respondio {resp['status']}")
+    return resp["response"]
+
+def reconcile_payments(camp_id=None, since=None, page_size=None, concurrency=None):
+    job = f"reconcile:{camp_id or '*'}"
+    page_size = page_size or RECONCILE_PAGE_SIZE
+    since = since or _job_cursor(job) or RECONCILE_DEFAULT_SINCE
+    filters = {"sort": "date_last_updated", "criteria": "asc", "range": "date_last_updated",
+               "begin_date": since, "end_date": "NOW", "limit": page_size}
+    first = _search_payments_page(filters, 0)
+    total = first.get("paging", {}).get("total", 0)
+    pages = [first]
+    with ThreadPoolExecutor(max_workers=concurrency or RECONCILE_CONCURRENCY) as pool:
+        pages.extend(pool.map(lambda offset: _search_payments_page(filters, offset),
+                              range(page_size, total, page_size)))
+    suffix = f"_{camp_id}" if camp_id else None
+    remote = {}
+    for page in pages:
+        for payment in page.get("results", []):
+            if suffix and not (payment.get("external_reference") or "").endswith(suffix):
+                continue
+            remote[str(payment["id"])] = payment
+    ordered = sorted(remote.values(), key=lambda p: p.get("date_last_updated") or "")
+    conn = pagos_db.conn()
+    local = {}
+    ids = list(remote)
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        local.update((row["payment_id"], row["status"]) for row in conn.execute(
+            f"SELECT payment_id, status FROM pagos WHERE payment_id IN ({', '.join('?' * len(chunk))})", chunk))
+    report = {"since": since, "fetched": sum(len(p.get("results", [])) for p in pages), "matched": len(remote),
+              "missing": [], "changed": [], "unchanged": 0}
+    pending = [p for p in ordered if local.get(str(p["id"])) != p.get("status")]
+    report["unchanged"] = len(remote) - len(pending)
+    for p in pending:
+        pid = str(p["id"])
+        if pid in local:
+            report["changed"].append({"payment_id": pid, "local": local[pid], "remote": p.get("status")})
+        else:
+            report["missing"].append({"payment_id": pid, "remote": p.get("status")})
+    cursor = since
+    for i in range(0, len(ordered), RECONCILE_BATCH_SIZE):
+        batch = ordered[i:i + RECONCILE_BATCH_SIZE]
+        cursor = batch[-1].get("date_last_updated") or cursor
+        with pagos_db.transaction() as tx:
+            for payment in batch:
+                if local.get(str(payment["id"])) != payment.get("status"):
+                    _record_payment_tx(tx, payment, "reconcile")
+            tx.execute("INSERT INTO jobs (name, cursor) VALUES (?, ?) "
+                       "ON CONFLICT (name) DO UPDATE SET cursor = excluded.cursor", (job, cursor))
+    report["cursor"] = cursor
+    return report
+
+class ReconcileScheduler:
+    def __init__(self, interval):
+        self.interval = interval
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if not self.interval or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name="reconcile", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval * random.uniform(0.9, 1.1))
+            try:
+                if _try_acquire_lease("reconcile:*", self.interval):
+                    report = reconcile_payments()
+                    app.logger.info("Conciliacion: %s pagos, %s cambios, %s faltantes", report["matched"],
+                                    len(report["changed"]), len(report["missing"]), extra={"event": "reconcile"})
+            except Exception as e:
+                app.logger.error("Error en conciliacion: %s", e, exc_info=True)
+
+reconcile_scheduler = ReconcileScheduler(RECONCILE_INTERVAL_SECONDS)
+
+@app.cli.command("reconcile")
+@click.option("--camp", "camp_id", default=None, help="Solo pagos de este campeonato.")
+@click.option("--since", default=None, help="Fecha ISO desde donde buscar (por defecto, el ultimo cursor).")
+@click.option("--concurrency", type=int, default=None)
+def reconcile_command(camp_id, since, concurrency):
+    """Concilia el libro local contra la busqueda de pagos de Mercado Pago."""
+    started = time.perf_counter()
+    report = reconcile_payments(camp_id, since=since, concurrency=concurrency)
+    report["elapsed_seconds"] = round(time.perf_counter() - started, 3)
+    click.echo(json.dumps(report, ensure_ascii=False, indent=2))
+
+class WebhookWorker:
+    def __init__(self, concurrency, batch_size):
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                                    thread_name_prefix="webhook-fetch")
+                threading.Thread(target=self._run, name="webhook-worker", daemon=True).start()
+                # Lo que quedo encolado antes de reiniciar se procesa ya, sin esperar otro webhook.
+                self._wakeup.set()
+
+    def notify(self):
+        self.ensure_started()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(timeout=5)
+            self._wakeup.clear()
+            try:
+                while self.drain_once():
+                    pass
+            except Exception as e:
+                app.logger.error("Error procesando cola de webhooks: %s", e, exc_info=True)
+
+    def drain_once(self):
+        rows = _claim_webhooks(self.batch_size)
+        if not rows:
+            return 0
+        payment_ids = list(dict.fromkeys(row["resource_id"] for row in rows if row["topic"] == "payment"))
+        results = dict(zip(payment_ids, self._executor.map(self._safe_fetch, payment_ids)))
+        apply_webhook_results(rows, results)
+        return len(rows)
+
+    @staticmethod
+    def _safe_fetch(resource_id):
+        if metrics:
+            metrics.webhook_fetches_in_flight.inc()
+        try:
+            return _fetch_payment(resource_id), None
+        except Exception as e:
+            app.logger.error("Error webhook %s: %s", resource_id, e, extra={"payment_id": resource_id})
+            return None, str(e)
+        finally:
+            if metrics:
+                metrics.webhook_fetches_in_flight.dec()
+
+def apply_webhook_results(rows, results):
+    # results: {resource_id: (pago, error)} de los pagos consultados a MP. Se
+    # registra cada pago una vez aunque haya varias notificaciones del recurso.
+    now = time.time()
+    updates = []
+    by_resource = {}
+    for row in rows:
+        by_resource.setdefault((row["topic"], row["resource_id"]), []).append(row)
+    for (topic, resource_id), group in by_resource.items():
+        payment, error = results.get(resource_id, (None, None)) if topic == "payment" else (None, None)
+        if payment is not None:
+            record_payment(payment, "webhook")
+        for row in group:
+            if error is None:
+                updates.append(("done", row["attempts"] + 1, now, payment["status"] if payment else None, None, row["id"]))
+            else:
+                state = "failed" if row["attempts"] + 1 >= WEBHOOK_MAX_ATTEMPTS else "pending"
+                updates.append((state, row["attempts"] + 1, now, None, error, row["id"]))
+                if state == "failed" and topic == "payment":
+                    drop_unverified_payment(resource_id)
+    with pagos_db.transaction() as conn:
+        conn.executemany("UPDATE webhook_queue SET state = ?, attempts = ?, processed_at = ?, "
+                         "payment_status = ?, error = ? WHERE id = ?", updates)
+    if metrics:
+        topics = {row["id"]: row["topic"] for row in rows}
+        for state, *_, row_id in updates:
+            metrics.webhooks_processed.labels(_metric_topic(topics[row_id]), state).inc()
+
+webhook_worker = WebhookWorker(WEBHOOK_CONCURRENCY, WEBHOOK_BATCH_SIZE)
+
+def webhook_queue_stats():
+    now = time.time()
+    conn = pagos_db.conn()
+    counts = {row["state"]: row["n"] for row in conn.execute(
+        "SELECT state, COUNT(*) AS n FROM webhook_queue GROUP BY state")}
+    oldest = conn.execute("SELECT MIN(received_at) FROM webhook_queue WHERE state IN ('pending', 'processing')").fetchone()[0]
+    last = conn.execute("SELECT MAX(processed_at) FROM webhook_queue WHERE state = 'done'").fetchone()[0]
+    return {
+        "depth": counts.get("pending", 0) + counts.get("processing", 0),
+        "lag_seconds": round(now - oldest, 3) if oldest else 0.0,
+        "by_state": counts,
+        "last_processed_seconds_ago": round(now - last, 3) if last else None,
+    }
+
+# ── Compresion de HTML ────────────────────────────────────────────────────────
+# Las paginas del cache guardan su version gzip; el resto del HTML generado se
+# comprime al vuelo. Se puede apagar si ya lo hace el proxy.
+
+COMPRESS_HTML = os.environ.get("COMPRESS_HTML", "1") == "1"
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", "500"))
+
+@app.after_request
+def compress_html(response):
+    if (not COMPRESS_HTML or response.mimetype != "text/html" or response.status_code != 200
+            or response.direct_passthrough or response.is_streamed
+            or "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+    if not request.accept_encodings["gzip"]:
+        return response
+    data = response.get_data()
+    if len(data) >= COMPRESS_MIN_SIZE:
+        response.set_data(gzip.compress(data, 6))
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+# ── Perfilado a pedido ────────────────────────────────────────────────────────
+# Con PROFILING_ENABLED=1 un admin puede armar el perfilado de las proximas N
+# requests a un endpoint (el contador vive en pagos.db y lo comparten todos los
+# workers) o generar un token para el header X-Profile-Token. Cada request
+# perfilada deja en PROFILES_DIR un .pstats (cProfile) o un .folded (muestreo
+# de stacks, listo para flamegraph.pl o speedscope). Sin PROFILING_ENABLED los
+# hooks no se registran.
+
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "0") == "1"
+PROFILES_DIR = os.environ.get("PROFILES_DIR", os.path.join(DATA_DIR, "profiles"))
+PROFILE_HEADER = "X-Profile-Token"
+PROFILE_MODES = ("cprofile", "sampling")
+PROFILE_POLL_SECONDS = float(os.environ.get("PROFILE_POLL_SECONDS", "2"))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", "0.001"))
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", "200"))
+PROFILE_ARM_SECONDS = 3600
+
+class StackSampler:
+    # Muestrea el stack de un hilo cada "interval" segundos desde otro hilo.
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+
+class RequestProfiler:
+    def __init__(self):
+        self.armed = {}
+        self.next_poll = 0.0
+        self._lock = threading.Lock()
+
+    def _serializer(self):
+        from itsdangerous import URLSafeSerializer
+        return URLSafeSerializer(app.secret_key, salt="profile-token")
+
+    def make_token(self, mode, minutes):
+        return self._serializer().dumps({"mode": mode, "exp": time.time() + minutes * 60})
+
+    def _token_mode(self, token):
+        from itsdangerous import BadSignature
+        try:
+            data = self._serializer().loads(token)
+        except BadSignature:
+            return None
+        if data.get("exp", 0) < time.time() or data.get("mode") not in PROFILE_MODES:
+            return None
+        return data["mode"]
+
+    def arm(self, endpoint, mode, count):
+        with pagos_db.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO perfiles_armados (endpoint, mode, remaining, expires_at) "
+                         "VALUES (?, ?, ?, ?)", (endpoint, mode, count, time.time() + PROFILE_ARM_SECONDS))
+        self.next_poll = 0.0
+
+    def disarm(self, endpoint):
+        with pagos_db.transaction() as conn:
+            conn.execute("DELETE FROM perfiles_armados WHERE endpoint = ?", (endpoint,))
+        self.next_poll = 0.0
+
+    def arms(self):
+        conn = pagos_db.conn()
+        return [dict(row) for row in conn.execute(
+            "SELECT endpoint, mode, remaining, expires_at FROM perfiles_armados "
+            "WHERE remaining > 0 AND expires_at > ? ORDER BY endpoint", (time.time(),))]
+
+    def _claim(self, endpoint):
+        # Descuenta una request del contador compartido; None si otro worker ya lo agoto.
+        with pagos_db.transaction() as conn:
+            row = conn.execute("SELECT mode FROM perfiles_armados WHERE endpoint = ? AND remaining > 0 "
+                               "AND expires_at > ?", (endpoint, time.time())).fetchone()
+            if row is None:
+                self.armed.pop(endpoint, None)
+                return None
+            conn.execute("UPDATE perfiles_armados SET remaining = remaining - 1 WHERE endpoint = ?", (endpoint,))
+            return row["mode"]
+
+    def mode_for(self, endpoint, token):
+        if token:
+            return self._token_mode(token)
+        now = time.monotonic()
+        if now >= self.next_poll:
+            with self._lock:
+                if now >= self.next_poll:
+                    self.armed = {row["endpoint"]: row["mode"] for row in self.arms()}
+                    self.next_poll = now + PROFILE_POLL_SECONDS
+        if endpoint in self.armed:
+            return self._claim(endpoint)
+        return None
+
+    @staticmethod
+    def start(mode):
+        if mode == "sampling":
+            sampler = StackSampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL)
+            sampler.start()
+            return mode, sampler
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Ya hay otro profiler activo en este hilo.
+            return None
+        return mode, profile
+
+    @staticmethod
+    def finish(active, endpoint, elapsed):
+        mode, profiler = active
+        if mode == "sampling":
+            profiler.stop()
+        else:
+            profiler.disable()
+        os.makedirs(PROFILES_DIR, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        name = f"{stamp}-{endpoint}-{int(elapsed * 1000)}ms-{uuid.uuid4().hex[:6]}"
+        path = os.path.join(PROFILES_DIR, name + (".folded" if mode == "sampling" else ".pstats"))
+        if mode == "sampling":
+            profiler.dump(path)
+        else:
+            profiler.dump_stats(path)
+        for old in list_profiles()[PROFILE_MAX_FILES:]:
+            os.remove(os.path.join(PROFILES_DIR, old["name"]))
+        app.logger.info("Perfil guardado %s", os.path.basename(path),
+                        extra={"event": "profile", "path": request.path, "duration_ms": round(elapsed * 1000, 2)})
+
+profiler = RequestProfiler()
+
+def list_profiles():
+    if not os.path.isdir(PROFILES_DIR):
+        return []
+    entries = []
+    for name in os.listdir(PROFILES_DIR):
+        if name.endswith((".pstats", ".folded")):
+            st = os.stat(os.path.join(PROFILES_DIR, name))
+            entries.append({"name": name, "size": st.st_size, "mtime": datetime.fromtimestamp(st.st_mtime)})
+    return sorted(entries, key=lambda e: e["mtime"], reverse=True)
+
+def profile_summary(name, limit=40):
+    path = os.path.join(PROFILES_DIR, name)
+    if name.endswith(".folded"):
+        # Cuenta muestras por funcion "propia" (la hoja del stack).
+        totals = {}
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                leaf = stack.rsplit(";", 1)[-1]
+                totals[leaf] = totals.get(leaf, 0) + int(count)
+        total = sum(totals.values())
+        rows = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return "\n".join([f"{total} muestras cada {PROFILE_SAMPLE_INTERVAL * 1000:g} ms"] +
+                         [f"{c:>7} {c / total:>6.1%}  {leaf}" for leaf, c in rows])
+    import pstats
+    out = io.StringIO()
+    pstats.Stats(path, stream=out).sort_stats("cumulative").print_stats(limit)
+    return out.getvalue()
+
+if PROFILING_ENABLED:
+    @app.before_request
+    def profile_request_started():
+        mode = profiler.mode_for(request.endpoint, request.headers.get(PROFILE_HEADER))
+        if mode:
+            g.profile = profiler.start(mode)
+            g.profile_started = time.perf_counter()
+
+    @app.teardown_request
+    def profile_request_finished(exc):
+        active = g.pop("profile", None)
+        if active:
+            try:
+                profiler.finish(active, request.endpoint, time.perf_counter() - g.profile_started)
+            except OSError as e:
+                app.logger.error("No se pudo guardar el perfil: %s", e)
+
+# ── Cache de paginas publicas ─────────────────────────────────────────────────
+# Las paginas publicas dependen de la revision de settings, del campeonato y
+# de las URLs de assets que llevan adentro (bundle y variantes de logos), asi
+# que se guardan ya renderizadas junto con un ETag fuerte. Cuando cambia la
+# revision o asset_stamp() se descarta todo lo anterior de una vez.
+
+class PageCache:
+    def __init__(self):
+        self.revision = None
+        self.pages = {}
+        self._lock = threading.Lock()
+
+    def get_or_render(self, revision, key, render):
+        with self._lock:
+            if revision != self.revision:
+                self.revision = revision
+                self.pages = {}
+            entry = self.pages.get(key)
+        if entry is None:
+            body = render().encode("utf-8")
+            compressed = gzip.compress(body, 9) if COMPRESS_HTML and len(body) >= COMPRESS_MIN_SIZE else None
+            entry = (body, hashlib.sha1(body).hexdigest(), compressed)
+            with self._lock:
+                if revision == self.revision:
+                    self.pages[key] = entry
+        return entry
+
+page_cache = PageCache()
+
+def cached_page(key, template, **context):
+    settings = load_settings()
+    body, etag, compressed = page_cache.get_or_render((settings.revision, asset_stamp()), key,
+                                                      lambda: render_template(template, **context))
+    if compressed is not None and request.accept_encodings["gzip"]:
+        response = Response(compressed, mimetype="text/html")
+        response.headers["Content-Encoding"] = "gzip"
+        etag += "-gz"
+    else:
+        response = Response(body, mimetype="text/html")
+    response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+def closed_page(settings):
+    return cached_page(("cerrada",), 'cerrada.html', page_title="Inscripcion cerrada",
+                       cuba_logo=settings.cuba_logo)
+
 # ÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂ Rutas publicas ÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂ
 
 
 @app.route('/logos/<path:filename>')
 def serve_logo(filename):
-    return send_from_directory(LOGOS_DIR, filename)
+    if not os.path.exists(os.path.join(LOGOS_DIR, filename)):
+        original = _variant_source(filename) or fetch_shared_logo(filename)
+        if original and original != filename:
+            return send_from_directory(LOGOS_DIR, original, max_age=0)
+    return send_asset(LOGOS_DIR, filename)
+
+@app.endpoint('static')
+def serve_static(filename):
+    return send_asset(app.static_folder, filename)
 
 @app.route('/')
 def index():
     settings = load_settings()
-    if settings.get("site_closed"):
-        return render_template('cerrada.html', page_title="Inscripcion cerrada",
-                               cuba_logo=settings.get("cuba_logo", "static/images/Metropolitano.png"))
+    if settings.site_closed:
+        return closed_page(settings)
     return redirect(url_for('inscripciones'))
 
 @app.route('/inscripciones')
 def inscripciones():
     settings = load_settings()
-    if settings.get("site_closed"):
-        return render_template('cerrada.html', page_title="Inscripcion cerrada",
-                               cuba_logo=settings.get("cuba_logo", "static/images/Metropolitano.png"))
-    activos = [c for c in settings.get("campeonatos", []) if c.get("active", True)]
+    if settings.site_closed:
+        return closed_page(settings)
+    activos = settings.activos
     if not activos:
-        return render_template('cerrada.html', page_title="No hay campeonatos activos",
-                               cuba_logo=settings.get("cuba_logo", "static/images/Metropolitano.png"))
+        return cached_page(("sin_activos",), 'cerrada.html', page_title="No hay campeonatos activos",
+                           cuba_logo=settings.cuba_logo)
     if len(activos) == 1:
-        return redirect(url_for('inscripcion_campeonato', camp_id=activos[0]['id']))
-    return render_template('select_campeonato.html',
-                           cuba_logo=settings.get("cuba_logo", "static/images/Metropolitano.png"),
-                           campeonatos=activos)
+        return redirect(url_for('inscripcion_campeonato', camp_id=activos[0].id))
+    return cached_page(("inscripciones",), 'select_campeonato.html',
+                       cuba_logo=settings.cuba_logo,
+                       campeonatos=activos)
 
 @app.route('/inscripciones/<camp_id>')
 def inscripcion_campeonato(camp_id):
     settings = load_settings()
-    if settings.get("site_closed"):
-        return render_template('cerrada.html', page_title="Inscripcion cerrada",
-                               cuba_logo=settings.get("cuba_logo", "static/images/Metropolitano.png"))
-    camp = get_camp_or_none(settings, camp_id)
-    if not camp or not camp.get("active", True):
+    if settings.site_closed:
+        return closed_page(settings)
+    camp = settings.get_camp(camp_id)
+    if not camp or not camp.active:
         return redirect(url_for('inscripciones'))
-    classes = camp.get("classes", [])
-    sorted_classes = sorted(classes, key=lambda c: c.get("closed", False))
-    enabled_classes = [c["name"] for c in sorted_classes if not c.get("closed", False)]
-    return render_template('index.html',
-        page_title=f"{camp.get('title_main', 'Inscripciones')} {camp.get('title_strong', '')}",
-        logo_path=camp.get("logo", "static/images/Metropolitano.png"),
-        title_main=camp.get("title_main", "Inscripciones"),
-        title_strong=camp.get("title_strong", ""),
-        classes=sorted_classes,
-        enabled_classes=enabled_classes,
-        discount_enabled=camp.get("discount_enabled", False),
-        discount_description=camp.get("discount_description", ""),
+    return cached_page(("inscripcion_campeonato", camp_id), 'index.html',
+        page_title=f"{camp.title_main} {camp.title_strong}",
+        logo_path=camp.logo,
+        title_main=camp.title_main,
+        title_strong=camp.title_strong,
+        classes=camp.sorted_classes,
+        enabled_classes=list(camp.enabled_names),
+        discount_enabled=camp.discount_enabled,
+        discount_description=camp.discount_description,
         camp_id=camp_id,
-        campeonato_name=camp.get("name", ""),
+        campeonato_name=camp.name,
         multiple_campeonatos=True
     )
 
-@app.route('/process_inscription', methods=['POST'])
-def process_inscription():
-    camp_id = request.form.get('camp_id')
+TEAM_MAX_ENTRIES = int(os.environ.get("TEAM_MAX_ENTRIES", "40"))
+
+@app.route('/inscripciones/<camp_id>/equipo')
+def inscripcion_equipo(camp_id):
     settings = load_settings()
-    if settings.get("site_closed"):
-        return render_template('cerrada.html', page_title="Inscripcion cerrada",
-                               cuba_logo=settings.get("cuba_logo", "static/images/Metropolitano.png")), 403
-    camp = get_camp_or_none(settings, camp_id)
-    if not camp or not camp.get("active", True):
-        return "Campeonato no disponible.", 404
-    rol = request.form.get('rol')
-    clase_barco = request.form.get('clase_barco')
-    apply_discount = request.form.get('apply_discount') == 'on'
+    if settings.site_closed:
+        return closed_page(settings)
+    camp = settings.get_camp(camp_id)
+    if not camp or not camp.active:
+        return redirect(url_for('inscripciones'))
+    return cached_page(("inscripcion_equipo", camp_id), 'equipo.html',
+        page_title=f"{camp.title_main} {camp.title_strong} - Equipo",
+        logo_path=camp.logo,
+        title_main=camp.title_main,
+        title_strong=camp.title_strong,
+        classes=camp.sorted_classes,
+        discount_enabled=camp.discount_enabled,
+        discount_description=camp.discount_description,
+        prices={c.name: [c.regular_price, c.discounted_price] for c in camp.classes if not c.closed},
+        max_entries=TEAM_MAX_ENTRIES,
+        camp_id=camp_id,
+    )
+
+class PendingCheckout:
+    # Un checkout validado y admitido que espera la preferencia de MP. lines
+    # solo se usa en los de equipo.
+    __slots__ = ("preference_data", "cache_key", "camp_id", "clase", "regular_price", "total_price",
+                 "reservation_ids", "lines")
+
+    def __init__(self, preference_data, cache_key, camp_id, clase, regular_price, total_price,
+                 reservation_ids=(), lines=None):
+        self.preference_data = preference_data
+        self.cache_key = cache_key
+        self.camp_id = camp_id
+        self.clase = clase
+        self.regular_price = regular_price
+        self.total_price = total_price
+        self.reservation_ids = reservation_ids
+        self.lines = lines
+
+def _checkout_camp(form):
+    # Devuelve (camp, None) o (None, respuesta de error).
+    settings = load_settings()
+    if settings.site_closed:
+        return None, (render_template('cerrada.html', page_title="Inscripcion cerrada",
+                                      cuba_logo=settings.cuba_logo), 403)
+    camp = settings.get_camp(form.get('camp_id'))
+    if not camp or not camp.active:
+        return None, ("Campeonato no disponible.", 404)
+    return camp, None
+
+def _back_urls(query):
+    return {status: f"{URL_BASE}/payment_{status}?{query}" for status in ("success", "pending", "failure")}
+
+def _admit_checkout(camp, form, preference_data, slots, action, **fields):
+    # Reserva de cupos, cache de preferencias y admision, comunes al checkout
+    # individual y al de equipo.
+    reservation_ids = ()
+    if slots:
+        try:
+            reservation_ids, full = reserve_slots(camp.id, slots, preference_data["external_reference"])
+        except sqlite3.Error as e:
+            app.logger.error("No se pudo reservar cupo: %s", e, extra={"camp_id": camp.id, "clase": fields["clase"]})
+        else:
+            if full:
+                return render_template('payment_status.html', status="cupo completo",
+                    message=f"No quedan cupos disponibles en la clase {full}."), 409
+    cache_key = preference_cache.key(preference_data)
+    init_point = preference_cache.get(cache_key)
+    if init_point:
+        return redirect(init_point)
+    position, retry_after = admission.admit(camp.id)
+    if position is not None:
+        if reservation_ids:
+            release_slots(reservation_ids)
+        return waiting_room(camp, position, retry_after, form, action)
+    return PendingCheckout(preference_data, cache_key, camp.id, reservation_ids=reservation_ids, **fields)
+
+def begin_checkout(form):
+    # Todo lo previo a la llamada a MP. Devuelve una respuesta (redirect, error,
+    # sala de espera) o un PendingCheckout ya admitido: quien lo recibe debe
+    # crear la preferencia y llamar a finish_checkout(). asgi.py usa las dos
+    # mitades para esperar a MP sin ocupar un hilo.
+    camp, error = _checkout_camp(form)
+    if error:
+        return error
+    camp_id = camp.id
+    rol = form.get('rol')
+    clase_barco = form.get('clase_barco')
+    apply_discount = form.get('apply_discount') == 'on'
     if rol == 'entrenador':
-        google_forms_id = camp["google_forms"]["trainers_id"]
+        google_forms_id = camp.google_forms["trainers_id"]
         google_forms_url = f"https://docs.google.com/forms/d/e/{google_forms_id}/viewform?usp=pp_url"
-        app.logger.info(f"Entrenador -> {google_forms_url}")
+        app.logger.info("Entrenador -> %s", google_forms_url, extra={
+            "event": "trainer_redirect", "camp_id": camp_id, "sample": True})
         return redirect(google_forms_url)
-    elif rol == 'competidor':
-        clases_habilitadas = [c["name"] for c in camp.get("classes", []) if not c.get("closed", False)]
-        if clase_barco not in clases_habilitadas:
-            return "La inscripcion para esta clase esta cerrada.", 403
-        class_info = next((c for c in camp.get("classes", []) if c.get("name") == clase_barco), None)
-        if class_info is None:
+    if rol != 'competidor':
+        return "Error: Rol no valido.", 400
+    if clase_barco not in camp.enabled_classes:
+        return "La inscripcion para esta clase esta cerrada.", 403
+    class_info = camp.classes_by_name.get(clase_barco)
+    if class_info is None or class_info.regular_price is None:
+        return "Error: clase no valida.", 400
+    if apply_discount and class_info.discounted_price is not None:
+        total_price = class_info.discounted_price
+        item_title = class_info.discounted_title
+    else:
+        total_price = class_info.regular_price
+        item_title = class_info.item_title
+    excluded_payment_types = []
+    if not camp.allow_cash_payments:
+        excluded_payment_types.append({"id": "ticket"})
+    preference_data = {
+        "items": [{"title": item_title, "quantity": 1, "unit_price": float(total_price), "currency_id": "ARS"}],
+        "back_urls": _back_urls(urllib.parse.urlencode({"clase_barco": clase_barco, "camp_id": camp_id})),
+        "auto_return": "approved",
+        "external_reference": f"{class_info.label}_{camp_id}",
+        "payment_methods": {"excluded_payment_types": excluded_payment_types}
+    }
+    slots = {clase_barco: (1, class_info.capacity)} if class_info.capacity else None
+    return _admit_checkout(camp, form, preference_data, slots, 'process_inscription', clase=clase_barco,
+                           regular_price=class_info.regular_price, total_price=total_price)
+
+def _team_form_lines(form):
+    # Filas "clase-<n>", "competidor-<n>", "cantidad-<n>", "descuento-<n>" del
+    # formulario de equipo, en orden y sin las que no tienen clase.
+    rows = []
+    for key in form:
+        index = key[len("clase-"):]
+        if key.startswith("clase-") and index.isdigit() and form.get(key):
+            rows.append(int(index))
+    lines = []
+    for index in sorted(rows):
+        try:
+            quantity = int(form.get(f"cantidad-{index}") or 1)
+        except ValueError:
+            quantity = 0
+        lines.append({"clase": form.get(f"clase-{index}"),
+                      "competidor": (form.get(f"competidor-{index}") or "").strip()[:80],
+                      "quantity": quantity,
+                      "discounted": form.get(f"descuento-{index}") == 'on'})
+    return lines
+
+def begin_team_checkout(form):
+    # Como begin_checkout, pero con varias lineas (clase, competidor, cantidad)
+    # en una sola preferencia de MP con un item por linea.
+    camp, error = _checkout_camp(form)
+    if error:
+        return error
+    camp_id = camp.id
+    lines = _team_form_lines(form)
+    if not lines:
+        return "Agrega al menos una inscripcion.", 400
+    if any(line["quantity"] < 1 for line in lines) or sum(line["quantity"] for line in lines) > TEAM_MAX_ENTRIES:
+        return f"Se pueden inscribir hasta {TEAM_MAX_ENTRIES} barcos por pago.", 400
+    for line in lines:
+        if line["clase"] not in camp.enabled_classes:
+            return f"La inscripcion para la clase {line['clase']} esta cerrada.", 403
+        class_info = camp.classes_by_name.get(line["clase"])
+        if class_info is None or class_info.regular_price is None:
             return "Error: clase no valida.", 400
-        is_discounted = (camp.get("discount_enabled") and apply_discount and class_info.get("price") is not None)
-        camp_prefix = camp.get("camp_prefix", "").strip()
-        clase_label = f"{camp_prefix}_{clase_barco}" if camp_prefix else clase_barco
-        if is_discounted:
-            original_price = int(class_info["price"])
-            discount_pct = int(camp.get("discount_percentage", 0))
-            total_price = max(1, round(original_price * (1 - discount_pct / 100), 2))
-            item_title = f"Inscripcion Competidor - {clase_label} ({camp.get('discount_description', 'Descuento')})"
+        line["discounted"] = line["discounted"] and class_info.discounted_price is not None
+        line["unit_price"] = class_info.discounted_price if line["discounted"] else class_info.regular_price
+        line["regular_price"] = class_info.regular_price
+        line["title"] = class_info.discounted_title if line["discounted"] else class_info.item_title
+        line["capacity"] = class_info.capacity
+    # Lote al azar: dos clubes con el mismo carrito no pueden compartir
+    # external_reference (ni las lineas y pagos que cuelgan de ella).
+    batch = f"{TEAM_REFERENCE_PREFIX}{secrets.token_hex(5).upper()}"
+    items = []
+    for n, line in enumerate(lines, 1):
+        line["line_reference"] = f"{batch}-{n:02d}_{camp_id}"
+        title = f"{line['title']} - {line['competidor']}" if line["competidor"] else line["title"]
+        items.append({"id": line["line_reference"], "title": title, "quantity": line["quantity"],
+                      "unit_price": float(line["unit_price"]), "currency_id": "ARS"})
+    excluded_payment_types = []
+    if not camp.allow_cash_payments:
+        excluded_payment_types.append({"id": "ticket"})
+    preference_data = {
+        "items": items,
+        "back_urls": _back_urls(urllib.parse.urlencode({"equipo": batch, "camp_id": camp_id})),
+        "auto_return": "approved",
+        "external_reference": f"{batch}_{camp_id}",
+        "payment_methods": {"excluded_payment_types": excluded_payment_types}
+    }
+    slots = {}
+    for line in lines:
+        if line["capacity"]:
+            count, capacity = slots.get(line["clase"], (0, line["capacity"]))
+            slots[line["clase"]] = (count + line["quantity"], capacity)
+    return _admit_checkout(camp, form, preference_data, slots, 'process_team_inscription', clase=TEAM_CLASS,
+                           regular_price=sum(line["regular_price"] * line["quantity"] for line in lines),
+                           total_price=sum(line["unit_price"] * line["quantity"] for line in lines),
+                           lines=lines)
+
+def finish_checkout(pending, resp=None, error=None):
+    # resp es la respuesta de MP ({"status", "response"}) o error la excepcion
+    # de la llamada. Libera la admision tomada en begin_checkout().
+    camp_id, clase_barco = pending.camp_id, pending.clase
+    try:
+        if error is not None:
+            raise error
+        pref = resp["response"]
+        if resp["status"] == 201:
+            app.logger.info("Preferencia creada %s", pref.get("id"), extra={
+                "event": "preference", "camp_id": camp_id, "clase": clase_barco,
+                "preference_id": pref.get("id"), "sample": True})
+            preference_cache.put(pending.cache_key, camp_id, pref["init_point"])
+            try:
+                pref = dict(pref, external_reference=pending.preference_data["external_reference"])
+                if pending.lines:
+                    record_team_preference(pref, camp_id, pending.lines, pending.total_price)
+                else:
+                    record_preference(pref, camp_id, clase_barco, pending.total_price != pending.regular_price,
+                                      pending.total_price)
+            except sqlite3.Error as e:
+                app.logger.error("No se pudo registrar la preferencia: %s", e,
+                                 extra={"camp_id": camp_id, "clase": clase_barco})
+            return redirect(pref["init_point"])
         else:
-            total_price = max(1, int(class_info["price"]))
-            item_title = f"Inscripcion Competidor - {clase_label}"
-        encoded_clase_barco = urllib.parse.quote_plus(clase_barco)
-        encoded_camp_id = urllib.parse.quote_plus(camp_id)
-        excluded_payment_types = []
-        if not camp.get("allow_cash_payments", True):
-            excluded_payment_types.append({"id": "ticket"})
-        preference_data = {
-            "items": [{"title": item_title, "quantity": 1, "unit_price": float(total_price), "currency_id": "ARS"}],
-            "back_urls": {
-                "success": f"{URL_BASE}/payment_success?clase_barco={encoded_clase_barco}&camp_id={encoded_camp_id}",
-                "pending": f"{URL_BASE}/payment_pending?clase_barco={encoded_clase_barco}&camp_id={encoded_camp_id}",
-                "failure": f"{URL_BASE}/payment_failure?clase_barco={encoded_clase_barco}&camp_id={encoded_camp_id}",
-            },
-            "auto_return": "approved",
-            "external_reference": f"{clase_label}_{camp_id}",
-            "payment_methods": {"excluded_payment_types": excluded_payment_types}
-        }
-        try:
-            resp = sdk.preference().create(preference_data)
-            pref = resp["response"]
-            if resp["status"] == 201:
-                app.logger.info(f"Preferencia creada -> {pref['init_point']}")
-                return redirect(pref["init_point"])
-            else:
-                app.logger.error(f"Error MP: {resp['status']}")
-                return "Hubo un error al procesar el pago. Intenta de nuevo."
-        except Exception as e:
-            app.logger.error(f"Excepcion MP: {e}")
-            return "Error inesperado al procesar tu solicitud."
-    return "Error: Rol no valido.", 400
+            app.logger.error("Error MP: %s", resp["status"], extra={"camp_id": camp_id, "clase": clase_barco})
+            if pending.reservation_ids:
+                release_slots(pending.reservation_ids)
+            return "Hubo un error al procesar el pago. Intenta de nuevo."
+    except MercadoPagoUnavailable as e:
+        app.logger.error("MP no disponible: %s", e, extra={"camp_id": camp_id, "clase": clase_barco})
+        if pending.reservation_ids:
+            release_slots(pending.reservation_ids)
+        return render_template('payment_status.html', status="no disponible",
+            message="Mercado Pago no responde en este momento. Intenta de nuevo en unos minutos."), \
+            503, {"Retry-After": str(int(MP_BREAKER_COOLDOWN))}
+    except Exception as e:
+        app.logger.error("Excepcion MP: %s", e, exc_info=True, extra={"camp_id": camp_id, "clase": clase_barco})
+        if pending.reservation_ids:
+            release_slots(pending.reservation_ids)
+        return "Error inesperado al procesar tu solicitud."
+    finally:
+        admission.release()
+
+def run_checkout(pending):
+    if not isinstance(pending, PendingCheckout):
+        return pending
+    try:
+        resp = get_sdk().preference().create(_with_expiration(pending.preference_data))
+    except Exception as e:
+        return finish_checkout(pending, error=e)
+    return finish_checkout(pending, resp)
+
+@app.route('/process_inscription', methods=['POST'])
+def process_inscription():
+    return run_checkout(begin_checkout(request.form))
+
+@app.route('/process_team_inscription', methods=['POST'])
+def process_team_inscription():
+    return run_checkout(begin_team_checkout(request.form))
 
 @app.route('/payment_success')
 def payment_success():
     payment_id = request.args.get('payment_id')
     clase_barco = request.args.get('clase_barco')
     camp_id = request.args.get('camp_id')
+    if payment_id and payment_id.isdigit():
+        # Cualquiera puede armar esta URL: no se registra nada de lo que trae,
+        # solo se encola la consulta a MP y el libro se escribe con su respuesta.
+        try:
+            if enqueue_webhook("payment", payment_id):
+                webhook_worker.notify()
+        except sqlite3.Error as e:
+            app.logger.error("No se pudo encolar el pago %s: %s", payment_id, e, extra={"payment_id": payment_id})
     settings = load_settings()
-    camp = get_camp_or_none(settings, camp_id) if camp_id else None
+    camp = settings.get_camp(camp_id) if camp_id else None
+    equipo = request.args.get('equipo')
+    if equipo:
+        # Un formulario por barco, ya completado con la operacion y la clase.
+        lines = team_lines(f"{equipo}_{camp_id}")
+        for line in lines:
+            line["google_forms_url"] = competitor_form_url(camp, payment_id, line["clase"])
+        return render_template('success_equipo.html', payment_id=payment_id, lines=lines,
+                               google_forms_url=competitor_form_url(camp, payment_id, None))
+    return render_template('success.html',
+        message="Tu pago fue procesado con exito! Por favor, completa el formulario.",
+        payment_id=payment_id,
+        google_forms_url=competitor_form_url(camp, payment_id, clase_barco))
+
+def competitor_form_url(camp, payment_id, clase_barco):
     if camp:
-        gf = camp.get("google_forms", {})
+        gf = camp.google_forms
         google_forms_id = gf.get("competitors_id", "")
         entry_id_num_op = gf.get("entry_id_num_operacion", "entry.1161481877")
         entry_id_clase = gf.get("entry_id_clase_barco", "entry.1553765108")
@@ -309,10 +3257,7 @@ def payment_success():
     google_forms_url = f"https://docs.google.com/forms/d/e/{google_forms_id}/viewform?usp=pp_url&{entry_id_num_op}={payment_id}"
     if clase_barco:
         google_forms_url += f"&{entry_id_clase}={urllib.parse.quote_plus(clase_barco)}"
-    return render_template('success.html',
-        message="Tu pago fue procesado con exito! Por favor, completa el formulario.",
-        payment_id=payment_id,
-        google_forms_url=google_forms_url)
+    return google_forms_url
 
 @app.route('/payment_pending')
 def payment_pending():
@@ -326,29 +3271,53 @@ def payment_failure():
 
 @app.route('/mercadopago-webhook', methods=['POST'])
 def mercadopago_webhook():
-    data = request.json
-    topic = data.get('topic')
-    resource_id = data.get('id')
-    app.logger.info(f"Webhook: topic={topic}, id={resource_id}")
+    data = request.get_json(silent=True) or {}
+    topic = data.get('topic') or data.get('type') or request.args.get('topic') or request.args.get('type')
+    resource_id = data.get('id') if data.get('topic') else (data.get('data') or {}).get('id')
+    resource_id = resource_id or request.args.get('id') or request.args.get('data.id')
+    if not topic or not resource_id or not str(resource_id).isdigit():
+        if metrics:
+            metrics.webhooks_received.labels(_metric_topic(topic), "invalida").inc()
+        return jsonify({"status": "invalid"}), 400
+    app.logger.info("Webhook: topic=%s, id=%s", topic, resource_id, extra={
+        "event": "webhook", "topic": topic, "payment_id": str(resource_id), "sample": True})
+    result = "ignorada"
     if topic == 'payment':
-        try:
-            payment_info = sdk.payment().get(resource_id)
-            if payment_info and payment_info["status"] == 200:
-                payment = payment_info["response"]
-                app.logger.info(f"Pago {payment['id']} - estado: {payment['status']}")
-        except Exception as e:
-            app.logger.error(f"Error webhook: {e}")
+        result = "duplicada"
+        if enqueue_webhook(topic, str(resource_id)):
+            result = "encolada"
+            webhook_worker.notify()
+    if metrics:
+        metrics.webhooks_received.labels(_metric_topic(topic), result).inc()
     return jsonify({"status": "ok"}), 200
 
+@app.before_request
+def start_background_jobs():
+    if _boot_timing["first_request"] is None:
+        _boot_timing["first_request"] = time.perf_counter() - _import_started
+        app.logger.info("Primer request del proceso %s a %.0f ms del inicio del import", os.getpid(),
+                        _boot_timing["first_request"] * 1000, extra={
+                            "event": "first_request", "duration_ms": round(_boot_timing["first_request"] * 1000)})
+    reconcile_scheduler.ensure_started()
+    webhook_worker.ensure_started()
+
+@app.before_request
+def admin_settings_guard():
+    # Las escrituras del admin parten de los settings reales: si no se pueden
+    # leer, load_settings() corta con 503 antes de tocar el store.
+    if request.path.startswith('/admin') and request.method not in ('GET', 'HEAD'):
+        load_settings()
+
 @app.before_request
 def site_closed_gate():
     try:
         if request.path.startswith('/admin') or request.path.startswith('/static') or request.path == '/':
             return
+        if request.path in ('/mercadopago-webhook', '/metrics'):
+            return
         settings = load_settings()
-        if settings.get('site_closed'):
-            return render_template('cerrada.html', page_title="Inscripcion cerrada",
-                               cuba_logo=settings.get("cuba_logo", "static/images/Metropolitano.png"))
+        if settings.site_closed:
+            return closed_page(settings)
     except Exception:
         pass
 
@@ -381,42 +3350,160 @@ def admin_site_state():
     if not session.get('is_admin'):
         return redirect(url_for('admin_home'))
     action = request.form.get('action')
-    settings = load_settings()
-    settings['site_closed'] = (action == 'close')
-    flash('Inscripciones cerradas' if settings['site_closed'] else 'Inscripciones abiertas',
-          'warning' if settings['site_closed'] else 'success')
-    save_settings(settings)
+    site_closed = (action == 'close')
+    settings_store.set_site(site_closed=site_closed)
+    flash('Inscripciones cerradas' if site_closed else 'Inscripciones abiertas',
+          'warning' if site_closed else 'success')
     return redirect(url_for('admin_home'))
 
 @app.route('/admin/cuba_logo', methods=['POST'])
 def admin_save_cuba_logo():
     if not session.get('is_admin'):
         return redirect(url_for('admin_home'))
-    settings = load_settings()
     if 'cuba_logo' in request.files:
         file = request.files['cuba_logo']
         if file and file.filename and allowed_logo(file.filename):
-            filename = secure_filename(file.filename)
-            save_name = f"cuba_logo_{filename}"
-            file.save(os.path.join(LOGOS_DIR, save_name))
-            settings['cuba_logo'] = f"logos/{save_name}"
-            save_settings(settings)
-            flash('Logo del club actualizado', 'success')
+            try:
+                settings_store.set_site(cuba_logo=save_logo(file, "cuba_logo"))
+                flash('Logo del club actualizado', 'success')
+            except InvalidImage as e:
+                flash(f'Imagen rechazada: {e}', 'warning')
         else:
             flash('Formato de imagen no permitido', 'warning')
     return redirect(url_for('admin_home'))
 
+@app.route('/admin/campeonato/<camp_id>/pagos', methods=['GET'])
+def admin_campeonato_pagos(camp_id):
+    if not session.get('is_admin'):
+        return jsonify({"error": "unauthorized"}), 401
+    return jsonify(ledger_payments(camp_id, request.args.get('clase'), request.args.get('status')))
+
+EXPORT_FILTERS = ("format", "clase", "status", "desde", "hasta")
+
+def _export_filters():
+    # Solo los filtros conocidos: camp_id o job_id en la query chocarian con los de la ruta.
+    return {name: request.args[name] for name in EXPORT_FILTERS if request.args.get(name)}
+
+@app.route('/admin/campeonato/<camp_id>/export', methods=['GET'])
+def admin_export_campeonato(camp_id):
+    if not session.get('is_admin'):
+        return redirect(url_for('admin_home'))
+    fmt = request.args.get('format', 'csv').lower()
+    query, params = _ledger_query(camp_id, request.args.get('clase'), request.args.get('status'),
+                                  request.args.get('desde'), request.args.get('hasta'),
+                                  columns=", ".join(EXPORT_COLUMNS))
+    query += " ORDER BY clase, date_created"
+    if fmt == 'xlsx':
+        job_id = start_xlsx_export(query, params)
+        return redirect(url_for('admin_export_download', camp_id=camp_id, job_id=job_id, **_export_filters()))
+    if fmt != 'csv':
+        return "Formato no soportado.", 400
+    return Response(stream_csv_export(query, params), mimetype='text/csv',
+                    headers={"Content-Disposition": f"attachment; filename=inscripciones_{camp_id}.csv"})
+
+@app.route('/admin/campeonato/<camp_id>/export/<job_id>', methods=['GET'])
+def admin_export_download(camp_id, job_id):
+    if not session.get('is_admin'):
+        return redirect(url_for('admin_home'))
+    if not re.fullmatch(r"[0-9a-f]{32}", job_id):
+        return "Exportacion no encontrada.", 404
+    path = os.path.join(EXPORTS_DIR, f"{job_id}.xlsx")
+    if os.path.exists(path + ".error"):
+        return render_template('payment_status.html', status="error",
+                               message="No se pudo generar el archivo.",
+                               retry_url=url_for('admin_export_campeonato', camp_id=camp_id, **_export_filters())), 500
+    if not os.path.exists(path):
+        return render_template('payment_status.html', status="en preparacion",
+                               message="El archivo se esta generando. Esta pagina se actualiza sola."), \
+            202, {"Retry-After": "2", "Refresh": "2"}
+    return send_file(path, as_attachment=True, download_name=f"inscripciones_{camp_id}.xlsx")
+
+@app.route('/admin/campeonato/<camp_id>/stats', methods=['GET'])
+def admin_campeonato_stats(camp_id):
+    if not session.get('is_admin'):
+        return jsonify({"error": "unauthorized"}), 401
+    return jsonify(registration_stats(camp_id))
+
+@app.route('/admin/webhooks/stats', methods=['GET'])
+def admin_webhook_stats():
+    if not session.get('is_admin'):
+        return jsonify({"error": "unauthorized"}), 401
+    return jsonify(webhook_queue_stats())
+
 # ÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂ Admin - Campeonatos CRUD ÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂÃÂÃÂ¢ÃÂÃÂÃÂÃÂ
 
+@app.route('/admin/perfiles', methods=['GET'])
+def admin_profiles():
+    if not session.get('is_admin'):
+        return redirect(url_for('admin_home'))
+    endpoints = sorted(e for e in app.view_functions if e != 'static')
+    return render_template('admin_perfiles.html', enabled=PROFILING_ENABLED, arms=profiler.arms(),
+                           profiles=list_profiles(), endpoints=endpoints, modes=PROFILE_MODES,
+                           header=PROFILE_HEADER, token=session.pop('profile_token', None))
+
+@app.route('/admin/perfiles/armar', methods=['POST'])
+def admin_arm_profile():
+    if not session.get('is_admin'):
+        return redirect(url_for('admin_home'))
+    endpoint = request.form.get('endpoint', '')
+    mode = request.form.get('mode', 'cprofile')
+    try:
+        count = max(1, min(100, int(request.form.get('count', 1))))
+    except ValueError:
+        count = 1
+    if endpoint not in app.view_functions or mode not in PROFILE_MODES:
+        flash('Endpoint o modo invalido', 'danger')
+    else:
+        profiler.arm(endpoint, mode, count)
+        flash(f'Perfilado armado: proximas {count} requests a {endpoint}', 'success')
+    return redirect(url_for('admin_profiles'))
+
+@app.route('/admin/perfiles/desarmar', methods=['POST'])
+def admin_disarm_profile():
+    if not session.get('is_admin'):
+        return redirect(url_for('admin_home'))
+    profiler.disarm(request.form.get('endpoint', ''))
+    return redirect(url_for('admin_profiles'))
+
+@app.route('/admin/perfiles/token', methods=['POST'])
+def admin_profile_token():
+    if not session.get('is_admin'):
+        return redirect(url_for('admin_home'))
+    mode = request.form.get('mode', 'cprofile')
+    try:
+        minutes = max(1, min(60, int(request.form.get('minutes', 10))))
+    except ValueError:
+        minutes = 10
+    if mode in PROFILE_MODES:
+        session['profile_token'] = {"value": profiler.make_token(mode, minutes), "mode": mode, "minutes": minutes}
+    return redirect(url_for('admin_profiles'))
+
+@app.route('/admin/perfiles/borrar', methods=['POST'])
+def admin_delete_profiles():
+    if not session.get('is_admin'):
+        return redirect(url_for('admin_home'))
+    for entry in list_profiles():
+        os.remove(os.path.join(PROFILES_DIR, entry["name"]))
+    flash('Perfiles eliminados', 'success')
+    return redirect(url_for('admin_profiles'))
+
+@app.route('/admin/perfiles/<path:name>', methods=['GET'])
+def admin_download_profile(name):
+    if not session.get('is_admin'):
+        return redirect(url_for('admin_home'))
+    if name != secure_filename(name) or not os.path.exists(os.path.join(PROFILES_DIR, name)):
+        return "Perfil no encontrado.", 404
+    if request.args.get('resumen'):
+        return Response(profile_summary(name), mimetype="text/plain")
+    return send_from_directory(PROFILES_DIR, name, as_attachment=True)
+
 @app.route('/admin/campeonato/new', methods=['POST'])
 def admin_new_campeonato():
     if not session.get('is_admin'):
         return redirect(url_for('admin_home'))
-    settings = load_settings()
     name = request.form.get('name', 'Nuevo Campeonato').strip() or 'Nuevo Campeonato'
     camp = make_default_campeonato(name)
-    settings.setdefault("campeonatos", []).append(camp)
-    save_settings(settings)
+    settings_store.add_campeonato(camp)
     flash('Campeonato creado', 'success')
     return redirect(url_for('admin_edit_campeonato', camp_id=camp['id']))
 
@@ -425,108 +3512,275 @@ def admin_edit_campeonato(camp_id):
     if not session.get('is_admin'):
         return redirect(url_for('admin_home'))
     settings = load_settings()
-    camp = get_camp_or_none(settings, camp_id)
+    camp = settings.get_camp(camp_id)
     if not camp:
         flash('Campeonato no encontrado', 'danger')
         return redirect(url_for('admin_home'))
-    return render_template('admin_campeonato.html', camp=camp, settings=settings)
+    try:
+        stats = registration_stats(camp_id)
+    except sqlite3.Error:
+        stats = None
+    try:
+        taken = slots_taken(camp_id)
+    except sqlite3.Error:
+        taken = {}
+    return render_template('admin_campeonato.html', camp=camp, settings=settings, stats=stats, taken=taken)
 
 @app.route('/admin/campeonato/<camp_id>/save', methods=['POST'])
 def admin_save_campeonato(camp_id):
+    # Todo el formulario se aplica sobre el campeonato leido dentro de la
+    # misma escritura del store: dos admins guardando a la vez no se pisan.
     if not session.get('is_admin'):
         return redirect(url_for('admin_home'))
-    settings = load_settings()
-    camp = get_camp_or_none(settings, camp_id)
-    if not camp:
-        flash('Campeonato no encontrado', 'danger')
-        return redirect(url_for('admin_home'))
     delete_idx = request.form.get('delete')
     if delete_idx is not None:
         try:
             di = int(delete_idx)
-            classes = camp.get('classes', [])
-            if 0 <= di < len(classes):
-                classes.pop(di)
-                camp['classes'] = classes
-                save_settings(settings)
-                flash('Clase eliminada', 'success')
-        except Exception:
+        except ValueError:
             flash('No se pudo eliminar la clase', 'danger')
+            return redirect(url_for('admin_edit_campeonato', camp_id=camp_id))
+        def delete_class(camp):
+            if 0 <= di < len(camp['classes']):
+                camp['classes'].pop(di)
+        result = _update_campeonato(camp_id, delete_class)
+        if result is None:
+            flash('Campeonato no encontrado', 'danger')
+            return redirect(url_for('admin_home'))
+        if len(result[1]['classes']) < len(result[0]['classes']):
+            flash('Clase eliminada', 'success')
         return redirect(url_for('admin_edit_campeonato', camp_id=camp_id))
-    camp['name'] = request.form.get('name', camp['name']).strip()
-    camp['title_main'] = request.form.get('title_main', camp.get('title_main', 'Inscripciones')).strip()
-    camp['title_strong'] = request.form.get('title_strong', camp.get('title_strong', '')).strip()
-    camp['allow_cash_payments'] = request.form.get('allow_cash_payments') == 'on'
-    camp['discount_enabled'] = request.form.get('discount_enabled') == 'on'
-    camp['discount_description'] = request.form.get('discount_description', '').strip()
     try:
-        camp['discount_percentage'] = int(request.form.get('discount_percentage', 0))
+        discount_percentage = int(request.form.get('discount_percentage', 0))
     except ValueError:
         flash('Porcentaje de descuento invalido', 'danger')
         return redirect(url_for('admin_edit_campeonato', camp_id=camp_id))
+    logo = None
+    if 'logo' in request.files:
+        file = request.files['logo']
+        if file and file.filename and allowed_logo(file.filename):
+            try:
+                logo = save_logo(file, f"camp_{secure_filename(camp_id)}")
+            except InvalidImage as e:
+                flash(f'Imagen rechazada: {e}', 'warning')
+        elif file and file.filename:
+            flash('Formato de imagen no permitido', 'warning')
+    def apply(camp):
+        _apply_camp_form(camp, request.form, discount_percentage)
+        if logo:
+            camp['logo'] = logo
+    if _update_campeonato(camp_id, apply) is None:
+        flash('Campeonato no encontrado', 'danger')
+        return redirect(url_for('admin_home'))
+    flash('Cambios guardados', 'success')
+    return redirect(url_for('admin_edit_campeonato', camp_id=camp_id))
+
+def _apply_camp_form(camp, form, discount_percentage):
+    camp['name'] = form.get('name', camp['name']).strip()
+    camp['title_main'] = form.get('title_main', camp.get('title_main', 'Inscripciones')).strip()
+    camp['title_strong'] = form.get('title_strong', camp.get('title_strong', '')).strip()
+    camp['allow_cash_payments'] = form.get('allow_cash_payments') == 'on'
+    camp['discount_enabled'] = form.get('discount_enabled') == 'on'
+    camp['discount_description'] = form.get('discount_description', '').strip()
+    camp['discount_percentage'] = discount_percentage
     gf = camp.setdefault('google_forms', {})
-    gf['competitors_id'] = extract_form_id(request.form.get('google_forms_competitors_id', gf.get('competitors_id', '')).strip())
-    gf['trainers_id'] = extract_form_id(request.form.get('google_forms_trainers_id', gf.get('trainers_id', '')).strip())
-    gf['entry_id_num_operacion'] = request.form.get('entry_id_num_operacion', gf.get('entry_id_num_operacion', 'entry.1161481877')).strip()
-    gf['entry_id_clase_barco'] = request.form.get('entry_id_clase_barco', gf.get('entry_id_clase_barco', 'entry.1553765108')).strip()
-    camp['camp_prefix'] = request.form.get('camp_prefix', camp.get('camp_prefix', ''))[:10].strip()
+    gf['competitors_id'] = extract_form_id(form.get('google_forms_competitors_id', gf.get('competitors_id', '')).strip())
+    gf['trainers_id'] = extract_form_id(form.get('google_forms_trainers_id', gf.get('trainers_id', '')).strip())
+    gf['entry_id_num_operacion'] = form.get('entry_id_num_operacion', gf.get('entry_id_num_operacion', 'entry.1161481877')).strip()
+    gf['entry_id_clase_barco'] = form.get('entry_id_clase_barco', gf.get('entry_id_clase_barco', 'entry.1553765108')).strip()
+    camp['camp_prefix'] = form.get('camp_prefix', camp.get('camp_prefix', ''))[:10].strip()
     updated_classes = []
     for idx, cls in enumerate(camp.get('classes', [])):
-        open_checked = request.form.get(f'open-{idx}') == 'on'
-        name_cls = request.form.get(f'name-{idx}', cls.get('name', '')).strip()
-        price_val = request.form.get(f'price-{idx}')
+        open_checked = form.get(f'open-{idx}') == 'on'
+        name_cls = form.get(f'name-{idx}', cls.get('name', '')).strip()
+        price_val = form.get(f'price-{idx}')
         try:
             price = int(price_val) if price_val else cls.get('price')
         except Exception:
             price = cls.get('price')
+        capacity_val = form.get(f'capacity-{idx}', str(cls.get('capacity') or ''))
+        try:
+            capacity = max(0, int(capacity_val)) if capacity_val else 0
+        except Exception:
+            capacity = cls.get('capacity', 0)
         if name_cls:
-            updated_classes.append({"name": name_cls, "closed": not open_checked, "price": price, "discount_price": None})
-    new_class = request.form.get('new_class', '').strip()
+            updated_classes.append({"name": name_cls, "closed": not open_checked, "price": price,
+                                    "discount_price": None, "capacity": capacity})
+    new_class = form.get('new_class', '').strip()
     if new_class:
         names_lower = {c['name'].lower() for c in updated_classes}
         if new_class.lower() not in names_lower:
-            new_price_val = request.form.get('new_class_price')
+            new_price_val = form.get('new_class_price')
             try:
                 new_price = int(new_price_val) if new_price_val else None
             except Exception:
                 new_price = None
-            updated_classes.append({"name": new_class, "closed": False, "price": new_price, "discount_price": None})
+            updated_classes.append({"name": new_class, "closed": False, "price": new_price,
+                                    "discount_price": None, "capacity": 0})
     camp['classes'] = updated_classes
-    if 'logo' in request.files:
-        file = request.files['logo']
-        if file and file.filename and allowed_logo(file.filename):
-            filename = secure_filename(file.filename)
-            save_name = f"camp_{camp_id}_{filename}"
-            file.save(os.path.join(LOGOS_DIR, save_name))
-            camp['logo'] = f"logos/{save_name}"
-        elif file and file.filename:
-            flash('Formato de imagen no permitido', 'warning')
-    save_settings(settings)
-    flash('Cambios guardados', 'success')
+
+def _update_campeonato(camp_id, fn):
+    result = settings_store.update_campeonato(camp_id, fn)
+    if result is not None and _pricing_signature(result[0]) != _pricing_signature(result[1]):
+        preference_cache.invalidate_camp(camp_id)
+    return result
+
+def _update_classes(camp_id, ops):
+    result = settings_store.update_classes(camp_id, ops)
+    if result is not None and _pricing_signature(result[0]) != _pricing_signature(result[1]):
+        preference_cache.invalidate_camp(camp_id)
+    return result
+
+@app.route('/admin/campeonato/<camp_id>/clases', methods=['GET', 'PATCH'])
+def admin_campeonato_clases(camp_id):
+    # PATCH recibe {"ops": [...]} (o la lista sola) y la aplica entera o nada:
+    #   {"op": "add", "name": "ILCA 6", "price": 30000, "capacity": 20, "closed": false}
+    #   {"op": "update", "name": "ILCA 6", "new_name": "ILCA 6 Sub 19", "price": 32000, "closed": true}
+    #   {"op": "delete", "name": "ILCA 6"}
+    if not session.get('is_admin'):
+        return jsonify({"error": "unauthorized"}), 401
+    if request.method == 'PATCH':
+        body = request.get_json(silent=True)
+        ops = body.get("ops") if isinstance(body, dict) else body
+        try:
+            result = _update_classes(camp_id, ops)
+        except ClassChangeError as e:
+            return jsonify({"error": "invalid", "errors": e.errors}), 400
+        if result is None:
+            return jsonify({"error": "not found"}), 404
+        app.logger.info("Clases actualizadas en bloque", extra={
+            "event": "classes_patch", "camp_id": camp_id, "ops": len(ops)})
+        return jsonify({"classes": result[1]["classes"]})
+    camp = settings_store.get_campeonato(camp_id)
+    if camp is None:
+        return jsonify({"error": "not found"}), 404
+    return jsonify({"classes": camp["classes"]})
+
+@app.route('/admin/campeonato/<camp_id>/clases/export', methods=['GET'])
+def admin_export_clases(camp_id):
+    if not session.get('is_admin'):
+        return redirect(url_for('admin_home'))
+    camp = load_settings().get_camp(camp_id)
+    if camp is None:
+        return "Campeonato no encontrado.", 404
+    fmt = request.args.get('format', 'csv').lower()
+    if fmt == 'xlsx':
+        return send_file(class_sheet_xlsx(camp), as_attachment=True, download_name=f"clases_{camp_id}.xlsx",
+                         mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    if fmt != 'csv':
+        return "Formato no soportado.", 400
+    return Response(class_sheet_csv(camp), mimetype='text/csv',
+                    headers={"Content-Disposition": f"attachment; filename=clases_{camp_id}.csv"})
+
+@app.route('/admin/campeonato/<camp_id>/clases/import', methods=['POST'])
+def admin_import_clases(camp_id):
+    if not session.get('is_admin'):
+        return redirect(url_for('admin_home'))
+    file = request.files.get('archivo')
+    if not file or not file.filename:
+        flash('Elegir un archivo CSV o XLSX', 'warning')
+        return redirect(url_for('admin_edit_campeonato', camp_id=camp_id))
+    data = file.read(CLASS_IMPORT_MAX_BYTES + 1)
+    if len(data) > CLASS_IMPORT_MAX_BYTES:
+        flash('El archivo es demasiado grande', 'danger')
+        return redirect(url_for('admin_edit_campeonato', camp_id=camp_id))
+    camp = settings_store.get_campeonato(camp_id)
+    if not camp:
+        flash('Campeonato no encontrado', 'danger')
+        return redirect(url_for('admin_home'))
+    try:
+        ops, op_rows = class_sheet_ops(file.filename, data, camp.get('classes', []),
+                                       remove_missing=request.form.get('remove_missing') == 'on')
+        if ops:
+            try:
+                _update_classes(camp_id, ops)
+            except ClassChangeError as e:
+                raise ClassChangeError([{"row": op_rows[err["index"]], "error": err["error"]}
+                                        if err.get("index") is not None else err for err in e.errors]) from None
+    except ClassChangeError as e:
+        for err in e.errors[:10]:
+            prefix = f"Fila {err['row']}: " if err.get("row") else ""
+            flash(f"{prefix}{err['error']}", 'danger')
+        if len(e.errors) > 10:
+            flash(f"... y {len(e.errors) - 10} errores mas", 'danger')
+        flash('No se importo ningun cambio', 'warning')
+        return redirect(url_for('admin_edit_campeonato', camp_id=camp_id))
+    if ops:
+        counts = {kind: sum(1 for op in ops if op["op"] == kind) for kind in CLASS_OPS}
+        flash(f"Clases importadas: {counts['add']} nuevas, {counts['update']} modificadas, "
+              f"{counts['delete']} eliminadas", 'success')
+    else:
+        flash('El archivo no tiene cambios', 'info')
     return redirect(url_for('admin_edit_campeonato', camp_id=camp_id))
 
 @app.route('/admin/campeonato/<camp_id>/toggle', methods=['POST'])
 def admin_toggle_campeonato(camp_id):
     if not session.get('is_admin'):
         return redirect(url_for('admin_home'))
-    settings = load_settings()
-    camp = get_camp_or_none(settings, camp_id)
-    if camp:
-        camp['active'] = not camp.get('active', True)
-        save_settings(settings)
-        estado = 'activado' if camp['active'] else 'desactivado'
-        flash(f"Campeonato {estado}", 'success' if camp['active'] else 'warning')
+    active = settings_store.toggle_campeonato(camp_id)
+    if active is not None:
+        estado = 'activado' if active else 'desactivado'
+        flash(f"Campeonato {estado}", 'success' if active else 'warning')
     return redirect(url_for('admin_home'))
 
 @app.route('/admin/campeonato/<camp_id>/delete', methods=['POST'])
 def admin_delete_campeonato(camp_id):
     if not session.get('is_admin'):
         return redirect(url_for('admin_home'))
-    settings = load_settings()
-    settings['campeonatos'] = [c for c in settings.get('campeonatos', []) if c['id'] != camp_id]
-    save_settings(settings)
+    settings_store.delete_campeonato(camp_id)
+    preference_cache.invalidate_camp(camp_id)
     flash('Campeonato eliminado', 'success')
     return redirect(url_for('admin_home'))
 
+# ── Arranque ──────────────────────────────────────────────────────────────────
+# El import no toca el disco ni construye el SDK; "flask init-data" prepara
+# DATA_DIR y deja compilados los templates en el cache de bytecode de Jinja.
+
+@app.cli.command("init-data")
+def init_data_command():
+    """Crea DATA_DIR, logos/, settings.json, pagos.db y el cache de templates."""
+    try:
+        for path in (DATA_DIR, os.path.join(DATA_DIR, "logos"), JINJA_CACHE_DIR):
+            os.makedirs(path, exist_ok=True)
+    except OSError as e:
+        raise click.ClickException(f"No se pudo crear {DATA_DIR}: {e}")
+    _bootstrap_settings_file(os.path.join(DATA_DIR, "settings.json"))
+    LocalDB(os.path.join(DATA_DIR, "pagos.db"), PAGOS_SCHEMA).conn()
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+    templates = [name for name in app.jinja_env.list_templates() if name.endswith(".html")]
+    for name in templates:
+        app.jinja_env.get_template(name)
+    click.echo(f"DATA_DIR listo en {DATA_DIR} ({len(templates)} templates precompilados)")
+
+@app.cli.command("boot-report")
+@click.option("--runs", default=5, show_default=True, help="imports en frio a medir")
+@click.option("--top", default=10, show_default=True, help="modulos mas lentos a listar")
+def boot_report_command(runs, top):
+    """Mide el tiempo de import de la app en procesos nuevos."""
+    code = "import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)"
+    wall, stderr = [], ""
+    for _ in range(runs):
+        started = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=BASE_DIR,
+                              capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise click.ClickException(proc.stderr.strip().splitlines()[-1])
+        wall.append((time.perf_counter() - started, float(proc.stdout.strip().splitlines()[-1])))
+        stderr = proc.stderr
+    click.echo(f"proceso completo: mediana {statistics.median(w for w, _ in wall) * 1000:.0f} ms")
+    click.echo(f"import app:       mediana {statistics.median(i for _, i in wall) * 1000:.0f} ms")
+    rows = []
+    for line in stderr.splitlines():
+        parts = line.split("|")
+        if line.startswith("import time:") and len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]), parts[2].rstrip()))
+    click.echo("modulos con mayor tiempo acumulado (us):")
+    for cumulative, name in sorted(rows, reverse=True)[:top]:
+        click.echo(f"{cumulative:>10} {name}")
+
+IMPORT_SECONDS = time.perf_counter() - _import_started
+_boot_timing = {"import": IMPORT_SECONDS, "first_request": None}
+app.logger.info("app importada en %.0f ms", IMPORT_SECONDS * 1000,
+                extra={"event": "import", "duration_ms": round(IMPORT_SECONDS * 1000)})
+
 if __name__ == '__main__':
     app.run(debug=False, port=5000)
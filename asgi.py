@@ -0,0 +1,441 @@
+"""Modo de servicio asincrono (ASGI) para app.py.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+Los checkouts (POST /process_inscription y /process_team_inscription) se
+parten en tres: validacion, reserva de cupo y admision en un hilo
+(begin_checkout), la creacion de la preferencia esperada en el event loop con
+un cliente HTTP asincrono, y el cache, el libro de pagos y la respuesta otra
+vez en un hilo (finish_checkout). Mientras MP
+responde el request no ocupa ningun hilo, asi que un proceso puede sostener
+miles de checkouts en vuelo; el limite lo ponen ASGI_MP_MAX_CONNECTIONS y la
+admision de app.py. Las consultas de pagos de la cola de webhooks tambien se
+esperan en el loop (AsyncWebhookWorker reemplaza al pool de hilos).
+
+Las demas rutas se sirven con la app Flask tal cual, en el pool de hilos
+(ASGI_THREADS): mismas URLs, templates, hooks, metricas y logs que con gunicorn.
+"""
+import asyncio
+import io
+import itertools
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import g, request
+
+import app as webapp
+from app import app as flask_app
+
+ASGI_THREADS = int(os.environ.get("ASGI_THREADS", "32"))
+ASGI_MP_MAX_CONNECTIONS = int(os.environ.get("ASGI_MP_MAX_CONNECTIONS", "1000"))
+ASGI_MP_POOL_SIZE = int(os.environ.get("ASGI_MP_POOL_SIZE", "100"))
+ASGI_MP_KEEPALIVE = int(os.environ.get("ASGI_MP_KEEPALIVE", "10"))
+ASGI_WEBHOOK_CONCURRENCY = int(os.environ.get("ASGI_WEBHOOK_CONCURRENCY", "200"))
+ASGI_MAX_BODY = int(os.environ.get("ASGI_MAX_BODY", str(16 * 1024 * 1024)))
+
+# ── Cliente asincrono de Mercado Pago ─────────────────────────────────────────
+# Mismo contrato que PooledHttpClient: devuelve {"status", "response"}, reintenta
+# solo GET, comparte el circuit breaker y las metricas mp_* con el SDK.
+
+class AsyncMercadoPago:
+    def __init__(self, max_connections, connect_timeout, read_timeout, get_retries, backoff, breaker, base_url=""):
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.get_retries = get_retries
+        self.backoff = backoff
+        self.breaker = breaker
+        self.base_url = base_url or webapp.MP_DEFAULT_API_BASE_URL
+        self._clients = []
+        self._next_client = None
+
+    def _get_client(self):
+        # Se crean dentro del loop que los usa (httpx ata el pool al loop). Son
+        # varios pools chicos y no uno grande: httpcore recorre todas las
+        # conexiones del pool en cada request y con miles en vuelo el costo de
+        # CPU crece con el cuadrado.
+        if not self._clients:
+            import httpx
+            pools = max(1, -(-self.max_connections // ASGI_MP_POOL_SIZE))
+            size = -(-self.max_connections // pools)
+            self._clients = [httpx.AsyncClient(
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=size, max_keepalive_connections=min(size, ASGI_MP_KEEPALIVE)))
+                for _ in range(pools)]
+            self._next_client = itertools.cycle(self._clients)
+        return next(self._next_client)
+
+    async def aclose(self):
+        clients, self._clients = self._clients, []
+        await asyncio.gather(*(client.aclose() for client in clients))
+
+    @staticmethod
+    def _headers():
+        # Los del SDK (token, tracking, x-idempotency-key nuevo por llamada).
+        from mercadopago.config import RequestOptions
+        if not webapp.MERCADO_PAGO_ACCESS_TOKEN:
+            raise webapp.MercadoPagoUnavailable("MERCADO_PAGO_ACCESS_TOKEN no configurado")
+        headers = RequestOptions(access_token=webapp.MERCADO_PAGO_ACCESS_TOKEN).get_headers()
+        headers["Content-type"] = "application/json"
+        return headers
+
+    async def request(self, method, path, **kwargs):
+        metrics = webapp.metrics
+        if not metrics:
+            return await self._request(method, path, **kwargs)
+        operation = webapp._mp_operation(method, path)
+        outcome = "error"
+        metrics.mp_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            result = await self._request(method, path, **kwargs)
+            status = result["status"]
+            outcome = "ok" if status < 400 else "rechazada" if status < 500 and status != 429 else "error"
+            return result
+        except webapp.MercadoPagoUnavailable as e:
+            outcome = "circuito_abierto" if str(e) == "circuito abierto" else "sin_conexion"
+            raise
+        finally:
+            metrics.mp_in_flight.dec()
+            metrics.mp_latency.labels(operation, outcome).observe(time.perf_counter() - started)
+
+    async def _request(self, method, path, **kwargs):
+        import httpx
+        headers = self._headers()
+        if not self.breaker.allow():
+            raise webapp.MercadoPagoUnavailable("circuito abierto")
+        attempts = 1 + (self.get_retries if method == "GET" else 0)
+        error = None
+        result = None
+        for attempt in range(attempts):
+            if attempt:
+                await asyncio.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+            try:
+                api_result = await self._get_client().request(method, self.base_url + path,
+                                                              headers=headers, **kwargs)
+            except httpx.PoolTimeout as e:
+                # Saturacion local (todas las conexiones ocupadas), no una falla de MP.
+                raise webapp.MercadoPagoUnavailable("sin conexiones libres") from e
+            except httpx.HTTPError as e:
+                error = e
+                continue
+            result = webapp.PooledHttpClient._to_response(api_result)
+            if api_result.status_code < 500 and api_result.status_code != 429:
+                self.breaker.record_success()
+                return result
+        self.breaker.record_failure()
+        if result is not None:
+            return result
+        raise webapp.MercadoPagoUnavailable(str(error) or type(error).__name__) from error
+
+    async def create_preference(self, preference_data):
+        return await self.request("POST", "/checkout/preferences", json=preference_data)
+
+    async def get_payment(self, resource_id):
+        return await self.request("GET", f"/v1/payments/{resource_id}")
+
+# ── Cola de webhooks ──────────────────────────────────────────────────────────
+# Misma cola SQLite y mismo registro que WebhookWorker; cambia que las
+# consultas a MP son corrutinas en vez de hilos bloqueados, asi que se pueden
+# procesar varios lotes a la vez (hasta ASGI_WEBHOOK_CONCURRENCY consultas).
+
+class AsyncWebhookWorker:
+    def __init__(self, server, concurrency, batch_size):
+        self.server = server
+        self.batch_size = batch_size
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._batches = asyncio.Semaphore(max(1, concurrency // batch_size))
+        self._tasks = set()
+        self._wakeup = asyncio.Event()
+        self._loop = None
+
+    def start(self, loop):
+        self._loop = loop
+        self._track(loop.create_task(self._run()))
+
+    async def stop(self):
+        # Lo que quede en 'processing' se vuelve a tomar pasado WEBHOOK_STALE_SECONDS.
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _track(self, task):
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def ensure_started(self):
+        # Arranca con el lifespan (ver AsgiApp._startup), que ya drena lo pendiente.
+        pass
+
+    def notify(self):
+        # Se llama desde el hilo que atiende el webhook.
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self):
+        self._wakeup.set()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                while await self.drain_once():
+                    pass
+            except Exception as e:
+                flask_app.logger.error("Error procesando cola de webhooks: %s", e, exc_info=True)
+
+    async def drain_once(self):
+        await self._batches.acquire()
+        try:
+            rows = await self.server.run_sync(webapp._claim_webhooks, self.batch_size)
+        except BaseException:
+            self._batches.release()
+            raise
+        if not rows:
+            self._batches.release()
+            return 0
+        self._track(asyncio.get_running_loop().create_task(self._process(rows)))
+        return len(rows)
+
+    async def _process(self, rows):
+        try:
+            payment_ids = list(dict.fromkeys(row["resource_id"] for row in rows if row["topic"] == "payment"))
+            results = await asyncio.gather(*(self._safe_fetch(rid) for rid in payment_ids))
+            await self.server.run_sync(webapp.apply_webhook_results, rows, dict(zip(payment_ids, results)))
+        except Exception as e:
+            flask_app.logger.error("Error procesando cola de webhooks: %s", e, exc_info=True)
+        finally:
+            self._batches.release()
+
+    async def _safe_fetch(self, resource_id):
+        metrics = webapp.metrics
+        async with self._semaphore:
+            if metrics:
+                metrics.webhook_fetches_in_flight.inc()
+            try:
+                return webapp._payment_from_response(await self.server.mp.get_payment(resource_id)), None
+            except Exception as e:
+                flask_app.logger.error("Error webhook %s: %s", resource_id, e, extra={"payment_id": resource_id})
+                return None, str(e)
+            finally:
+                if metrics:
+                    metrics.webhook_fetches_in_flight.dec()
+
+# ── Servidor ──────────────────────────────────────────────────────────────────
+
+def build_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = scope["client"][0], str(scope["client"][1])
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").lower()
+        value = value.decode("latin-1")
+        if name == "content-length":
+            continue
+        if name == "content-type":
+            environ["CONTENT_TYPE"] = value
+            continue
+        key = "HTTP_" + name.upper().replace("-", "_")
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+def _dispatch(view):
+    # Lo mismo que Flask.full_dispatch_request + wsgi_app, pero con la vista
+    # dada y con el contexto del request ya empujado. Un PendingCheckout se
+    # devuelve tal cual: after_request corre recien al retomarlo.
+    try:
+        try:
+            rv = view()
+        except Exception as e:
+            rv = flask_app.handle_user_exception(e)
+        if isinstance(rv, webapp.PendingCheckout):
+            return rv, None
+        return flask_app.finalize_request(rv), None
+    except Exception as e:
+        return flask_app.handle_exception(e), e
+
+def _buffered(response, environ):
+    app_iter, status, headers = response.get_wsgi_response(environ)
+    try:
+        body = b"".join(app_iter)
+    finally:
+        if hasattr(app_iter, "close"):
+            app_iter.close()
+    return int(status.split(" ", 1)[0]), headers, body
+
+# Rutas cuyo POST espera a MP en el loop, con la primera mitad de cada checkout.
+CHECKOUTS = {
+    "/process_inscription": webapp.begin_checkout,
+    "/process_team_inscription": webapp.begin_team_checkout,
+}
+
+def _checkout_view():
+    rv = flask_app.preprocess_request()
+    if rv is None:
+        rv = CHECKOUTS[request.path](request.form)
+    return rv
+
+def suspend_checkout(environ):
+    # Devuelve (pending, g) si hay que esperar a MP; si no, (status, headers, body).
+    ctx = flask_app.request_context(environ)
+    ctx.push()
+    error = None
+    try:
+        response, error = _dispatch(_checkout_view)
+        if isinstance(response, webapp.PendingCheckout):
+            g.request_suspended = True
+            return response, g._get_current_object()
+        return _buffered(response, environ)
+    finally:
+        ctx.pop(error)
+
+def resume_checkout(environ, pending, saved_g, resp, mp_error):
+    ctx = flask_app.request_context(environ)
+    ctx.push()
+    error = None
+    try:
+        vars(g).update(vars(saved_g))
+        g.request_suspended = False
+        response, error = _dispatch(lambda: webapp.finish_checkout(pending, resp, mp_error))
+        return _buffered(response, environ)
+    finally:
+        ctx.pop(error)
+
+class AsgiApp:
+    def __init__(self, threads=ASGI_THREADS):
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="asgi")
+        self.mp = AsyncMercadoPago(ASGI_MP_MAX_CONNECTIONS, webapp.MP_CONNECT_TIMEOUT, webapp.MP_READ_TIMEOUT,
+                                   webapp.MP_GET_RETRIES, webapp.MP_RETRY_BACKOFF, webapp.mp_breaker,
+                                   base_url=webapp.MP_API_BASE_URL)
+        self.webhooks = None
+
+    def run_sync(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def _startup(self):
+        if self.webhooks is None:
+            self.webhooks = AsyncWebhookWorker(self, ASGI_WEBHOOK_CONCURRENCY, webapp.WEBHOOK_BATCH_SIZE)
+            webapp.webhook_worker = self.webhooks
+            self.webhooks.start(asyncio.get_running_loop())
+
+    async def _shutdown(self):
+        if self.webhooks is not None:
+            await self.webhooks.stop()
+        await self.mp.aclose()
+        self.executor.shutdown(wait=False)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+        self._startup()
+        body = await self._read_body(receive)
+        if body is None:
+            return await self._send(send, 413, [("Content-Type", "text/plain")], b"Request demasiado grande.")
+        environ = build_environ(scope, body)
+        if scope["method"] == "POST" and scope["path"] in CHECKOUTS:
+            return await self._checkout(environ, send)
+        return await self._wsgi(environ, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self._startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self._shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    @staticmethod
+    async def _read_body(receive):
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > ASGI_MAX_BODY:
+                return None
+            chunks.append(chunk)
+            if not message.get("more_body"):
+                break
+        return b"".join(chunks)
+
+    @staticmethod
+    async def _send(send, status, headers, body):
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def _checkout(self, environ, send):
+        result = await self.run_sync(suspend_checkout, environ)
+        if len(result) == 2:
+            pending, saved_g = result
+            resp = mp_error = None
+            try:
+                resp = await self.mp.create_preference(webapp._with_expiration(pending.preference_data))
+            except Exception as e:
+                mp_error = e
+            result = await self.run_sync(resume_checkout, environ, pending, saved_g, resp, mp_error)
+        await self._send(send, *result)
+
+    async def _wsgi(self, environ, send):
+        # Flask sin cambios; el cuerpo se itera en el pool por si es un archivo.
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [int(status.split(" ", 1)[0]), headers]
+
+        def call():
+            app_iter = flask_app(environ, start_response)
+            return app_iter, iter(app_iter)
+
+        app_iter, chunks = await self.run_sync(call)
+        try:
+            status, headers = started
+            await send({"type": "http.response.start", "status": status,
+                        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]})
+            if isinstance(app_iter, (list, tuple)):
+                for chunk in app_iter:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            else:
+                while True:
+                    chunk = await self.run_sync(next, chunks, None)
+                    if chunk is None:
+                        break
+                    if chunk:
+                        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(app_iter, "close"):
+                await self.run_sync(app_iter.close)
+
+app = AsgiApp()
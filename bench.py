@@ -0,0 +1,346 @@
+"""Benchmark de las rutas de inscripcion y pago contra un Mercado Pago falso.
+
+    python bench.py                                  # test client de Flask
+    python bench.py --server --concurrency 8         # servidor WSGI real con hilos
+    python bench.py --latency 0.05 --error-rate 0.01 -o antes.json
+    python bench.py -o despues.json --compare antes.json
+
+Para cada escenario (1, 10 y 100 campeonatos con --classes clases cada uno)
+escribe un settings.json sintetico en un DATA_DIR temporal, levanta
+fake_mercadopago.py y mide throughput y p50/p95/p99 de inscripcion_campeonato,
+process_inscription, payment_success y mercadopago_webhook. Con --compare
+termina con codigo 1 si algun p95 empeoro mas de --tolerance.
+"""
+import argparse
+import http.client
+import importlib
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from datetime import datetime
+
+from fake_mercadopago import start_fake_server
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROUTES = ("inscripcion_campeonato", "process_inscription", "payment_success", "mercadopago_webhook")
+# Respuesta esperada por ruta; cualquier otra cuenta como error.
+EXPECTED_STATUS = {
+    "inscripcion_campeonato": 200,
+    "process_inscription": 302,
+    "payment_success": 200,
+    "mercadopago_webhook": 200,
+}
+
+# ── Settings sinteticos ───────────────────────────────────────────────────────
+
+def synthetic_settings(app_module, camps, classes, seed=0):
+    rng = random.Random(seed)
+    settings = dict(app_module.DEFAULT_SETTINGS)
+    settings["campeonatos"] = []
+    for n in range(camps):
+        camp = app_module.make_default_campeonato(f"Campeonato {n:03d}", camp_id=f"bench{n:03d}")
+        camp["camp_prefix"] = f"C{n:03d}"
+        camp["discount_enabled"] = n % 2 == 0
+        camp["discount_percentage"] = 10
+        camp["discount_description"] = "Socios"
+        camp["allow_cash_payments"] = n % 3 != 0
+        camp["google_forms"]["competitors_id"] = f"form-{n:03d}"
+        camp["classes"] = [{"name": f"Clase {i:03d}", "price": rng.randrange(15000, 60000, 500),
+                            "closed": i % 10 == 9, "discount_price": None}
+                           for i in range(classes)]
+        settings["campeonatos"].append(camp)
+    return settings
+
+# ── Generadores de requests ───────────────────────────────────────────────────
+# Cada generador devuelve (metodo, path, body, content_type).
+
+class Workload:
+    def __init__(self, settings):
+        self.camps = [c for c in settings["campeonatos"] if c["active"]]
+        self.open_classes = {c["id"]: [k["name"] for k in c["classes"] if not k["closed"]] for c in self.camps}
+        self._ids = itertools.count(int(time.time() * 1000))
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        # Ids unicos: el webhook deduplica el mismo id dentro de una ventana.
+        with self._lock:
+            return next(self._ids)
+
+    def request(self, route, rng):
+        camp = rng.choice(self.camps)
+        clase = rng.choice(self.open_classes[camp["id"]])
+        if route == "inscripcion_campeonato":
+            return "GET", f"/inscripciones/{camp['id']}", None, None
+        if route == "process_inscription":
+            form = {"camp_id": camp["id"], "rol": "competidor", "clase_barco": clase}
+            if camp["discount_enabled"] and rng.random() < 0.5:
+                form["apply_discount"] = "on"
+            return "POST", "/process_inscription", urllib.parse.urlencode(form), \
+                "application/x-www-form-urlencoded"
+        if route == "payment_success":
+            query = urllib.parse.urlencode({
+                "payment_id": self.next_id(), "status": "approved", "collection_status": "approved",
+                "external_reference": f"{camp['camp_prefix']}_{clase}_{camp['id']}",
+                "preference_id": f"pref-{self.next_id()}", "payment_type": "credit_card",
+                "clase_barco": clase, "camp_id": camp["id"]})
+            return "GET", f"/payment_success?{query}", None, None
+        if route == "mercadopago_webhook":
+            body = json.dumps({"type": "payment", "data": {"id": str(self.next_id())}})
+            return "POST", "/mercadopago-webhook", body, "application/json"
+        raise ValueError(route)
+
+# ── Clientes ──────────────────────────────────────────────────────────────────
+
+class TestClientDriver:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+
+    def session(self):
+        client = self.flask_app.test_client()
+
+        def send(method, path, body, content_type):
+            response = client.open(path, method=method, data=body, content_type=content_type,
+                                   headers={"Accept-Encoding": "gzip"})
+            response.get_data()
+            response.close()
+            return response.status_code
+        return send
+
+    def close(self):
+        pass
+
+class ServerDriver:
+    def __init__(self, flask_app):
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class Handler(WSGIRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        self.server = make_server("127.0.0.1", 0, flask_app, threaded=True, request_handler=Handler)
+        self.port = self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def session(self):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+
+        def send(method, path, body, content_type):
+            headers = {"Accept-Encoding": "gzip"}
+            if content_type:
+                headers["Content-Type"] = content_type
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        return send
+
+    def close(self):
+        self.server.shutdown()
+
+# ── Medicion ──────────────────────────────────────────────────────────────────
+
+def percentile_summary(latencies):
+    if len(latencies) < 2:
+        value = latencies[0] * 1000 if latencies else 0.0
+        return {"p50_ms": value, "p95_ms": value, "p99_ms": value}
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {"p50_ms": round(cuts[49] * 1000, 3), "p95_ms": round(cuts[94] * 1000, 3),
+            "p99_ms": round(cuts[98] * 1000, 3)}
+
+def run_route(driver, workload, route, requests, concurrency, warmup, seed):
+    latencies, errors = [], {}
+    lock = threading.Lock()
+    remaining = itertools.count()
+
+    def worker(n):
+        rng = random.Random(seed * 1000 + n)
+        send = driver.session()
+        for _ in range(warmup // concurrency):
+            send(*workload.request(route, rng))
+        barrier.wait()
+        local, local_errors = [], {}
+        while next(remaining) < requests:
+            req = workload.request(route, rng)
+            started = time.perf_counter()
+            try:
+                status = send(*req)
+            except Exception as e:
+                status = type(e).__name__
+            local.append(time.perf_counter() - started)
+            if status != EXPECTED_STATUS[route]:
+                local_errors[str(status)] = local_errors.get(str(status), 0) + 1
+        with lock:
+            latencies.extend(local)
+            for key, count in local_errors.items():
+                errors[key] = errors.get(key, 0) + count
+
+    barrier = threading.Barrier(concurrency + 1)
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    result = {"requests": len(latencies), "errors": sum(errors.values()), "error_status": errors,
+              "seconds": round(elapsed, 3), "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0}
+    result.update(percentile_summary(latencies))
+    return result
+
+def wait_for_webhooks(app_module, timeout=60):
+    # Lo encolado por una ruta se procesa antes de medir la siguiente.
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if not app_module.webhook_queue_stats()["depth"]:
+            break
+        time.sleep(0.05)
+    return round(time.perf_counter() - started, 3)
+
+def run_scenario(app_module, driver, camps, args):
+    settings = synthetic_settings(app_module, camps, args.classes, seed=args.seed)
+    app_module.save_settings(settings)
+    workload = Workload(settings)
+    results = {}
+    for route in args.routes:
+        results[route] = run_route(driver, workload, route, args.requests, args.concurrency,
+                                   args.warmup, args.seed)
+        r = results[route]
+        r["webhook_drain_seconds"] = wait_for_webhooks(app_module)
+        print(f"{camps:>4} camp  {route:<24} {r['rps']:>8.1f} req/s  p50 {r['p50_ms']:>8.2f}  "
+              f"p95 {r['p95_ms']:>8.2f}  p99 {r['p99_ms']:>8.2f} ms  errores {r['errors']}")
+    return results
+
+# ── Comparacion ───────────────────────────────────────────────────────────────
+
+# Parametros que cambian los numeros: si difieren, la comparacion solo avisa.
+COMPARABLE_META = ("mode", "classes", "concurrency", "latency", "error_rate", "settings_backend",
+                   "preference_cache")
+
+def compare(current, baseline, tolerance):
+    regressions = []
+    print(f"\nComparacion contra {baseline['meta'].get('created', '?')} ({baseline['meta'].get('git', '?')})")
+    for key in COMPARABLE_META:
+        if current["meta"].get(key) != baseline["meta"].get(key):
+            print(f"Aviso: {key} distinto ({baseline['meta'].get(key)} -> {current['meta'].get(key)})")
+    for scenario, routes in current["results"].items():
+        for route, r in routes.items():
+            old = baseline["results"].get(scenario, {}).get(route)
+            if not old or not old["p95_ms"]:
+                continue
+            ratio = r["p95_ms"] / old["p95_ms"]
+            mark = ""
+            if ratio > 1 + tolerance:
+                mark = "  <-- regresion"
+                regressions.append((scenario, route, ratio))
+            print(f"{scenario:>4} camp  {route:<24} p95 {old['p95_ms']:>8.2f} -> {r['p95_ms']:>8.2f} ms "
+                  f"({(ratio - 1) * 100:+.0f}%)  rps {old['rps']:>8.1f} -> {r['rps']:>8.1f}{mark}")
+    return regressions
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# ── Main ──────────────────────────────────────────────────────────────────────
+
+def import_app(data_dir, fake_url, args):
+    # La app lee su configuracion del entorno al importarse.
+    os.environ.update({
+        "DATA_DIR": data_dir,
+        "SETTINGS_BACKEND": args.settings_backend,
+        "MP_API_BASE_URL": fake_url,
+        "MERCADO_PAGO_ACCESS_TOKEN": "TEST-bench",
+        "MP_BREAKER_THRESHOLD": "1000000",
+        "PREFERENCE_CACHE_SIZE": os.environ.get("PREFERENCE_CACHE_SIZE", "512" if args.preference_cache else "0"),
+        "RECONCILE_INTERVAL_SECONDS": "0",
+    })
+    sys.path.insert(0, BASE_DIR)
+    app_module = importlib.import_module("app")
+    app_module.app.logger.setLevel(logging.WARNING)
+    return app_module
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", action="store_true", help="medir a traves de un servidor WSGI real")
+    parser.add_argument("--camps", type=int, nargs="+", default=[1, 10, 100], help="escenarios a medir")
+    parser.add_argument("--classes", type=int, default=200, help="clases por campeonato")
+    parser.add_argument("--routes", nargs="+", default=list(ROUTES), choices=ROUTES)
+    parser.add_argument("--requests", type=int, default=500, help="requests medidos por ruta y escenario")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="segundos de demora del MP falso")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraccion de respuestas 500 del MP falso")
+    parser.add_argument("--settings-backend", default="json", choices=("json", "sqlite"))
+    parser.add_argument("--preference-cache", action="store_true",
+                        help="dejar activo el cache de preferencias (por defecto cada checkout llama a MP)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep-data", action="store_true", help="no borrar el DATA_DIR temporal")
+    parser.add_argument("-o", "--output", default="bench-results.json")
+    parser.add_argument("--compare", metavar="JSON", help="resultado anterior contra el que comparar")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="aumento de p95 tolerado (0.10 = 10%%)")
+    args = parser.parse_args()
+
+    fake = start_fake_server(latency=args.latency, error_rate=args.error_rate)
+    data_dir = tempfile.mkdtemp(prefix="bench-data-")
+    app_module = import_app(data_dir, f"http://127.0.0.1:{fake.server_address[1]}", args)
+    driver = ServerDriver(app_module.app) if args.server else TestClientDriver(app_module.app)
+
+    results = {}
+    try:
+        for camps in args.camps:
+            results[str(camps)] = run_scenario(app_module, driver, camps, args)
+    finally:
+        driver.close()
+        fake.shutdown()
+
+    report = {
+        "meta": {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "git": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "mode": "server" if args.server else "test_client",
+            "classes": args.classes,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "latency": args.latency,
+            "error_rate": args.error_rate,
+            "settings_backend": args.settings_backend,
+            "preference_cache": args.preference_cache,
+            "mp_calls": dict(fake.fake.calls),
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResultados en {args.output}")
+    if args.keep_data:
+        print(f"Datos de la corrida en {data_dir}")
+    else:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} rutas con p95 peor que {args.tolerance:.0%} de tolerancia")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
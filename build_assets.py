@@ -0,0 +1,253 @@
+"""Arma el bundle de CSS e iconos que sirve la app en lugar de jsdelivr.
+
+    python build_assets.py            # usa static/vendor, descarga lo que falte
+    python build_assets.py --refresh  # vuelve a descargar las fuentes
+
+Toma Bootstrap y Bootstrap Icons de static/vendor, descarta las reglas cuyas
+clases no aparecen en templates/ ni en app.py, recorta la fuente de iconos a
+los glifos usados y escribe en static/dist un unico CSS con hash en el nombre,
+sus variantes .gz y .br y manifest.json (que es lo que lee app.py).
+"""
+import argparse
+import base64
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import sys
+import urllib.request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+VENDOR_DIR = os.path.join(BASE_DIR, "static", "vendor")
+DIST_DIR = os.path.join(BASE_DIR, "static", "dist")
+TEMPLATES_DIR = os.path.join(BASE_DIR, "templates")
+
+SOURCES = {
+    "bootstrap.min.css": (
+        "https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css",
+        "sha384-QWTKZyjpPEjISv5WaRU9OFeRpok6YctnYmDr5pNlyT2bRjXh0JMhjY6hW+ALEwIH"),
+    "bootstrap-icons.min.css": (
+        "https://cdn.jsdelivr.net/npm/bootstrap-icons@1.11.3/font/bootstrap-icons.min.css", None),
+    "bootstrap-icons.woff2": (
+        "https://cdn.jsdelivr.net/npm/bootstrap-icons@1.11.3/font/fonts/bootstrap-icons.woff2", None),
+}
+# Templates que no se renderizan desde app.py.
+IGNORED_TEMPLATES = {"justinAdmin.html", "payment_brick.html"}
+# Clases que Bootstrap agrega desde CSS/JS o que arma el navegador.
+SAFELIST = {"show", "active", "disabled", "fade", "collapsing", "was-validated", "is-invalid", "is-valid"}
+
+# ── Fuentes ───────────────────────────────────────────────────────────────────
+
+def fetch_sources(refresh=False):
+    os.makedirs(VENDOR_DIR, exist_ok=True)
+    for name, (url, integrity) in SOURCES.items():
+        path = os.path.join(VENDOR_DIR, name)
+        if os.path.exists(path) and not refresh:
+            continue
+        print(f"Descargando {url}")
+        with urllib.request.urlopen(url, timeout=30) as resp:
+            data = resp.read()
+        if integrity:
+            algo, expected = integrity.split("-", 1)
+            actual = base64.b64encode(hashlib.new(algo, data).digest()).decode()
+            if actual != expected:
+                sys.exit(f"{name}: el hash no coincide con {integrity}")
+        with open(path, "wb") as f:
+            f.write(data)
+
+def read_vendor(name, mode="r"):
+    with open(os.path.join(VENDOR_DIR, name), mode, **({} if "b" in mode else {"encoding": "utf-8"})) as f:
+        return f.read()
+
+# ── Clases usadas ─────────────────────────────────────────────────────────────
+
+def used_names():
+    # Cualquier palabra que aparezca en los templates o en app.py cuenta como
+    # posible clase; "alert-{{ category }}" agrega el prefijo "alert-".
+    words, prefixes = set(SAFELIST), set()
+    paths = [os.path.join(TEMPLATES_DIR, n) for n in os.listdir(TEMPLATES_DIR)
+             if n.endswith(".html") and n not in IGNORED_TEMPLATES]
+    paths.append(os.path.join(BASE_DIR, "app.py"))
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            text = f.read()
+        words.update(re.findall(r"[A-Za-z0-9_-]+", text))
+        prefixes.update(re.findall(r"([A-Za-z0-9-]+-)\{\{", text))
+    return words, tuple(prefixes)
+
+# ── Purga de CSS ──────────────────────────────────────────────────────────────
+
+def split_blocks(css):
+    # Devuelve [(prelude, body)] del nivel actual; body es None para
+    # sentencias sueltas como @charset o @import.
+    blocks, i, start, depth, quote = [], 0, 0, 0, None
+    prelude_end = None
+    while i < len(css):
+        ch = css[i]
+        if quote:
+            if ch == "\\":
+                i += 1
+            elif ch == quote:
+                quote = None
+        elif ch in "\"'":
+            quote = ch
+        elif css.startswith("/*", i):
+            end = css.find("*/", i + 2)
+            i = len(css) if end < 0 else end + 1
+        elif ch == "{":
+            if depth == 0:
+                prelude_end = i
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                blocks.append((css[start:prelude_end].strip(), css[prelude_end + 1:i]))
+                start = i + 1
+        elif ch == ";" and depth == 0:
+            blocks.append((css[start:i].strip(), None))
+            start = i + 1
+        i += 1
+    return blocks
+
+def split_selectors(selector_list):
+    parts, depth, current = [], 0, ""
+    for ch in selector_list:
+        if ch in "([":
+            depth += 1
+        elif ch in ")]":
+            depth -= 1
+        if ch == "," and depth == 0:
+            parts.append(current)
+            current = ""
+        else:
+            current += ch
+    parts.append(current)
+    return [p.strip() for p in parts if p.strip()]
+
+def selector_used(selector, words, prefixes):
+    # Lo que esta dentro de :not(...) no necesita existir para que la regla aplique.
+    selector = re.sub(r":not\([^)]*\)", "", selector)
+    for name in re.findall(r"\.(-?[_a-zA-Z][\w-]*)", selector):
+        if name not in words and not name.startswith(prefixes):
+            return False
+    return True
+
+KEEP_WHOLE = ("@font-face", "@keyframes", "@-webkit-keyframes", "@page")
+
+def purge(css, words, prefixes):
+    out = []
+    for prelude, body in split_blocks(css):
+        if body is None:
+            out.append(prelude + ";")
+        elif prelude.startswith(KEEP_WHOLE):
+            out.append(f"{prelude}{{{body}}}")
+        elif prelude.startswith("@"):
+            inner = purge(body, words, prefixes)
+            if inner:
+                out.append(f"{prelude}{{{inner}}}")
+        else:
+            selectors = [s for s in split_selectors(prelude) if selector_used(s, words, prefixes)]
+            if selectors:
+                out.append(f"{','.join(selectors)}{{{body}}}")
+    return "".join(out)
+
+def drop_unused_keyframes(css):
+    names = set(re.findall(r"@(?:-webkit-)?keyframes\s+([\w-]+)", css))
+    for name in names:
+        rest = re.sub(r"@(?:-webkit-)?keyframes\s+" + re.escape(name) + r"\{(?:[^{}]*\{[^{}]*\})*[^{}]*\}", "", css)
+        if not re.search(r"animation[^;{}]*\b" + re.escape(name) + r"\b", rest):
+            css = rest
+    return css
+
+# ── Iconos ────────────────────────────────────────────────────────────────────
+
+def subset_icons(icons_css, font_bytes):
+    from fontTools import subset
+    from fontTools.ttLib import TTFont
+    codepoints = {int(cp, 16) for cp in re.findall(r'content:\s*"\\([0-9a-fA-F]+)"', icons_css)}
+    font = TTFont(io.BytesIO(font_bytes))
+    options = subset.Options()
+    options.flavor = "woff2" if brotli is not None else "woff"
+    options.layout_features = []
+    options.name_IDs = []
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(unicodes=codepoints)
+    subsetter.subset(font)
+    out = io.BytesIO()
+    font.flavor = options.flavor
+    font.save(out)
+    return out.getvalue(), options.flavor, len(codepoints)
+
+# ── Salida ────────────────────────────────────────────────────────────────────
+
+def write_hashed(stem, ext, data, compress=True):
+    digest = hashlib.sha256(data).hexdigest()[:16]
+    name = f"{stem}.{digest}.{ext}"
+    path = os.path.join(DIST_DIR, name)
+    with open(path, "wb") as f:
+        f.write(data)
+    if compress:
+        with open(path + ".gz", "wb") as f:
+            f.write(gzip.compress(data, 9, mtime=0))
+        if brotli is not None:
+            with open(path + ".br", "wb") as f:
+                f.write(brotli.compress(data, quality=11))
+    return name
+
+def strip_comments(css):
+    # Devuelve el CSS sin comentarios y el aviso de licencia (/*! ... */) aparte.
+    license = re.search(r"/\*!.*?\*/", css, re.S)
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    return css.replace('@charset "UTF-8";', ""), license.group(0) if license else ""
+
+def minify(css):
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s*([{};:,>])\s*", r"\1", css)
+    return re.sub(r"\s+", " ", css).replace(";}", "}").strip()
+
+def build(refresh=False):
+    fetch_sources(refresh)
+    words, prefixes = used_names()
+    os.makedirs(DIST_DIR, exist_ok=True)
+    for name in os.listdir(DIST_DIR):
+        os.remove(os.path.join(DIST_DIR, name))
+
+    bootstrap_css, bootstrap_license = strip_comments(read_vendor("bootstrap.min.css"))
+    purged = drop_unused_keyframes(purge(bootstrap_css, words, prefixes))
+
+    icons_css, icons_license = strip_comments(read_vendor("bootstrap-icons.min.css"))
+    icons_css = purge(icons_css, words, prefixes)
+    font_data, flavor, glyphs = subset_icons(icons_css, read_vendor("bootstrap-icons.woff2", "rb"))
+    font_name = write_hashed("bootstrap-icons", flavor, font_data, compress=False)
+    icons_css = re.sub(r"src:url\([^;}]*", f'src:url("{font_name}") format("{flavor}")', icons_css, count=1)
+
+    with open(os.path.join(BASE_DIR, "static", "css", "style.css"), encoding="utf-8") as f:
+        style_css = minify(f.read())
+
+    bundle = "\n".join([bootstrap_license, icons_license, purged, icons_css, style_css]).encode("utf-8")
+    css_name = write_hashed("bundle", "css", bundle)
+    with open(os.path.join(DIST_DIR, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump({"bundle.css": f"dist/{css_name}"}, f, indent=2)
+
+    original = sum(len(read_vendor(n, "rb")) for n in SOURCES) + len(style_css)
+    print(f"{css_name}: {len(bundle) / 1024:.1f} KiB "
+          f"(gzip {len(gzip.compress(bundle, 9)) / 1024:.1f} KiB), fuentes {original / 1024:.1f} KiB")
+    print(f"{font_name}: {glyphs} iconos, {len(font_data) / 1024:.1f} KiB")
+    if brotli is None:
+        print("Aviso: sin el paquete 'brotli' no se generan .br y la fuente queda en woff")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--refresh", action="store_true", help="volver a descargar static/vendor")
+    args = parser.parse_args()
+    build(args.refresh)
+
+if __name__ == "__main__":
+    main()
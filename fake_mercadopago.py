@@ -0,0 +1,173 @@
+"""Servidor local que imita la API de Mercado Pago usada por app.py.
+
+Sirve para pruebas y benchmarks sin salir a internet:
+
+    python fake_mercadopago.py --port 8089 --latency 0.05 --error-rate 0.01
+    MP_API_BASE_URL=http://127.0.0.1:8089 python app.py
+"""
+import argparse
+import itertools
+import json
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeMercadoPago:
+    def __init__(self, latency=0.0, error_rate=0.0, payment_status="approved"):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.payment_status = payment_status
+        self.preferences = {}
+        self.payments = {}
+        self.calls = {}
+        self._ids = itertools.count(1000)
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def create_preference(self, data):
+        pref_id = f"pref-{next(self._ids)}"
+        pref = dict(data, id=pref_id,
+                    init_point=f"https://www.mercadopago.com.ar/checkout/v1/redirect?pref_id={pref_id}")
+        with self._lock:
+            self.preferences[pref_id] = pref
+        return pref
+
+    def add_payment(self, payment_id, **fields):
+        payment = {
+            "id": int(payment_id),
+            "status": fields.pop("status", self.payment_status),
+            "status_detail": "accredited",
+            "external_reference": fields.pop("external_reference", ""),
+            "transaction_amount": fields.pop("transaction_amount", 1000.0),
+            "payment_type_id": fields.pop("payment_type_id", "credit_card"),
+            "date_created": fields.pop("date_created", time.strftime("%Y-%m-%dT%H:%M:%S.000-03:00")),
+        }
+        payment["date_last_updated"] = fields.pop("date_last_updated", payment["date_created"])
+        payment.update(fields)
+        with self._lock:
+            self.payments[str(payment_id)] = payment
+        return payment
+
+    def search_payments(self, params):
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", 30))
+        begin_date = params.get("begin_date", "")
+        external_reference = params.get("external_reference")
+        with self._lock:
+            payments = list(self.payments.values())
+        if begin_date and begin_date != "NOW":
+            payments = [p for p in payments if p["date_last_updated"] >= begin_date]
+        if external_reference:
+            payments = [p for p in payments if p["external_reference"] == external_reference]
+        payments.sort(key=lambda p: (p["date_last_updated"], p["id"]))
+        return {"paging": {"total": len(payments), "limit": limit, "offset": offset},
+                "results": payments[offset:offset + limit]}
+
+    def get_payment(self, payment_id):
+        with self._lock:
+            payment = self.payments.get(str(payment_id))
+        return payment or self.add_payment(payment_id)
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers y cuerpo salen en dos writes: sin TCP_NODELAY cada respuesta
+        # espera ~40 ms por Nagle + ACK demorado y eso contamina los benchmarks.
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _simulate(self, name):
+            fake.count(name)
+            if fake.latency:
+                time.sleep(fake.latency)
+            if fake.error_rate and random.random() < fake.error_rate:
+                self._send(500, {"message": "simulated error", "status": 500})
+                return False
+            return True
+
+        def _body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            return json.loads(raw or b"{}")
+
+        def do_POST(self):
+            path = self.path.split("?", 1)[0]
+            if path == "/checkout/preferences":
+                data = self._body()
+                if self._simulate("preference.create"):
+                    self._send(201, fake.create_preference(data))
+                return
+            self._send(404, {"message": "not found"})
+
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            if path == "/v1/payments/search":
+                if self._simulate("payment.search"):
+                    query = dict(urllib.parse.parse_qsl(self.path.split("?", 1)[1] if "?" in self.path else ""))
+                    self._send(200, fake.search_payments(query))
+                return
+            match = re.fullmatch(r"/v1/payments/(\d+)", path)
+            if match:
+                if self._simulate("payment.get"):
+                    self._send(200, fake.get_payment(match.group(1)))
+                return
+            self._send(404, {"message": "not found"})
+
+    return Handler
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # El modo ASGI abre cientos de conexiones a la vez; con el backlog por
+    # defecto (5) el kernel rechaza las que no entran.
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # El cliente corto la conexion (la app termino a mitad de una llamada).
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+def start_fake_server(host="127.0.0.1", port=0, **options):
+    fake = FakeMercadoPago(**options)
+    server = FakeServer((host, port), make_handler(fake))
+    server.fake = fake
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.0, help="segundos de demora por llamada")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraccion de respuestas 500")
+    parser.add_argument("--payment-status", default="approved")
+    args = parser.parse_args()
+    server = start_fake_server(args.host, args.port, latency=args.latency,
+                               error_rate=args.error_rate, payment_status=args.payment_status)
+    print(f"Fake Mercado Pago en http://{args.host}:{server.server_address[1]}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
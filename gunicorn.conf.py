@@ -0,0 +1,17 @@
+# Hooks para las metricas de app.py con varios workers (ver "Metricas").
+# Con PROMETHEUS_MULTIPROC_DIR cada worker escribe sus valores en archivos de
+# ese directorio; no usar --preload, asi las metricas se crean en cada worker.
+import os
+
+def on_starting(server):
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        # Lo que quedo de un arranque anterior sumaria valores viejos.
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            os.remove(os.path.join(path, name))
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
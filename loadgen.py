@@ -0,0 +1,590 @@
+"""Generador de carga: tormenta de webhooks + apertura de inscripciones.
+
+    # todo local: levanta el MP falso y la app (gunicorn si esta instalado)
+    python loadgen.py --spawn --profile spike --concurrency 64 --duration 60
+
+    # contra una instancia ya corriendo (apuntada a fake_mercadopago.py)
+    python loadgen.py --url http://127.0.0.1:5000 --settings /data/settings.json \\
+        --admin-password secreto --profile ramp --record carga.jsonl
+
+    # repetir una carga grabada, al doble de velocidad
+    python loadgen.py --spawn --replay carga.jsonl --speed 2
+
+La mezcla sintetica (--mix) combina webhooks de pago con duplicados como los
+que manda MP (mismo id por IPN y por webhook, y reintentos), POSTs de
+competidores a process_inscription repartidos entre clases, redirecciones de
+entrenadores, visitas a la pagina del campeonato y guardados del admin. Los
+perfiles de concurrencia son ramp (sube hasta --concurrency), spike (base de
+10% con un pico en el medio) y soak (constante). Al final muestra tasa de
+errores, histograma de latencias por tipo y una linea por segundo con la
+saturacion: requests en vuelo, rechazos 429/503, profundidad de la cola de
+webhooks y CPU de los procesos de la app (solo con --spawn en Linux).
+"""
+import argparse
+import bisect
+import collections
+import http.client
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MIX = "webhook=50,competitor=25,page=15,trainer=8,admin=2"
+# Limites superiores de los buckets del histograma, en ms.
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, math.inf)
+# Respuestas con las que la app se defiende de la carga (sala de espera,
+# circuito abierto, cupo completo): no son errores pero indican saturacion.
+SHED_STATUS = {429, 503, 409}
+
+# ── Mezcla de trafico ─────────────────────────────────────────────────────────
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in ("webhook", "competitor", "trainer", "page", "admin"):
+            raise argparse.ArgumentTypeError(f"tipo desconocido en --mix: {kind}")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+def admin_form(camp):
+    # Lo que envia el formulario de edicion sin cambios: guardar no altera el estado.
+    gf = camp.get("google_forms", {})
+    form = {
+        "name": camp.get("name", ""), "title_main": camp.get("title_main", ""),
+        "title_strong": camp.get("title_strong", ""),
+        "discount_description": camp.get("discount_description", ""),
+        "discount_percentage": str(camp.get("discount_percentage", 0)),
+        "google_forms_competitors_id": gf.get("competitors_id", ""),
+        "google_forms_trainers_id": gf.get("trainers_id", ""),
+        "entry_id_num_operacion": gf.get("entry_id_num_operacion", ""),
+        "entry_id_clase_barco": gf.get("entry_id_clase_barco", ""),
+        "camp_prefix": camp.get("camp_prefix", ""),
+    }
+    if camp.get("allow_cash_payments"):
+        form["allow_cash_payments"] = "on"
+    if camp.get("discount_enabled"):
+        form["discount_enabled"] = "on"
+    for idx, cls in enumerate(camp.get("classes", [])):
+        form[f"name-{idx}"] = cls["name"]
+        form[f"price-{idx}"] = "" if cls.get("price") is None else str(cls["price"])
+        form[f"capacity-{idx}"] = str(cls.get("capacity") or "")
+        if not cls.get("closed"):
+            form[f"open-{idx}"] = "on"
+    return urllib.parse.urlencode(form)
+
+class SyntheticMix:
+    def __init__(self, settings, mix, duplicate_ratio, seed):
+        self.camps = [c for c in settings["campeonatos"] if c.get("active", True)]
+        if not self.camps:
+            raise SystemExit("settings sin campeonatos activos")
+        self.open_classes = {c["id"]: [k["name"] for k in c.get("classes", [])
+                                       if not k.get("closed") and k.get("price") is not None]
+                             for c in self.camps}
+        self.kinds = list(mix)
+        self.weights = [mix[k] for k in self.kinds]
+        self.duplicate_ratio = duplicate_ratio
+        self.recent_payments = collections.deque(maxlen=500)
+        self._ids = iter(range(int(time.time() * 1000) % 10 ** 9, 10 ** 12))
+        self._lock = threading.Lock()
+        self.seed = seed
+
+    def webhook(self, rng):
+        with self._lock:
+            if self.recent_payments and rng.random() < self.duplicate_ratio:
+                payment_id = rng.choice(self.recent_payments)
+            else:
+                payment_id = next(self._ids)
+                self.recent_payments.append(payment_id)
+        roll = rng.random()
+        if roll < 0.45:
+            body = json.dumps({"action": "payment.updated", "type": "payment", "data": {"id": str(payment_id)}})
+            return "POST", "/mercadopago-webhook", body, "application/json"
+        if roll < 0.9:
+            # Notificacion IPN: mismo pago, parametros en la query.
+            return "POST", f"/mercadopago-webhook?topic=payment&id={payment_id}", "", None
+        return "POST", f"/mercadopago-webhook?topic=merchant_order&id={payment_id}", "", None
+
+    def next(self, rng):
+        kind = rng.choices(self.kinds, self.weights)[0]
+        camp = rng.choice(self.camps)
+        if kind == "webhook":
+            return (kind,) + self.webhook(rng)
+        if kind == "page":
+            return kind, "GET", f"/inscripciones/{camp['id']}", None, None
+        if kind == "admin":
+            return kind, "POST", f"/admin/campeonato/{camp['id']}/save", admin_form(camp), \
+                "application/x-www-form-urlencoded"
+        form = {"camp_id": camp["id"], "rol": "entrenador" if kind == "trainer" else "competidor"}
+        if kind == "competitor":
+            classes = self.open_classes[camp["id"]]
+            if not classes:
+                return kind, "GET", f"/inscripciones/{camp['id']}", None, None
+            form["clase_barco"] = rng.choice(classes)
+            if camp.get("discount_enabled") and rng.random() < 0.3:
+                form["apply_discount"] = "on"
+        return kind, "POST", "/process_inscription", urllib.parse.urlencode(form), \
+            "application/x-www-form-urlencoded"
+
+def classify(kind, status, location):
+    if isinstance(status, str):
+        return "error"
+    if status in SHED_STATUS:
+        return "rechazo"
+    if kind == "admin":
+        # Sin sesion el admin redirige al login: cuenta como error del generador.
+        return "ok" if status == 302 and "/admin/campeonato/" in (location or "") else "error"
+    if kind in ("competitor", "trainer"):
+        return "ok" if status == 302 else "error"
+    if kind == "webhook":
+        return "ok" if status == 200 else "error"
+    return "ok" if status in (200, 304) else "error"
+
+# ── Perfiles de concurrencia ──────────────────────────────────────────────────
+
+def target_concurrency(profile, elapsed, duration, peak):
+    fraction = min(1.0, elapsed / duration) if duration else 1.0
+    if profile == "ramp":
+        return max(1, math.ceil(peak * fraction))
+    if profile == "spike":
+        return peak if 0.4 <= fraction < 0.6 else max(1, peak // 10)
+    return peak
+
+# ── Cliente HTTP ──────────────────────────────────────────────────────────────
+
+class Target:
+    def __init__(self, url):
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.admin_cookie = None
+
+    def connect(self):
+        return http.client.HTTPConnection(self.host, self.port, timeout=30)
+
+    def login(self, password):
+        conn = self.connect()
+        conn.request("POST", "/admin/login", body=urllib.parse.urlencode({"password": password}),
+                     headers={"Content-Type": "application/x-www-form-urlencoded"})
+        response = conn.getresponse()
+        response.read()
+        cookie = response.getheader("Set-Cookie") or ""
+        conn.close()
+        if "session=" not in cookie:
+            raise SystemExit("No se pudo iniciar sesion en /admin: revisar --admin-password")
+        self.admin_cookie = cookie.split(";", 1)[0]
+
+    def webhook_depth(self):
+        if not self.admin_cookie:
+            return None
+        try:
+            conn = self.connect()
+            conn.request("GET", "/admin/webhooks/stats", headers={"Cookie": self.admin_cookie})
+            response = conn.getresponse()
+            data = json.loads(response.read() or b"{}")
+            conn.close()
+            return data.get("depth")
+        except (OSError, ValueError, http.client.HTTPException):
+            return None
+
+class Session:
+    # Una conexion keep-alive por worker; se reabre si el servidor la corta.
+    def __init__(self, target):
+        self.target = target
+        self.conn = None
+
+    def send(self, kind, method, path, body, content_type):
+        headers = {"Accept-Encoding": "gzip"}
+        if content_type:
+            headers["Content-Type"] = content_type
+        if kind == "admin" and self.target.admin_cookie:
+            headers["Cookie"] = self.target.admin_cookie
+        for attempt in (0, 1):
+            if self.conn is None:
+                self.conn = self.target.connect()
+            try:
+                self.conn.request(method, path, body=body or None, headers=headers)
+                response = self.conn.getresponse()
+                response.read()
+                if response.getheader("Connection", "").lower() == "close":
+                    self.conn.close()
+                    self.conn = None
+                return response.status, response.getheader("Location")
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError) as e:
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    return type(e).__name__, None
+            except (OSError, http.client.HTTPException) as e:
+                self.conn.close()
+                self.conn = None
+                return type(e).__name__, None
+
+# ── Resultados ────────────────────────────────────────────────────────────────
+
+class Stats:
+    def __init__(self):
+        self.kinds = {}
+        self.seconds = collections.defaultdict(lambda: {"done": 0, "errors": 0, "shed": 0, "latencies": [],
+                                                        "in_flight": 0})
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def started(self, second):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            bucket = self.seconds[second]
+            bucket["in_flight"] = max(bucket["in_flight"], self.in_flight)
+
+    def finished(self, kind, second, latency, outcome, status):
+        with self._lock:
+            self.in_flight -= 1
+            entry = self.kinds.setdefault(kind, {"latencies": [], "ok": 0, "rechazo": 0, "error": 0,
+                                                 "status": collections.Counter()})
+            entry["latencies"].append(latency)
+            entry[outcome] += 1
+            entry["status"][str(status)] += 1
+            bucket = self.seconds[second]
+            bucket["done"] += 1
+            bucket["latencies"].append(latency)
+            if outcome == "error":
+                bucket["errors"] += 1
+            elif outcome == "rechazo":
+                bucket["shed"] += 1
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def histogram(latencies):
+    counts = [0] * len(BUCKETS_MS)
+    for latency in latencies:
+        counts[bisect.bisect_left(BUCKETS_MS, latency * 1000)] += 1
+    return counts
+
+def summarize(stats, timeline):
+    kinds = {}
+    for kind, entry in sorted(stats.kinds.items()):
+        latencies = sorted(entry["latencies"])
+        total = len(latencies)
+        kinds[kind] = {
+            "requests": total, "ok": entry["ok"], "rechazos": entry["rechazo"], "errores": entry["error"],
+            "error_rate": round(entry["error"] / total, 4) if total else 0.0,
+            "status": dict(entry["status"]),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+            "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+            "histogram": dict(zip(("inf" if b == math.inf else str(b) for b in BUCKETS_MS),
+                                  histogram(latencies))),
+        }
+    return {"kinds": kinds, "max_in_flight": stats.max_in_flight, "timeline": timeline}
+
+def print_report(report):
+    print(f"\n{'tipo':<11}{'requests':>9}{'ok':>8}{'rechazos':>10}{'errores':>9}{'p50':>9}{'p95':>9}{'p99':>9} ms")
+    for kind, k in report["kinds"].items():
+        print(f"{kind:<11}{k['requests']:>9}{k['ok']:>8}{k['rechazos']:>10}{k['errores']:>9}"
+              f"{k['p50_ms']:>9.1f}{k['p95_ms']:>9.1f}{k['p99_ms']:>9.1f}")
+    for kind, k in report["kinds"].items():
+        print(f"\nlatencia {kind} (status {k['status']})")
+        peak = max(k["histogram"].values()) or 1
+        for bucket, count in k["histogram"].items():
+            if count:
+                label = "> 10000" if bucket == "inf" else f"<= {bucket}"
+                print(f"  {label:>8} ms {count:>7} {'#' * max(1, round(40 * count / peak))}")
+    print(f"\n{'seg':>4}{'objetivo':>9}{'en vuelo':>9}{'req/s':>7}{'err':>5}{'429/503':>8}"
+          f"{'p95 ms':>9}{'cola wh':>8}{'cpu app':>8}")
+    for row in report["timeline"]:
+        cpu = "" if row["cpu"] is None else f"{row['cpu']:.0%}"
+        depth = "" if row["webhook_depth"] is None else row["webhook_depth"]
+        print(f"{row['second']:>4}{row['target']:>9}{row['in_flight']:>9}{row['done']:>7}{row['errors']:>5}"
+              f"{row['shed']:>8}{row['p95_ms']:>9.1f}{depth:>8}{cpu:>8}")
+    print(f"\nmaximo en vuelo: {report['max_in_flight']}")
+
+# ── Saturacion ────────────────────────────────────────────────────────────────
+
+def process_cpu_seconds(root_pid):
+    # Suma utime+stime del proceso y sus hijos directos (workers de gunicorn).
+    if not root_pid or not os.path.isdir("/proc"):
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    total = 0
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(name) == root_pid or int(fields[1]) == root_pid:
+            total += int(fields[11]) + int(fields[12])
+    return total / ticks
+
+class Sampler(threading.Thread):
+    def __init__(self, stats, target, started_at, target_fn, server_pid, cpu_count):
+        super().__init__(daemon=True)
+        self.stats = stats
+        self.target = target
+        self.started_at = started_at
+        self.target_fn = target_fn
+        self.server_pid = server_pid
+        self.cpu_count = cpu_count
+        self.timeline = []
+        self.stop = threading.Event()
+
+    def run(self):
+        last_cpu = process_cpu_seconds(self.server_pid)
+        second = 0
+        while not self.stop.wait(max(0.0, self.started_at + second + 1 - time.monotonic())):
+            cpu = process_cpu_seconds(self.server_pid)
+            with self.stats._lock:
+                bucket = self.stats.seconds.get(second, {"done": 0, "errors": 0, "shed": 0, "latencies": [],
+                                                         "in_flight": 0})
+            latencies = sorted(bucket["latencies"])
+            # "in_flight" es el maximo de requests simultaneas dentro del segundo.
+            self.timeline.append({
+                "second": second, "target": self.target_fn(second + 0.5), "in_flight": bucket["in_flight"],
+                "done": bucket["done"], "errors": bucket["errors"], "shed": bucket["shed"],
+                "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+                "webhook_depth": self.target.webhook_depth(),
+                "cpu": None if cpu is None or last_cpu is None else round((cpu - last_cpu) / self.cpu_count, 3),
+            })
+            last_cpu = cpu
+            second += 1
+
+# ── Ejecucion ─────────────────────────────────────────────────────────────────
+
+def run_profile(target, mix, args, stats, started_at, recorder):
+    def worker(n):
+        rng = random.Random(args.seed * 1000 + n)
+        session = Session(target)
+        while True:
+            elapsed = time.monotonic() - started_at
+            if elapsed >= args.duration:
+                return
+            if n >= target_concurrency(args.profile, elapsed, args.duration, args.concurrency):
+                time.sleep(0.05)
+                continue
+            request = mix.next(rng)
+            execute(session, request, stats, started_at, recorder)
+            if args.think:
+                time.sleep(rng.expovariate(1 / args.think))
+
+    threads = [threading.Thread(target=worker, args=(n,), daemon=True) for n in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def run_replay(target, path, args, stats, started_at):
+    # Open loop: cada request sale en su instante grabado (dividido por --speed)
+    # aunque las anteriores no hayan terminado, hasta --concurrency en vuelo.
+    with open(path, encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    pending = collections.deque(sorted(entries, key=lambda e: e["t"]))
+    lock = threading.Lock()
+
+    def worker():
+        session = Session(target)
+        while True:
+            with lock:
+                if not pending:
+                    return
+                entry = pending.popleft()
+            delay = started_at + entry["t"] / args.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            execute(session, (entry["kind"], entry["method"], entry["path"], entry.get("body"),
+                              entry.get("content_type")), stats, started_at, None)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return max((e["t"] / args.speed for e in entries), default=0)
+
+def execute(session, request, stats, started_at, recorder):
+    kind = request[0]
+    sent_at = time.monotonic()
+    second = int(sent_at - started_at)
+    stats.started(second)
+    status, location = session.send(*request)
+    latency = time.monotonic() - sent_at
+    stats.finished(kind, second, latency, classify(kind, status, location), status)
+    if recorder is not None:
+        recorder.write(request, sent_at - started_at)
+
+class Recorder:
+    def __init__(self, path):
+        self.file = open(path, "w", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def write(self, request, offset):
+        kind, method, path, body, content_type = request
+        line = json.dumps({"t": round(offset, 4), "kind": kind, "method": method, "path": path,
+                           "body": body, "content_type": content_type})
+        with self._lock:
+            self.file.write(line + "\n")
+
+    def close(self):
+        self.file.close()
+
+# ── Instancia local ───────────────────────────────────────────────────────────
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def spawn_instance(args):
+    # MP falso en este proceso y la app en un subproceso con un DATA_DIR nuevo.
+    sys.path.insert(0, BASE_DIR)
+    from fake_mercadopago import start_fake_server
+    fake = start_fake_server(latency=args.mp_latency, error_rate=args.mp_error_rate)
+    data_dir = tempfile.mkdtemp(prefix="loadgen-data-")
+    port = free_port()
+    env = dict(os.environ, DATA_DIR=data_dir, MP_API_BASE_URL=f"http://127.0.0.1:{fake.server_address[1]}",
+               MERCADO_PAGO_ACCESS_TOKEN="TEST-loadgen", ADMIN_PASSWORD=args.admin_password or "loadgen",
+               SECRET_KEY="loadgen")
+    args.admin_password = env["ADMIN_PASSWORD"]
+    if args.settings:
+        shutil.copy(args.settings, os.path.join(data_dir, "settings.json"))
+    else:
+        import app as app_module
+        from bench import synthetic_settings
+        with open(os.path.join(data_dir, "settings.json"), "w", encoding="utf-8") as f:
+            json.dump(synthetic_settings(app_module, args.camps, args.classes, seed=args.seed), f)
+    args.settings = os.path.join(data_dir, "settings.json")
+    if args.server == "gunicorn":
+        cmd = [sys.executable, "-m", "gunicorn", "-b", f"127.0.0.1:{port}", "-w", str(args.workers),
+               "--threads", str(args.threads), "--log-level", "warning", "app:app"]
+    else:
+        cmd = [sys.executable, "-m", "flask", "--app", "app", "run", "--port", str(port), "--with-threads"]
+    log = open(os.path.join(data_dir, "server.log"), "w")
+    proc = subprocess.Popen(cmd, cwd=BASE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"La app termino al arrancar; ver {log.name}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                break
+        except OSError:
+            time.sleep(0.1)
+    else:
+        proc.terminate()
+        raise SystemExit(f"La app no respondio en 30 s; ver {log.name}")
+    print(f"App en {url} ({args.server}, pid {proc.pid}), MP falso en puerto {fake.server_address[1]}, "
+          f"datos en {data_dir}")
+    return url, proc, fake, data_dir
+
+def default_server():
+    try:
+        import gunicorn  # noqa: F401
+        return "gunicorn"
+    except ImportError:
+        return "flask"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="instancia ya corriendo (usar con --settings)")
+    parser.add_argument("--settings", help="settings.json de la instancia, para elegir campeonatos y clases")
+    parser.add_argument("--admin-password", help="para los guardados del admin y la cola de webhooks")
+    parser.add_argument("--spawn", action="store_true", help="levantar MP falso y la app localmente")
+    parser.add_argument("--server", choices=("gunicorn", "flask"), default=default_server())
+    parser.add_argument("--workers", type=int, default=2, help="workers de gunicorn")
+    parser.add_argument("--threads", type=int, default=4, help="hilos por worker de gunicorn")
+    parser.add_argument("--camps", type=int, default=3, help="campeonatos sinteticos con --spawn")
+    parser.add_argument("--classes", type=int, default=40, help="clases por campeonato con --spawn")
+    parser.add_argument("--mp-latency", type=float, default=0.15, help="demora del MP falso en segundos")
+    parser.add_argument("--mp-error-rate", type=float, default=0.0)
+    parser.add_argument("--profile", choices=("ramp", "spike", "soak"), default="ramp")
+    parser.add_argument("--concurrency", type=int, default=32, help="clientes simultaneos en el pico")
+    parser.add_argument("--duration", type=float, default=30.0, help="segundos")
+    parser.add_argument("--think", type=float, default=0.0, help="pausa media entre requests por cliente")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument("--duplicate-ratio", type=float, default=0.6,
+                        help="fraccion de webhooks que repiten un pago ya notificado")
+    parser.add_argument("--replay", metavar="JSONL", help="reproducir una carga grabada")
+    parser.add_argument("--speed", type=float, default=1.0, help="factor de velocidad para --replay")
+    parser.add_argument("--record", metavar="JSONL", help="grabar las requests enviadas")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", help="guardar el reporte en JSON")
+    args = parser.parse_args()
+    if not args.spawn and not args.url:
+        parser.error("indicar --url o --spawn")
+    if not args.replay and not args.spawn and not args.settings:
+        parser.error("la mezcla sintetica necesita --settings de la instancia")
+
+    proc = fake = data_dir = None
+    url = args.url
+    if args.spawn:
+        url, proc, fake, data_dir = spawn_instance(args)
+    target = Target(url)
+    try:
+        if args.admin_password:
+            target.login(args.admin_password)
+        elif "admin" in args.mix and not args.replay:
+            print("Aviso: sin --admin-password se omiten los guardados del admin")
+            args.mix.pop("admin")
+        stats = Stats()
+        started_at = time.monotonic()
+        if args.replay:
+            duration = None
+            target_fn = lambda second: args.concurrency
+        else:
+            duration = args.duration
+            target_fn = lambda second: target_concurrency(args.profile, second, args.duration, args.concurrency)
+        sampler = Sampler(stats, target, started_at, target_fn, proc.pid if proc else None, os.cpu_count() or 1)
+        sampler.start()
+        if args.replay:
+            duration = run_replay(target, args.replay, args, stats, started_at)
+        else:
+            with open(args.settings, encoding="utf-8") as f:
+                settings = json.load(f)
+            mix = SyntheticMix(settings, args.mix, args.duplicate_ratio, args.seed)
+            recorder = Recorder(args.record) if args.record else None
+            try:
+                run_profile(target, mix, args, stats, started_at, recorder)
+            finally:
+                if recorder:
+                    recorder.close()
+        sampler.stop.set()
+        sampler.join()
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait(timeout=10)
+        if fake:
+            fake.shutdown()
+
+    report = summarize(stats, sampler.timeline)
+    report["meta"] = {"url": url, "profile": None if args.replay else args.profile, "replay": args.replay,
+                      "concurrency": args.concurrency, "duration": duration,
+                      "mix": None if args.replay else args.mix, "duplicate_ratio": args.duplicate_ratio,
+                      "mp_calls": dict(fake.fake.calls) if fake else None}
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Reporte en {args.output}")
+    if data_dir:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import fake_mercadopago
+
+# La app lee la configuracion al importarse: DATA_DIR temporal y el SDK
+# apuntando al Mercado Pago falso antes del import.
+_fake_server = fake_mercadopago.start_fake_server("127.0.0.1", 0)
+os.environ.update(
+    DATA_DIR=tempfile.mkdtemp(prefix="inscripciones-tests-"),
+    MERCADO_PAGO_ACCESS_TOKEN="TEST-123456789",
+    MP_API_BASE_URL=f"http://127.0.0.1:{_fake_server.server_address[1]}",
+    MP_GET_RETRIES="0",
+    WEBHOOK_MAX_ATTEMPTS="2",
+    WEBHOOK_RETRY_BACKOFF="0",
+    SETTINGS_BACKEND="json",
+    LOG_LEVEL="ERROR",
+    ADMIN_PASSWORD="pw",
+)
+
+import app as webapp
+import bench
+
+# Sin hilos de fondo: cada test procesa la cola de webhooks a mano.
+webapp.reconcile_scheduler.ensure_started = lambda: None
+webapp.webhook_worker.ensure_started = lambda: None
+webapp.webhook_worker._executor = ThreadPoolExecutor(max_workers=2)
+
+@pytest.fixture
+def mp():
+    fake = _fake_server.fake
+    fake.preferences.clear()
+    fake.payments.clear()
+    fake.error_rate = 0.0
+    fake.payment_status = "approved"
+    yield fake
+    fake.error_rate = 0.0
+    webapp.mp_breaker.record_success()
+
+@pytest.fixture
+def ledger(tmp_path, monkeypatch):
+    # Un pagos.db nuevo por test.
+    db_path = str(tmp_path / "pagos.db")
+    monkeypatch.setattr(webapp, "PAGOS_DB_PATH", db_path)
+    monkeypatch.setattr(webapp, "pagos_db", webapp.LocalDB(db_path, webapp.PAGOS_SCHEMA))
+    monkeypatch.setattr(webapp, "preference_cache", webapp.PreferenceCache(16, 3600))
+    return webapp.pagos_db
+
+@pytest.fixture
+def camp(ledger):
+    # Un campeonato con cinco clases abiertas; la 001 con cupo 3.
+    raw = bench.synthetic_settings(webapp, 1, 5)
+    raw["campeonatos"][0]["classes"][1]["capacity"] = 3
+    webapp.settings_store.replace_all(raw)
+    webapp.invalidate_settings_cache()
+    return webapp.load_settings().campeonatos[0]
+
+@pytest.fixture
+def client():
+    return webapp.app.test_client()
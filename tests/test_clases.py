@@ -0,0 +1,72 @@
+import pytest
+
+import app as webapp
+
+CLASSES = [
+    {"name": "Optimist", "closed": False, "price": 20000, "discount_price": None, "capacity": 0},
+    {"name": "ILCA 7", "closed": True, "price": 30000, "discount_price": 25000, "capacity": 40},
+]
+
+def errors_of(ops, classes=CLASSES):
+    with pytest.raises(webapp.ClassChangeError) as excinfo:
+        webapp.apply_class_changes(classes, ops)
+    return [(e["index"], e["error"]) for e in excinfo.value.errors]
+
+def test_add_update_and_delete():
+    result = webapp.apply_class_changes(CLASSES, [
+        {"op": "add", "name": "420", "price": "45000"},
+        {"op": "update", "name": "ilca 7", "closed": "no", "capacity": 30},
+        {"op": "delete", "name": "Optimist"},
+    ])
+    assert result == [
+        {"name": "ILCA 7", "closed": False, "price": 30000, "discount_price": 25000, "capacity": 30},
+        {"name": "420", "closed": False, "price": 45000, "discount_price": None, "capacity": 0},
+    ]
+
+def test_input_classes_are_not_modified():
+    before = [dict(c) for c in CLASSES]
+    webapp.apply_class_changes(CLASSES, [{"op": "update", "name": "Optimist", "price": 1}])
+    assert CLASSES == before
+
+def test_rename_then_update_by_new_name():
+    result = webapp.apply_class_changes(CLASSES, [
+        {"op": "update", "name": "Optimist", "new_name": "Optimist Principiantes"},
+        {"op": "update", "name": "Optimist Principiantes", "price": ""},
+    ])
+    assert result[0]["name"] == "Optimist Principiantes"
+    assert result[0]["price"] is None
+
+def test_excel_floats_are_accepted_as_integers():
+    result = webapp.apply_class_changes(CLASSES, [{"op": "update", "name": "Optimist", "price": 30000.0}])
+    assert result[0]["price"] == 30000
+
+def test_errors_are_collected_with_their_index():
+    assert errors_of([
+        {"op": "add", "name": "optimist"},
+        {"op": "update", "name": "Laser", "price": 1},
+        {"op": "borrar", "name": "Optimist"},
+        {"op": "delete", "name": "Optimist", "price": 1},
+        {"op": "update", "name": "Optimist", "price": -5},
+        {"op": "update", "name": "Optimist", "capacity": "muchos"},
+        {"op": "update", "name": "Optimist", "new_name": "ILCA 7"},
+        "Optimist",
+    ]) == [
+        (0, "la clase optimist ya existe"),
+        (1, "no existe la clase Laser"),
+        (2, "op desconocida: 'borrar'"),
+        (3, "campos no validos para delete: price"),
+        (4, "price no puede ser negativo"),
+        (5, "capacity invalido: 'muchos'"),
+        (6, "la clase ILCA 7 ya existe"),
+        (7, "cada operacion debe ser un objeto"),
+    ]
+
+def test_nothing_is_applied_when_one_op_fails():
+    assert errors_of([
+        {"op": "delete", "name": "Optimist"},
+        {"op": "update", "name": "ILCA 7", "closed": "quizas"},
+    ]) == [(1, "closed invalido: 'quizas'")]
+
+@pytest.mark.parametrize("ops", [[], {"op": "add", "name": "420"}, None])
+def test_ops_must_be_a_non_empty_list(ops):
+    assert errors_of(ops) == [(None, "se espera una lista de operaciones")]
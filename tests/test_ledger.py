@@ -0,0 +1,172 @@
+import urllib.parse
+
+import app as webapp
+
+CAMP = "bench000"
+SINGLE_REF = f"C000_Clase 001_{CAMP}"
+TEAM_REF = f"EQTEST_{CAMP}"
+
+def payment(payment_id, status, external_reference, amount=1000.0, updated="2026-01-01T10:00:00.000-03:00"):
+    return {"id": payment_id, "status": status, "external_reference": external_reference,
+            "transaction_amount": amount, "payment_type_id": "credit_card",
+            "date_created": updated, "date_last_updated": updated}
+
+def stats(clase):
+    rows = {row["clase"]: row for row in webapp.registration_stats(CAMP)["classes"]}
+    return rows.get(clase)
+
+def single_preference():
+    webapp.record_preference({"id": "pref-single", "external_reference": SINGLE_REF}, CAMP, "Clase 001", False, 1000)
+
+def team_preference():
+    # Clase 001 x1 a 100 y Clase 002 x2 a 25: 150 en total.
+    lines = [
+        {"line_reference": f"EQTEST-01_{CAMP}", "clase": "Clase 001", "competidor": "Ana", "quantity": 1,
+         "discounted": False, "unit_price": 100.0},
+        {"line_reference": f"EQTEST-02_{CAMP}", "clase": "Clase 002", "competidor": "", "quantity": 2,
+         "discounted": True, "unit_price": 25.0},
+    ]
+    webapp.record_team_preference({"id": "pref-team", "external_reference": TEAM_REF}, CAMP, lines, 150.0)
+
+def queue_states(ledger):
+    return {row["resource_id"]: row["state"] for row in ledger.conn().execute("SELECT * FROM webhook_queue")}
+
+# ── Libro de pagos ────────────────────────────────────────────────────────────
+
+def test_repeated_status_is_recorded_once(ledger):
+    single_preference()
+    assert webapp.record_payment(payment(1, "approved", SINGLE_REF), "webhook")
+    assert not webapp.record_payment(payment(1, "approved", SINGLE_REF), "reconcile")
+    assert ledger.conn().execute("SELECT COUNT(*) FROM pagos_eventos").fetchone()[0] == 1
+    row = stats("Clase 001")
+    assert (row["approved"], row["gross_revenue"], row["card_count"]) == (1, 1000.0, 1)
+
+def test_status_change_moves_the_payment_between_buckets(ledger):
+    single_preference()
+    webapp.record_payment(payment(1, "pending", SINGLE_REF), "webhook")
+    webapp.record_payment(payment(1, "approved", SINGLE_REF), "webhook")
+    row = stats("Clase 001")
+    assert (row["pending"], row["approved"]) == (0, 1)
+    webapp.record_payment(payment(1, "refunded", SINGLE_REF), "webhook")
+    row = stats("Clase 001")
+    assert (row["approved"], row["rejected"], row["gross_revenue"]) == (0, 1, 0)
+
+def test_team_payment_is_split_in_proportion_to_each_line(ledger):
+    team_preference()
+    webapp.record_payment(payment(2, "approved", TEAM_REF, amount=120.0), "webhook")
+    lines = ledger.conn().execute(
+        "SELECT line_reference, clase, quantity, amount, status FROM pagos_lineas ORDER BY line_reference").fetchall()
+    assert [tuple(line) for line in lines] == [
+        (f"EQTEST-01_{CAMP}", "Clase 001", 1, 80.0, "approved"),
+        (f"EQTEST-02_{CAMP}", "Clase 002", 2, 40.0, "approved"),
+    ]
+    assert (stats("Clase 001")["approved"], stats("Clase 001")["gross_revenue"]) == (1, 80.0)
+    assert (stats("Clase 002")["approved"], stats("Clase 002")["discounted_revenue"]) == (2, 40.0)
+    assert stats(webapp.TEAM_CLASS) is None
+
+def test_rebuild_stats_matches_incremental_counters(ledger):
+    single_preference()
+    team_preference()
+    webapp.record_payment(payment(1, "pending", SINGLE_REF), "webhook")
+    webapp.record_payment(payment(1, "approved", SINGLE_REF), "webhook")
+    webapp.record_payment(payment(2, "approved", TEAM_REF, amount=120.0), "webhook")
+    before = webapp.registration_stats(CAMP)
+    webapp.rebuild_stats()
+    assert webapp.registration_stats(CAMP) == before
+
+# ── Verificacion contra MP ────────────────────────────────────────────────────
+
+def test_back_url_status_is_not_trusted(ledger, camp, client, mp):
+    single_preference()
+    mp.add_payment(999, status="rejected", external_reference=SINGLE_REF)
+    query = urllib.parse.urlencode({"payment_id": "999", "status": "approved", "camp_id": CAMP,
+                                    "external_reference": SINGLE_REF, "clase_barco": "Clase 001"})
+    assert client.get(f"/payment_success?{query}").status_code == 200
+    assert ledger.conn().execute("SELECT COUNT(*) FROM pagos").fetchone()[0] == 0
+    assert queue_states(ledger) == {"999": "pending"}
+    webapp.webhook_worker.drain_once()
+    status = ledger.conn().execute("SELECT status, source FROM pagos WHERE payment_id = '999'").fetchone()
+    assert tuple(status) == ("rejected", "webhook")
+    assert stats("Clase 001")["approved"] == 0
+
+def test_unverified_back_url_row_is_dropped_when_verification_fails(ledger, mp):
+    single_preference()
+    webapp.record_payment(payment(888, "approved", SINGLE_REF), "back_url")
+    assert stats("Clase 001")["approved"] == 1
+    webapp.enqueue_webhook("payment", "888")
+    mp.error_rate = 1.0
+    for _ in range(webapp.WEBHOOK_MAX_ATTEMPTS):
+        webapp.webhook_worker.drain_once()
+    assert queue_states(ledger) == {"888": "failed"}
+    assert ledger.conn().execute("SELECT COUNT(*) FROM pagos").fetchone()[0] == 0
+    assert stats("Clase 001")["approved"] == 0
+
+def test_reconcile_records_missing_payments_and_advances_the_cursor(ledger, mp):
+    single_preference()
+    mp.add_payment(11, status="approved", external_reference=SINGLE_REF,
+                   date_last_updated="2026-01-02T10:00:00.000-03:00")
+    mp.add_payment(12, status="pending", external_reference=SINGLE_REF,
+                   date_last_updated="2026-01-03T10:00:00.000-03:00")
+    mp.add_payment(13, status="approved", external_reference="C001_Clase 001_otro",
+                   date_last_updated="2026-01-04T10:00:00.000-03:00")
+    report = webapp.reconcile_payments(CAMP, since="2026-01-01T00:00:00.000-03:00", page_size=1, concurrency=2)
+    assert sorted(p["payment_id"] for p in report["missing"]) == ["11", "12"]
+    assert report["cursor"] == "2026-01-03T10:00:00.000-03:00"
+    assert webapp._job_cursor(f"reconcile:{CAMP}") == report["cursor"]
+    row = stats("Clase 001")
+    assert (row["approved"], row["pending"]) == (1, 1)
+    again = webapp.reconcile_payments(CAMP, page_size=1)
+    assert again["since"] == report["cursor"]
+    assert not again["missing"] and not again["changed"]
+
+# ── Cupos y reservas ──────────────────────────────────────────────────────────
+
+def test_reservations_are_all_or_nothing(ledger):
+    ids, full = webapp.reserve_slots(CAMP, {"Clase 001": (2, 3)}, SINGLE_REF)
+    assert len(ids) == 2 and full is None
+    assert webapp.reserve_slots(CAMP, {"Clase 002": (1, 5), "Clase 001": (2, 3)}) == ((), "Clase 001")
+    assert webapp.slots_taken(CAMP) == {"Clase 001": 2}
+    webapp.release_slots(ids)
+    assert webapp.slots_taken(CAMP) == {}
+
+def test_recorded_payment_consumes_its_reservation(ledger):
+    single_preference()
+    webapp.reserve_slots(CAMP, {"Clase 001": (1, 3)}, SINGLE_REF)
+    webapp.reserve_slots(CAMP, {"Clase 001": (1, 3)}, f"C000_Clase 001_{CAMP}-otro")
+    webapp.record_payment(payment(1, "pending", SINGLE_REF), "webhook")
+    assert webapp.slots_taken(CAMP) == {"Clase 001": 2}
+    webapp.record_payment(payment(1, "approved", SINGLE_REF), "webhook")
+    assert webapp.slots_taken(CAMP) == {"Clase 001": 2}
+    webapp.record_payment(payment(1, "rejected", SINGLE_REF), "webhook")
+    assert webapp.slots_taken(CAMP) == {"Clase 001": 1}
+
+def test_team_payment_consumes_one_reservation_per_boat(ledger):
+    team_preference()
+    webapp.reserve_slots(CAMP, {"Clase 001": (1, 3), "Clase 002": (2, 5)}, TEAM_REF)
+    webapp.record_payment(payment(2, "pending", TEAM_REF, amount=150.0), "webhook")
+    assert webapp.slots_taken(CAMP) == {"Clase 001": 1, "Clase 002": 2}
+    assert ledger.conn().execute("SELECT COUNT(*) FROM reservas").fetchone()[0] == 0
+    assert ledger.conn().execute("SELECT COUNT(*) FROM reservas_referencia").fetchone()[0] == 0
+
+# ── Checkout de equipo ────────────────────────────────────────────────────────
+
+def team_form(camp):
+    return {"camp_id": camp.id, "clase-0": "Clase 001", "competidor-0": "Ana",
+            "clase-1": "Clase 002", "cantidad-1": "2"}
+
+def test_identical_team_carts_get_distinct_references(camp, client, mp):
+    for _ in range(2):
+        assert client.post("/process_team_inscription", data=team_form(camp)).status_code == 302
+    references = [pref["external_reference"] for pref in mp.preferences.values()]
+    assert len(set(references)) == 2
+    for reference in references:
+        assert reference.startswith(webapp.TEAM_REFERENCE_PREFIX) and reference.endswith(f"_{camp.id}")
+        assert [line["quantity"] for line in webapp.team_lines(reference)] == [1, 2]
+
+def test_team_checkout_respects_class_capacity(camp, client, mp, ledger):
+    form = dict(team_form(camp), **{"cantidad-0": "2"})
+    assert client.post("/process_team_inscription", data=form).status_code == 302
+    assert webapp.slots_taken(camp.id)["Clase 001"] == 2
+    response = client.post("/process_team_inscription", data=form)
+    assert response.status_code == 409
+    assert webapp.slots_taken(camp.id)["Clase 001"] == 2